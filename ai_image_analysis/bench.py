@@ -0,0 +1,37 @@
+import time
+
+import click
+
+from . import routes
+
+STAGES = ('decode', 'resize', 'encode')
+
+
+def run_inline(paths, repeat, draft):
+    """
+    inline_image を全ファイルに repeat 回かけ、(段階ごとの合計秒, 合計秒, data URL の合計バイト数) を返す
+    """
+    totals = dict.fromkeys(STAGES, 0.0)
+    size = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            timings = {}
+            size += len(routes.inline_image(path, timings, draft=draft))
+            for stage in STAGES:
+                totals[stage] += timings[stage]
+    return totals, time.perf_counter() - started, size
+
+
+@click.command('inline-bench')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--repeat', default=3, help='同じファイル群を繰り返す回数')
+def inline_bench_command(paths, repeat):
+    """OpenAI に送る画像の縮小・再圧縮を測る（縮小しながらのデコードを使わない場合と比べる）"""
+    count = len(paths) * repeat
+    routes.inline_image(paths[0])  # 初回の読み込み分は除く
+    for label, draft in (("全体をデコード", False), ("縮小しながらデコード", True)):
+        totals, elapsed, size = run_inline(paths, repeat, draft)
+        stages = ", ".join(f"{stage} {totals[stage] * 1000 / count:.1f}" for stage in STAGES)
+        click.echo(f"{label}: 1枚 {elapsed * 1000 / count:.1f} ms（{stages} ms, "
+                   f"{count / elapsed:.1f} 枚/秒, 送信 {size / count / 1024:.0f} KB/枚）")
@@ -1,25 +1,73 @@
-from flask import request, session, redirect, render_template, url_for, flash, jsonify
+from flask import request, session, redirect, render_template, url_for, flash, jsonify, Response
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import pytz
 import uuid
 import openai
 import os
+import io
+import json
+import time
+import base64
+import hashlib
+import threading
 import platform
+import numpy as np
 from .forms import FileRegisterForm
 from PIL import Image
-import pillow_heif
 import sqlite3
+from common.db import register_database, get_connection
+from common.history_store import record, register_legacy, query_history, cache_counts
+from common.janitor import register_folder
+from common.images import is_jpegfile, save_upload_as_jpeg, ImageTooLarge
+from common.workers import WorkerPool, resume_once
 from . import ai_image_analysis_bp  # Blueprintをインポート
 
 
 IMAGE_URL = 'http://18.181.162.5:5000/ai_image_analysis/static/images/'
 IMAGE_URL2 = 'https://upload.wikimedia.org/wikipedia/commons/thumb/d/dd/Gfp-wisconsin-madison-the-nature-boardwalk.jpg/2560px-Gfp-wisconsin-madison-the-nature-boardwalk.jpg'
 UPLOAD_FOLDER = './ai_image_analysis/static/images/'
+register_folder(UPLOAD_FOLDER, max_age=24 * 3600, max_bytes=500 * 1024 ** 2)  # 古い画像は common.janitor が消す
+
+# 画像の渡し方
+#   inline : 縮小・再圧縮した画像を base64 の data URL で直接送る（OpenAI からの取りに来る通信が無い）
+#   url    : 公開URL（IMAGE_URL）を渡して OpenAI に取りに来てもらう（従来の方式）
+IMAGE_MODE = os.environ.get("AI_IMAGE_MODE", "inline")
+# モデルが使う解像度（高詳細モードは長辺2048・短辺768に縮めてから見る）に合わせて縮小する
+INLINE_MAX_LONG_SIDE = 2048
+INLINE_MAX_SHORT_SIDE = 768
+INLINE_FORMAT = os.environ.get("AI_IMAGE_FORMAT", "JPEG").upper()  # JPEG または WEBP
+INLINE_QUALITY = 85
+
+# 分析に使うモデルとプロンプト（変えたら分析結果のキャッシュも別扱いになる）
+ANALYSIS_MODEL = 'gpt-4o'
+ANALYSIS_PROMPT = "写真を分析して、日本語で説明してください"
+
+# 分析結果のキャッシュ（同じ画像・ほぼ同じ画像は OpenAI を呼ばずに前回の結果を返す）
+#   ANALYSIS_CACHE_DISTANCE : 知覚ハッシュ（64ビット）のハミング距離がこれ以下なら同じ写真とみなす
+ANALYSIS_CACHE_DISTANCE = int(os.environ.get("AI_IMAGE_CACHE_DISTANCE", "4"))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get("AI_IMAGE_CACHE_MAX_ENTRIES", "5000"))
+ANALYSIS_CACHE_TTL = int(os.environ.get("AI_IMAGE_CACHE_TTL", str(30 * 24 * 3600)))  # 秒
+#   知覚ハッシュは PHASH_BANDS 個の帯（band0〜）に分けて索引を張る。距離が PHASH_BANDS 未満なら
+#   どれか1つの帯は完全に一致するので、帯が一致する行だけを比べればよい。
+#   ANALYSIS_CACHE_DISTANCE が PHASH_BANDS 以上の時は全件（最大 ANALYSIS_CACHE_MAX_ENTRIES 件）と比べる
+PHASH_BANDS = 5
+
+# 分析タスク（アップロードはすぐ返し、分析はワーカーで1回だけ行う）
+TASK_WORKERS = int(os.environ.get("AI_IMAGE_WORKERS", "4"))  # 同時に実行する分析数
+TASK_STALE_SECONDS = 300   # これより長く更新が無い実行中タスクは中断されたとみなす
+TASK_STREAM_TIMEOUT = 120  # SSE で結果を待つ最長時間（秒）
+
+
+class ImageExpired(RuntimeError):
+    """アップロードされた画像が保存期間を過ぎて消されている"""
+PARTIAL_SAVE_INTERVAL = 0.5  # 生成途中の文章をDBに書く最短間隔（秒、別プロセスのSSE用）
 
 # データベースのパスを指定
 DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
 
+register_database(DATABASE)
+
 # OpenAI APIキーの設定
 
 #openai.api_key = os.environ["OPENAI_API_KEY"]
@@ -31,33 +79,75 @@ HISTORY_PASSWORD = os.environ.get("HISTORY_PASSWORD", "Canon-01")
 # 日本標準時 (JST) のタイムゾーンを取得
 jst = pytz.timezone('Asia/Tokyo')
 
+def phash_bands(phash):
+    """
+    知覚ハッシュ（64ビット）を PHASH_BANDS 個の帯に分ける
+    """
+    value = phash & 0xFFFFFFFFFFFFFFFF
+    bands = []
+    for i in range(PHASH_BANDS):
+        start, end = i * 64 // PHASH_BANDS, (i + 1) * 64 // PHASH_BANDS
+        bands.append((value >> start) & ((1 << (end - start)) - 1))
+    return bands
+
 # データベースの初期化
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS history
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                  image_name TEXT,
-                  image_url TEXT,
-                  ai_analysis TEXT)''')
-    conn.commit()
-    conn.close()
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                      image_name TEXT,
+                      image_url TEXT,
+                      ai_analysis TEXT)''')
+        # 画像の前処理とAPI呼び出しの所要時間（JSON、ミリ秒）と
+        # 分析結果キャッシュの利用（0: ミス、1: 同じ画像、2: ほぼ同じ画像）
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+        for column, column_type in [('timings', 'TEXT'), ('cache_hit', 'INTEGER')]:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE history ADD COLUMN {column} {column_type}")
+        # 分析結果のキャッシュ（sha256 は画像ファイルの内容、phash は知覚ハッシュ、prompt_key はモデル＋プロンプト）
+        conn.execute('''CREATE TABLE IF NOT EXISTS analysis_cache
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      prompt_key TEXT,
+                      sha256 TEXT,
+                      phash INTEGER,
+                      ai_analysis TEXT,
+                      created_at REAL,
+                      last_access REAL,
+                      hits INTEGER DEFAULT 0)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_sha256 ON analysis_cache (prompt_key, sha256)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_access ON analysis_cache (last_access)")
+        # 知覚ハッシュの帯（以前の行は phash から埋める）
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(analysis_cache)")]
+        for i in range(PHASH_BANDS):
+            if f'band{i}' not in columns:
+                conn.execute(f"ALTER TABLE analysis_cache ADD COLUMN band{i} INTEGER")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_analysis_cache_band{i} ON analysis_cache (band{i})")
+        for entry_id, phash in conn.execute("SELECT id, phash FROM analysis_cache WHERE band0 IS NULL").fetchall():
+            conn.execute(f"UPDATE analysis_cache SET {', '.join(f'band{i} = ?' for i in range(PHASH_BANDS))} "
+                         "WHERE id = ?", (*phash_bands(phash), entry_id))
+        # 分析タスク（再起動しても残るようDBに保存）
+        conn.execute('''CREATE TABLE IF NOT EXISTS tasks
+                     (id TEXT PRIMARY KEY,
+                      created_at DATETIME,
+                      updated_at DATETIME,
+                      image_file TEXT,
+                      image_url TEXT,
+                      status TEXT,
+                      ai_analysis TEXT,
+                      message TEXT)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status)")
 
 init_db()
 
-def save_history(image_name, image_url, ai_analysis):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+register_legacy('ai_image_analysis', DATABASE,
+                "SELECT id, timestamp, NULL, image_name, ai_analysis, cache_hit, image_url, timings FROM history",
+                detail=('image_url', 'timings'), json_detail=('timings',))
 
-    # 現在の日時をJSTで取得
-    current_time = datetime.now(jst)
-    
-    c.execute("INSERT INTO history (timestamp, image_name, image_url, ai_analysis) VALUES (?, ?, ?, ?)",
-              (current_time, image_name, image_url, ai_analysis))
-    
-    conn.commit()
-    conn.close()
+def save_history(image_name, image_url, ai_analysis, timings=None, cache_hit=None):
+    record('ai_image_analysis', file=image_name, result=ai_analysis, cache_hit=cache_hit, image_url=image_url,
+           timings={k: round(v * 1000, 1) for k, v in timings.items()} if timings else None)
 
 @ai_image_analysis_bp.route("/", methods=['GET', 'POST'])
 def index():
@@ -75,23 +165,27 @@ def index():
         unique_filename = str(uuid.uuid4()) + '.jpg'
         file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
         
-        if is_heif:
-            save_heif_as_jpeg(temp_file, file_path)
-        else:
-            temp_file.save(file_path)
+        # 変換（HEIF→JPEG・大きすぎる画像の縮小）は別プロセスで行う
+        try:
+            save_upload_as_jpeg(temp_file, file_path)
+        except ImageTooLarge as e:
+            session["error_msg"] = str(e)
+            return jsonify({'error': session["error_msg"]}), 400
         
         #session["file"] = file_path
 
         # TEST_FLAGに基づいてURLを設定
+        session["image_file"] = unique_filename
         if platform.system() == "Windows":
             session["image_url"] = IMAGE_URL2
+        elif IMAGE_MODE == "inline":
+            # 表示用。OpenAI へは画像そのものを送る
+            session["image_url"] = url_for('ai_image_analysis.static', filename='images/' + unique_filename)
         else:
             session["image_url"] = IMAGE_URL +  unique_filename
-        # OpenAIによる分析
+        # OpenAIによる分析はワーカーで行い、結果画面から待つ
         #print("akio" + session["image_url"])
-        ai_msg = get_ai_img(session["image_url"])
-        # 履歴を保存
-        save_history(unique_filename, session["image_url"], ai_msg)
+        session["task_id"] = submit_task(unique_filename, session["image_url"])
 
         return redirect(url_for('ai_image_analysis.user_maintenance'))
     return render_template("upload.html", form=form)
@@ -102,68 +196,343 @@ def user_maintenance():
 
 @ai_image_analysis_bp.route("/get_ai_analysis")
 def get_ai_analysis():
-    try:
-        ai_msg = get_ai_img(session['image_url'])
-        if ai_msg is None:
-            return jsonify({'error': 'OpenAI APIでエラーが発生しました'})
-        return jsonify({'result': ai_msg})
-    except Exception as e:
-        return jsonify({'error': f"エラーが発生しました: {str(e)}"})
+    # 直前にアップロードした画像のタスクの状態（分析中は status のみ）
+    task = get_task(session.get('task_id')) if session.get('task_id') else None
+    if not task:
+        return jsonify({'error': '分析する画像がありません'})
+    return jsonify(task_result(task))
+
+@ai_image_analysis_bp.route("/task/<task_id>")
+def task_status(task_id):
+    task = get_task(task_id)
+    if not task:
+        return jsonify({'error': 'task not found'}), 404
+    return jsonify(task_result(task))
+
+@ai_image_analysis_bp.route("/task/<task_id>/events")
+def task_events(task_id):
+    """
+    生成途中の文章を delta イベントで送り、終わったら結果を送る（Server-Sent Events）
+    """
+    def generate():
+        done = _task_done.setdefault(task_id, threading.Event())
+        deadline = time.monotonic() + TASK_STREAM_TIMEOUT
+        sent = 0  # 送った文字数
+        try:
+            while time.monotonic() < deadline:
+                done.clear()
+                task = get_task(task_id)
+                if not task:
+                    yield f"data: {json.dumps({'error': 'task not found'})}\n\n"
+                    return
+                if task['status'] in ('done', 'error'):
+                    yield f"data: {json.dumps(task_result(task), ensure_ascii=False)}\n\n"
+                    return
+                text = partial_text(task)
+                if len(text) > sent:
+                    yield f"event: delta\ndata: {json.dumps(text[sent:], ensure_ascii=False)}\n\n"
+                    sent = len(text)
+                # 同じプロセスのワーカーなら文章が届いた時点で起こされる（別プロセスなら1秒ごとに確認）
+                if not done.wait(1.0):
+                    yield ": waiting\n\n"
+            yield f"data: {json.dumps({'error': 'タイムアウトしました'}, ensure_ascii=False)}\n\n"
+        finally:
+            _task_done.pop(task_id, None)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @ai_image_analysis_bp.route("/history", methods=['GET', 'POST'])
 def history():
     if request.method == 'POST':
         password = request.form.get('password')
         if password == HISTORY_PASSWORD:
-            conn = sqlite3.connect(DATABASE)
-            c = conn.cursor()
-            c.execute("SELECT id, datetime(timestamp, 'localtime'), image_name, image_url, ai_analysis FROM history ORDER BY timestamp DESC")
-            history_data = c.fetchall()
-            conn.close()
-            return render_template('history.html', history=history_data)
+            session['ai_image_analysis_history'] = True
+            return redirect(url_for('ai_image_analysis.history'))
         else:
             flash("パスワードが正しくありません", "danger")
             return redirect(url_for('ai_image_analysis.history'))
-    return render_template('password_prompt.html')
+    if not session.get('ai_image_analysis_history'):
+        return render_template('password_prompt.html')
+
+    # 期間指定とページ移動は common.history_store
+    page = query_history('ai_image_analysis', request.args)
+    history_data = [(row[0], row[1], row[3], row[6].get('image_url'), row[4], row[6].get('timings', {}))
+                    for row in page.rows]
+    # キャッシュの利用状況
+    counts = cache_counts('ai_image_analysis')
+    cache_stats = {'exact': counts.get(1, 0), 'near': counts.get(2, 0), 'miss': counts.get(0, 0)}
+    c = get_connection(DATABASE).cursor()
+    c.execute("SELECT COUNT(*), IFNULL(SUM(hits), 0) FROM analysis_cache")
+    cache_stats['entries'], cache_stats['hits'] = c.fetchone()
+    return render_template('history.html', history=history_data, page=page, args=request.args,
+                           cache_stats=cache_stats)
 
 
 @ai_image_analysis_bp.route('/error_msg')
 def error_msg():
     return render_template('message.html')
 
-def is_jpegfile(file):
-    header = file.read(12)
-    file.seek(0)  # ファイルポインタを元に戻す
+def inline_image(file_path, timings=None, draft=True):
+    """
+    画像をモデルが使う解像度まで縮小・再圧縮して data URL にする
+    timings に decode / resize / encode の所要時間（秒）を記録する
+    draft=False は縮小しながらのデコードを使わない（flask inline-bench での比較用）
+    """
+    timings = {} if timings is None else timings
+
+    started = time.perf_counter()
+    image = Image.open(file_path)
+    # JPEG は縮小しながらデコードできる（draft は 1/2, 1/4, 1/8 の範囲で目標以上の大きさを選ぶ）
+    if draft:
+        image.draft('RGB', (INLINE_MAX_SHORT_SIDE, INLINE_MAX_SHORT_SIDE))
+    image = image.convert('RGB')
+    timings['decode'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    width, height = image.size
+    scale = min(1.0, INLINE_MAX_LONG_SIDE / max(width, height), INLINE_MAX_SHORT_SIDE / min(width, height))
+    if scale < 1.0:
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))),
+                             Image.LANCZOS, reducing_gap=3.0)
+    timings['resize'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    if INLINE_FORMAT == 'WEBP':
+        image.save(buffer, 'WEBP', quality=INLINE_QUALITY, method=4)
+        mime = 'image/webp'
+    else:
+        image.save(buffer, 'JPEG', quality=INLINE_QUALITY, optimize=True, progressive=True)
+        mime = 'image/jpeg'
+    data_url = f"data:{mime};base64," + base64.b64encode(buffer.getvalue()).decode('ascii')
+    timings['encode'] = time.perf_counter() - started
+    return data_url
+
+def image_payload(image_file, image_url, timings=None):
+    """
+    OpenAI に渡す画像（inline なら data URL、それ以外は公開URL）
+    inline で画像が消されていたら ImageExpired（image_url は表示用の相対URLで OpenAI からは取れない）
+    """
+    if IMAGE_MODE == "inline" and image_file and platform.system() != "Windows":
+        file_path = os.path.join(UPLOAD_FOLDER, image_file)
+        if not os.path.exists(file_path):
+            raise ImageExpired("画像の保存期間が過ぎたため分析できません。もう一度アップロードしてください")
+        return inline_image(file_path, timings)
+    return image_url
+
+# pHash 用の 32x32 DCT 行列
+_DCT = np.array([[np.sqrt((1 if k == 0 else 2) / 32) * np.cos(np.pi * (2 * n + 1) * k / 64)
+                  for n in range(32)] for k in range(32)])
+
+def image_hashes(file_path):
+    """
+    画像ファイルの sha256 と知覚ハッシュ（pHash、64ビットを SQLite に入るよう符号付きにしたもの）を返す
+    """
+    with open(file_path, 'rb') as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
 
-    # JPEG判定
-    is_jpeg = header[:2] == b'\xff\xd8'
+    image = Image.open(file_path)
+    image.draft('L', (64, 64))
+    pixels = np.asarray(image.convert('L').resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].flatten()
+    bits = low > np.median(low[1:])  # 直流成分は除いて中央値と比べる
+    value = int(''.join('1' if b else '0' for b in bits), 2)
+    return sha256, value - (1 << 64) if value >= (1 << 63) else value
 
-    # HEIF/HEIC判定
-    heif_formats = [
-        b'ftypheic', b'ftypheix', b'ftyphevc', b'ftyphevx',
-        b'ftypmif1', b'ftypmsf1'
-    ]
-    is_heif = any(header[4:12] == heif for heif in heif_formats)
+def analysis_prompt_key():
+    return hashlib.sha1(f"{ANALYSIS_MODEL}\n{ANALYSIS_PROMPT}".encode('utf-8')).hexdigest()
 
-    return is_jpeg, is_heif
+def lookup_analysis(sha256, phash):
+    """
+    キャッシュから分析結果を探す。(分析結果, 1:同じ画像 / 2:ほぼ同じ画像) か None を返す
+    """
+    conn = get_connection(DATABASE)
+    prompt_key = analysis_prompt_key()
+    min_created = time.time() - ANALYSIS_CACHE_TTL
+    row = conn.execute("SELECT id, ai_analysis FROM analysis_cache WHERE prompt_key = ? AND sha256 = ? "
+                       "AND created_at >= ? ORDER BY id DESC LIMIT 1", (prompt_key, sha256, min_created)).fetchone()
+    kind = 1
+    if row is None and ANALYSIS_CACHE_DISTANCE >= 0:
+        query = "SELECT id, phash, ai_analysis FROM analysis_cache WHERE +prompt_key = ? AND created_at >= ?"
+        params = (prompt_key, min_created)
+        if ANALYSIS_CACHE_DISTANCE < PHASH_BANDS:
+            # 帯の索引で候補を引く（prompt_key の索引は使わせない）
+            query += " AND (" + " OR ".join(f"band{i} = ?" for i in range(PHASH_BANDS)) + ")"
+            params += tuple(phash_bands(phash))
+        best = None
+        for entry_id, entry_phash, ai_analysis in conn.execute(query, params):
+            distance = ((entry_phash ^ phash) & 0xFFFFFFFFFFFFFFFF).bit_count()
+            if distance <= ANALYSIS_CACHE_DISTANCE and (best is None or distance < best[0]):
+                best = (distance, entry_id, ai_analysis)
+        if best:
+            row, kind = best[1:], 2
+    if row is None:
+        return None
+
+    with conn:
+        conn.execute("UPDATE analysis_cache SET last_access = ?, hits = hits + 1 WHERE id = ?", (time.time(), row[0]))
+    return row[1], kind
+
+def store_analysis(sha256, phash, ai_analysis):
+    """
+    分析結果をキャッシュに入れ、期限切れと上限を超えた分（最終利用の古い順）を消す
+    """
+    now = time.time()
+    conn = get_connection(DATABASE)
+    with conn:
+        bands = ", ".join(f"band{i}" for i in range(PHASH_BANDS))
+        conn.execute(f"INSERT INTO analysis_cache (prompt_key, sha256, phash, ai_analysis, created_at, last_access, "
+                     f"{bands}) VALUES (?, ?, ?, ?, ?, ?, {', '.join('?' * PHASH_BANDS)})",
+                     (analysis_prompt_key(), sha256, phash, ai_analysis, now, now, *phash_bands(phash)))
+        conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - ANALYSIS_CACHE_TTL,))
+        conn.execute("DELETE FROM analysis_cache WHERE id NOT IN "
+                     "(SELECT id FROM analysis_cache ORDER BY last_access DESC LIMIT ?)", (ANALYSIS_CACHE_MAX_ENTRIES,))
+
+def analyze_image(image_file, image_url, timings=None, on_delta=None):
+    """
+    画像を分析する。キャッシュにあれば OpenAI は呼ばない。(分析結果, cache_hit) を返す
+    on_delta を渡すと生成途中の文章を少しずつ受け取れる
+    """
+    timings = {} if timings is None else timings
+    file_path = os.path.join(UPLOAD_FOLDER, image_file) if image_file else None
+    if not file_path or not os.path.exists(file_path):
+        return get_ai_img(image_payload(image_file, image_url, timings), timings, on_delta), None
+
+    started = time.perf_counter()
+    sha256, phash = image_hashes(file_path)
+    timings['hash'] = time.perf_counter() - started
+
+    cached = lookup_analysis(sha256, phash)
+    if cached:
+        return cached
+
+    ai_msg = get_ai_img(image_payload(image_file, image_url, timings), timings, on_delta)
+    if ai_msg is not None:
+        store_analysis(sha256, phash, ai_msg)
+    return ai_msg, 0
+
+# 分析用のワーカープール
+executor = WorkerPool(TASK_WORKERS, 'ai_image')
+_task_done = {}     # task_id -> threading.Event（SSE で待っている間だけ。文章が届くか終わると立つ）
+_task_partial = {}  # task_id -> 生成途中の文章の断片（実行中だけ）
+
+def wake_listeners(task_id):
+    event = _task_done.get(task_id)
+    if event:
+        event.set()
+
+def partial_text(task):
+    """
+    生成途中の文章（同じプロセスで実行中ならメモリから、そうでなければDBの途中保存から）
+    """
+    parts = _task_partial.get(task['id'])
+    return "".join(parts) if parts is not None else (task['ai_analysis'] or "")
+
+def submit_task(image_file, image_url):
+    """
+    分析タスクを登録してすぐにタスクIDを返す
+    """
+    task_id = uuid.uuid4().hex
+    now = datetime.now(jst)
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute("INSERT INTO tasks (id, created_at, updated_at, image_file, image_url, status, message) "
+                     "VALUES (?, ?, ?, ?, ?, 'queued', '待機中')", (task_id, now, now, image_file, image_url))
+    executor.submit(run_task, task_id)
+    return task_id
+
+def update_task(task_id, **fields):
+    fields['updated_at'] = datetime.now(jst)
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute(f"UPDATE tasks SET {columns} WHERE id = ?", (*fields.values(), task_id))
 
-def save_heif_as_jpeg(heif_file, output_path):
-    heif_file.seek(0)
-    image = Image.open(heif_file)
-    image = image.convert("RGB")  # RGBに変換
-    image.save(output_path, "JPEG")
+def get_task(task_id):
+    c = get_connection(DATABASE).cursor()
+    c.row_factory = sqlite3.Row
+    c.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
+    row = c.fetchone()
+    return dict(row) if row else None
 
-def get_ai_img(url):
+def task_result(task):
+    if task['status'] == 'done':
+        return {'status': 'done', 'result': task['ai_analysis']}
+    if task['status'] == 'error':
+        return {'status': 'error', 'error': task['message']}
+    return {'status': task['status']}
+
+def run_task(task_id):
+    """
+    ワーカースレッドでタスクを1件実行する
+    """
+    conn = get_connection(DATABASE)
+    # 待機中のものだけを実行中にする（他のプロセスが先に取っていたら何もしない）
+    with conn:
+        claimed = conn.execute("UPDATE tasks SET status = 'running', message = '分析中', updated_at = ? "
+                               "WHERE id = ? AND status = 'queued'", (datetime.now(jst), task_id)).rowcount
+    if claimed != 1:
+        return
+    task = get_task(task_id)
+
+    # 生成途中の文章（同じプロセスのSSEへはメモリで、別プロセスへはDB経由で渡す）
+    parts = _task_partial[task_id] = []
+    last = {'time': 0.0}
+    def on_delta(delta):
+        parts.append(delta)
+        wake_listeners(task_id)
+        now = time.monotonic()
+        if now - last['time'] >= PARTIAL_SAVE_INTERVAL:
+            last['time'] = now
+            update_task(task_id, ai_analysis="".join(parts))
+
+    try:
+        timings = {}
+        ai_msg, cache_hit = analyze_image(task['image_file'], task['image_url'], timings, on_delta)
+        # 履歴を保存
+        save_history(task['image_file'], task['image_url'], ai_msg, timings, cache_hit)
+        if ai_msg is None:
+            update_task(task_id, status='error', message='OpenAI APIでエラーが発生しました')
+        else:
+            update_task(task_id, status='done', ai_analysis=ai_msg, message='完了')
+    except ImageExpired as e:
+        update_task(task_id, status='error', message=str(e))
+    except Exception as e:
+        update_task(task_id, status='error', message=f"エラーが発生しました: {str(e)}")
+    finally:
+        _task_partial.pop(task_id, None)
+        wake_listeners(task_id)
+
+def resume_tasks():
+    """
+    再起動などで終わらなかったタスク（待機中・更新が途絶えた実行中）を待機中に戻して再実行する
+    """
+    conn = get_connection(DATABASE)
+    stale = datetime.fromtimestamp(time.time() - TASK_STALE_SECONDS, jst)
+    with conn:
+        conn.execute("UPDATE tasks SET status = 'queued', message = '再開待ち' "
+                     "WHERE status = 'running' AND updated_at < ?", (stale,))
+    for (task_id,) in conn.execute("SELECT id FROM tasks WHERE status = 'queued' ORDER BY created_at").fetchall():
+        executor.submit(run_task, task_id)
+
+tasks_resume = resume_once(ai_image_analysis_bp, resume_tasks)
+
+def get_ai_img(url, timings=None, on_delta=None):
+    """
+    OpenAI に画像を分析させる。on_delta を渡すとストリーミングで受け取り、届いた断片ごとに呼ぶ
+    """
+    started = time.perf_counter()
     try:
         completion = client.chat.completions.create(
-            model='gpt-4o',
+            model=ANALYSIS_MODEL,
             messages=[
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": "写真を分析して、日本語で説明してください"
+                            "text": ANALYSIS_PROMPT
                         },
                         {
                             "type": "image_url",
@@ -174,9 +543,26 @@ def get_ai_img(url):
                     ]
                 }
             ],
-            max_tokens=300
+            max_tokens=300,
+            stream=on_delta is not None
         )
-        return completion.choices[0].message.content
+        if on_delta is None:
+            return completion.choices[0].message.content
+
+        parts = []
+        for chunk in completion:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not parts and timings is not None:
+                    timings['first_token'] = time.perf_counter() - started
+                parts.append(delta)
+                on_delta(delta)
+        return "".join(parts)
     except Exception:
         return None
+    finally:
+        if timings is not None:
+            timings['api'] = time.perf_counter() - started
 
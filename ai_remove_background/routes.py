@@ -1,22 +1,40 @@
 import os
 import uuid
-import sqlite3
-from flask import render_template, request, redirect, url_for, session, jsonify, send_file, flash
+import threading
+from common.db import register_database, get_connection
+from common.history_store import record, register_legacy, query_history
+from flask import render_template, request, redirect, url_for, session, jsonify, flash
 from .forms import ImageUploadForm  # FlaskFormのインポート
 from . import ai_remove_background_bp  # __init__.pyからBlueprintをインポート
-from ai_image_analysis.routes import is_jpegfile, save_heif_as_jpeg
-from rembg import remove
-from PIL import Image
-from io import BytesIO
-from datetime import datetime
+from common.images import is_jpegfile, to_jpeg_bytes, ImageTooLarge
+from common.janitor import register_folder
+from common.media import send_media
 import pytz
 
 UPLOAD_FOLDER = './ai_remove_background/static/uploads/'
 RESULT_FOLDER = './ai_remove_background/static/results/'
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(RESULT_FOLDER, exist_ok=True)
+register_folder(UPLOAD_FOLDER, max_age=24 * 3600, max_bytes=500 * 1024 ** 2)  # 古い画像は common.janitor が消す
+register_folder(RESULT_FOLDER, max_age=24 * 3600, max_bytes=500 * 1024 ** 2)
+
+# 背景除去のモデル（プロセスごとに1回だけ読み込んで使い回す）
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+BATCH_MAX_FILES = 20  # 一括処理で受け付ける枚数の上限
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class RembgUnavailable(RuntimeError):
+    """rembg（と onnxruntime）が読み込めない"""
 
 # データベースのパスを指定
 DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
 
+register_database(DATABASE)
+
 # 認証に使用するパスワード
 HISTORY_PASSWORD = os.environ.get("HISTORY_PASSWORD", "Canon-01")
 
@@ -25,34 +43,71 @@ jst = pytz.timezone('Asia/Tokyo')
 
 # データベースに履歴を保存
 def save_history(original_filename, result_filename):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO history (original_filename, result_filename) 
-        VALUES (?, ?)
-    ''', (original_filename, result_filename))
-    conn.commit()
-    conn.close()
+    record('ai_remove_background', file=original_filename, result=result_filename)
 
 # データベースの初期化
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    # テーブル作成SQL
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            original_filename TEXT,
-            result_filename TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    conn = get_connection(DATABASE)
+    with conn:
+        # テーブル作成SQL
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                original_filename TEXT,
+                result_filename TEXT
+            )
+        ''')
 
 # サーバー起動時にデータベースを初期化
 init_db()
 
+register_legacy('ai_remove_background', DATABASE,
+                "SELECT id, timestamp, NULL, original_filename, result_filename, NULL FROM history")
+
+def get_session():
+    """
+    rembg のモデルセッション（プロセスごとに1つ、fork後は作り直す）
+    rembg は重いので、使う時に初めて import する
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            try:
+                from rembg import new_session
+            except ImportError as e:
+                print(f"rembg の読み込みに失敗しました: {e}")
+                raise RembgUnavailable("背景除去の機能が利用できません（rembg がインストールされていません）") from e
+            _session = new_session(REMBG_MODEL)
+            _session_pid = os.getpid()
+        return _session
+
+def remove_background(file):
+    """
+    アップロードされたファイルの背景を除去し、元画像（JPEG）と結果（PNG）を保存してファイル名を返す
+    途中でディスクから読み直さず、メモリ上で JPEG → PNG まで処理する
+    """
+    rembg_session = get_session()
+    from rembg import remove  # get_session で読み込めることは確認済み
+    jpeg_data = to_jpeg_bytes(file.read())
+
+    # UUIDを使ってファイル名を生成
+    unique_filename = str(uuid.uuid4()) + '.jpg'
+    with open(os.path.join(UPLOAD_FOLDER, unique_filename), 'wb') as f:
+        f.write(jpeg_data)
+
+    # 背景除去の実行（バイト列を渡すと PNG のバイト列が返る）
+    result_data = remove(jpeg_data, session=rembg_session)
+
+    # 結果を保存
+    output_filename = str(uuid.uuid4()) + '.png'
+    with open(os.path.join(RESULT_FOLDER, output_filename), 'wb') as f:
+        f.write(result_data)
+
+    # 履歴を保存
+    save_history(unique_filename, output_filename)
+    return unique_filename, output_filename
+
 # ルート: 画像アップロードページ
 @ai_remove_background_bp.route("/", methods=['GET', 'POST'])
 def index():
@@ -68,36 +123,58 @@ def index():
             session["error_msg"] = "JPEGまたはHEIFファイルを指定して下さい"
             return jsonify({'error': session["error_msg"]}), 400  # 400 Bad Request
 
-        # UUIDを使ってファイル名を生成
-        unique_filename = str(uuid.uuid4()) + '.jpg'
-        file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-        
-        if is_heif:
-            save_heif_as_jpeg(temp_file, file_path)
-        else:
-            temp_file.save(file_path)
-
-        # 背景を除去する処理
-        output_filename = str(uuid.uuid4()) + '.png'
-        output_path = os.path.join(RESULT_FOLDER, output_filename)
-
-        # 背景除去の実行
-        with open(file_path, 'rb') as input_file:
-            input_data = input_file.read()
-            result_data = remove(input_data)
-
-        # 結果を保存
-            img = Image.open(BytesIO(result_data))
-            img.save(output_path)
-
-        # 履歴を保存
-        save_history(unique_filename, output_filename)
+        # 変換（HEIF→JPEG・大きすぎる画像の縮小）は別プロセスで行う
+        try:
+            unique_filename, output_filename = remove_background(temp_file)
+        except RembgUnavailable as e:
+            session["error_msg"] = str(e)
+            return jsonify({'error': session["error_msg"]}), 503
+        except ImageTooLarge as e:
+            session["error_msg"] = str(e)
+            return jsonify({'error': session["error_msg"]}), 400
+        except (OSError, ValueError) as e:
+            # 先頭は JPEG / HEIF でも中身が壊れている
+            session["error_msg"] = f"画像を読み込めませんでした: {e}"
+            return jsonify({'error': session["error_msg"]}), 400
 
         # 背景除去前の画像と後の画像をテンプレートに渡す
         return redirect(url_for('ai_remove_background.result', original_filename=unique_filename, result_filename=output_filename))
 
     return render_template('ai_remove_background/upload.html', form=form)  # formをテンプレートに渡す
 
+# ルート: 複数の画像をまとめて背景除去（同じモデルセッションで順に処理し、結果のURLをJSONで返す）
+@ai_remove_background_bp.route("/batch", methods=['POST'])
+def batch():
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({'error': '画像を指定して下さい'}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({'error': f'一度に処理できるのは{BATCH_MAX_FILES}枚までです'}), 400
+
+    results = []
+    for temp_file in files:
+        item = {'name': temp_file.filename}
+        is_jpeg, is_heif = is_jpegfile(temp_file)
+        if not (is_jpeg or is_heif):
+            item['error'] = "JPEGまたはHEIFファイルを指定して下さい"
+            results.append(item)
+            continue
+        try:
+            unique_filename, output_filename = remove_background(temp_file)
+        except RembgUnavailable as e:
+            return jsonify({'error': str(e)}), 503
+        except ImageTooLarge as e:
+            item['error'] = str(e)
+        except (OSError, ValueError) as e:
+            # 壊れた画像があっても他の画像は続けて処理する
+            item['error'] = f"画像を読み込めませんでした: {e}"
+        else:
+            item['original_url'] = url_for('ai_remove_background.static', filename='uploads/' + unique_filename)
+            item['result_url'] = url_for('ai_remove_background.static', filename='results/' + output_filename)
+            item['download_url'] = url_for('ai_remove_background.download', filename=output_filename)
+        results.append(item)
+    return jsonify({'results': results})
+
 # 管理者ログインページ
 @ai_remove_background_bp.route("/admin", methods=['GET', 'POST'])
 def admin():
@@ -116,13 +193,11 @@ def history():
     if not session.get('admin_logged_in'):
         return redirect(url_for('ai_remove_background.admin'))
 
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT id, timestamp, original_filename, result_filename FROM history ORDER BY timestamp DESC')
-    history_data = c.fetchall()
-    conn.close()
+    # 期間指定とページ移動は common.history_store
+    page = query_history('ai_remove_background', request.args)
+    history_data = [(row[0], row[1], row[3], row[4]) for row in page.rows]
 
-    return render_template('ai_remove_background/history.html', history=history_data)
+    return render_template('ai_remove_background/history.html', history=history_data, page=page, args=request.args)
 
 # 結果の表示ページ
 @ai_remove_background_bp.route("/result")
@@ -138,5 +213,4 @@ def result():
 # 背景除去後の画像をダウンロードするルート
 @ai_remove_background_bp.route("/download/<filename>")
 def download(filename):
-    file_path = os.path.join(RESULT_FOLDER, filename)
-    return send_file(file_path, as_attachment=True)
+    return send_media(RESULT_FOLDER, filename, as_attachment=True)
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import time
+
+import click
+from openai import OpenAI
+
+from common.db import register_database, get_connection
+from common.workers import WorkerPool
+from . import routes
+
+# 長いテキストの音声合成（split_sentences → synthesize_chunk → キャッシュ → chunked_audio）を測る
+#   TTS は --base-url の OpenAI 互換サーバーを使う（課金されないよう、本番の API ではなく
+#   tests/fake_tts.py などの偽のサーバーを指定する）。
+#   キャッシュと台帳のデータベースは一時フォルダに作った AudioCache を使い、本番のものには触れない
+
+
+def run_chunked(text, tts_client, cache, pool, voice='alloy'):
+    """
+    chunked_audio を最後まで読み、(秒, 最初の音声までの秒, バイト数) を返す
+    """
+    started = time.perf_counter()
+    first = None
+    size = 0
+    for data in routes.chunked_audio(text, voice, tts_client, cache, pool):
+        if first is None:
+            first = time.perf_counter() - started
+        size += len(data)
+    return time.perf_counter() - started, first or 0.0, size
+
+
+def api_calls(cache):
+    """
+    これまでに合成した文の数（キャッシュに無い文だけ API を呼ぶので、台帳の件数が API の呼び出し回数になる）
+    """
+    return get_connection(cache.database).execute("SELECT COUNT(*) FROM tts_cache").fetchone()[0]
+
+
+@click.command('tts-bench')
+@click.option('--base-url', required=True, help='TTS の OpenAI 互換サーバー（例: http://127.0.0.1:8765/v1）')
+@click.option('--chars', default=3000, help='テキストの文字数')
+@click.option('--sentence', default=40, help='1文の文字数')
+@click.option('--workers', default='1,2,4,8', help='比べる並列数（カンマ区切り）')
+def tts_bench_command(base_url, chars, sentence, workers):
+    """長いテキストの合成スループットを測る（文ごとの並列合成・キャッシュ・結合）"""
+    tts_client = OpenAI(base_url=base_url, api_key=os.environ.get('OPENAI_API_KEY', 'bench'), max_retries=0)
+    # 文ごとに内容を変える（同じ文は1回しか合成しないため）
+    count = max(1, chars // sentence)
+    text = ''.join(f"{i:05d}" + 'あ' * (sentence - 6) + '。' for i in range(count))
+    click.echo(f"{len(text)} 文字 / {len(routes.split_sentences(text))} 文")
+    worker_counts = [int(w) for w in workers.split(',')]
+    for worker_count in worker_counts:
+        # 並列数ごとに空のキャッシュから測る
+        folder = tempfile.mkdtemp(prefix='tts-bench-')
+        pool = WorkerPool(worker_count, 'tts-bench')
+        try:
+            database = os.path.join(folder, 'history.db')
+            register_database(database)
+            cache = routes.AudioCache(folder, database, routes.CACHE_MAX_BYTES)
+            cache.init_db()
+
+            elapsed, first, size = run_chunked(text, tts_client, cache, pool)
+            click.echo(f"並列 {worker_count}: {elapsed:.2f} 秒（最初の音声 {first:.2f} 秒, "
+                       f"{len(text) / elapsed:.0f} 文字/秒, {size / 1024 / 1024:.1f} MB, API {api_calls(cache)} 回）")
+            if worker_count == worker_counts[-1]:
+                # 1文だけ直したテキスト（変わった文だけ合成し直す）と、同じテキストの再合成（全部キャッシュ）
+                edited = text.replace('00000', '0000x', 1)
+                calls = api_calls(cache)
+                elapsed, first, size = run_chunked(edited, tts_client, cache, pool)
+                click.echo(f"  1文だけ変更: {elapsed:.2f} 秒（API {api_calls(cache) - calls} 回）")
+                calls = api_calls(cache)
+                elapsed, first, size = run_chunked(text, tts_client, cache, pool)
+                click.echo(f"  すべてキャッシュ: {elapsed:.2f} 秒（API {api_calls(cache) - calls} 回）")
+        finally:
+            pool.shutdown()
+            shutil.rmtree(folder, ignore_errors=True)
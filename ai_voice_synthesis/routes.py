@@ -1,9 +1,20 @@
-from flask import request, render_template, redirect, url_for, flash, jsonify
+from flask import request, render_template, redirect, url_for, flash, jsonify, abort, Response, stream_with_context, session
 import os
 import uuid
+import time
+import re
+import hashlib
 import sqlite3
+import unicodedata
+from contextlib import ExitStack
 from datetime import datetime
 import pytz
+from common.db import register_database, get_connection
+from common.history_store import record, register_legacy, query_history, cache_counts
+from common.janitor import register_folder
+from common.media import send_media
+from common.workers import WorkerPool
+from werkzeug.utils import safe_join
 from .forms import TextToSpeechForm
 import openai
 from openai import OpenAI, OpenAIError
@@ -17,10 +28,39 @@ from . import ai_voice_synthesis_bp  # Blueprintをインポート
 # 保存先ディレクトリの設定
 UPLOAD_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'static/audio')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+register_folder(UPLOAD_FOLDER, max_age=24 * 3600, max_bytes=500 * 1024 ** 2,
+                exclude=('cache',))  # 古い音声は common.janitor が消す（キャッシュは AudioCache で管理）
+
+# 合成済み音声のキャッシュ（正規化したテキスト・声・モデルのハッシュをファイル名にして cache/ に置く）
+TTS_MODEL = "tts-1"
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache')
+CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", str(1024 ** 3)))  # 合計サイズの上限
+
+# 合成中の音声をブラウザへ中継する単位（届いた分から再生が始まる）
+STREAM_CHUNK_SIZE = int(os.environ.get("TTS_STREAM_CHUNK_SIZE", "4096"))
+CACHE_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# 同じ音声を2つのリクエストが同時に合成しないよう、/stream は tts_pending の行を条件付き UPDATE で取ってから API を呼ぶ
+#   取れなかったリクエストは先のリクエストが書き終えるのを待ってキャッシュから返す（待ちきれなければ 409）
+#   取ったままプロセスが落ちた行は STREAM_CLAIM_TIMEOUT 秒たてば取り直せる
+STREAM_WAIT = int(os.environ.get("TTS_STREAM_WAIT", "60"))
+STREAM_WAIT_INTERVAL = 0.2
+STREAM_CLAIM_TIMEOUT = 600
+
+# 長いテキストは文（。！？）ごとに分けて並列に合成し、mp3 のフレームをそのままつなぐ
+#   文ごとにキャッシュするので、一部を直したテキストは変わった文だけ合成し直す
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", "4"))  # 同時に呼ぶ API の数
+CHUNK_MAX_CHARS = 500  # 1文がこれより長ければさらに分ける（API の上限は 4096 文字）
+SENTENCE_PATTERN = re.compile(r'[^。！？!?\n]*(?:[。！？!?]+|\n|$)')
+
+# 文ごとの合成に使うワーカープール
+executor = WorkerPool(TTS_WORKERS, 'tts')
 
 # データベースのパスを指定
 DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
 
+register_database(DATABASE)
+
 # 認証に使用するパスワード
 HISTORY_PASSWORD = os.environ.get("HISTORY_PASSWORD", "Canon-01")
 
@@ -29,29 +69,125 @@ jst = pytz.timezone('Asia/Tokyo')
 
 # データベースの初期化
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS history
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                  input_text TEXT,
-                  audio_file TEXT)''')
-    conn.commit()
-    conn.close()
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                      input_text TEXT,
+                      audio_file TEXT)''')
+        # 履歴にキャッシュのヒット(1)/ミス(0)を記録する列を追加
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+        if 'cache_hit' not in columns:
+            conn.execute("ALTER TABLE history ADD COLUMN cache_hit INTEGER")
+        # 受け付けたがまだ合成していないテキスト（/stream で合成する）
+        conn.execute('''CREATE TABLE IF NOT EXISTS tts_pending
+                     (cache_key TEXT PRIMARY KEY,
+                      input_text TEXT,
+                      voice TEXT,
+                      created_at REAL)''')
+        # 合成を始めた時刻（NULL ならまだ誰も合成していない）
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(tts_pending)")]
+        if 'claimed_at' not in columns:
+            conn.execute("ALTER TABLE tts_pending ADD COLUMN claimed_at REAL")
+
+
+class AudioCache:
+    """
+    合成済み音声のキャッシュ（upload_folder/cache/ のファイルと database の tts_cache 台帳）
+    例: cache = AudioCache(UPLOAD_FOLDER, DATABASE, CACHE_MAX_BYTES)
+        filename = cache.lookup(cache_key)
+    """
+    def __init__(self, upload_folder, database, max_bytes):
+        self.upload_folder = upload_folder
+        self.folder = os.path.join(upload_folder, 'cache')
+        self.database = database
+        self.max_bytes = max_bytes
+
+    def init_db(self):
+        os.makedirs(self.folder, exist_ok=True)
+        conn = get_connection(self.database)
+        with conn:
+            # filename は upload_folder からの相対パス
+            conn.execute('''CREATE TABLE IF NOT EXISTS tts_cache
+                         (cache_key TEXT PRIMARY KEY,
+                          filename TEXT,
+                          size INTEGER,
+                          created_at REAL,
+                          last_access REAL)''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_tts_cache_access ON tts_cache (last_access)")
+
+    def lookup(self, cache_key):
+        """
+        キャッシュにあればファイル名（upload_folderからの相対パス）を返し、最終利用時刻を更新する
+        """
+        conn = get_connection(self.database)
+        row = conn.execute("SELECT filename FROM tts_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        if not row:
+            return None
+        if not os.path.exists(os.path.join(self.upload_folder, row[0])):
+            with conn:
+                conn.execute("DELETE FROM tts_cache WHERE cache_key = ?", (cache_key,))
+            return None
+        with conn:
+            conn.execute("UPDATE tts_cache SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key))
+        return row[0]
+
+    def path(self, cache_key):
+        return os.path.join(self.folder, cache_key + '.mp3')
+
+    def store(self, cache_key):
+        """
+        path(cache_key) に書き終えた音声を台帳に登録し、上限を超えた分を最終利用の古い順に消す
+        """
+        filename = 'cache/' + cache_key + '.mp3'
+        now = time.time()
+        conn = get_connection(self.database)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO tts_cache (cache_key, filename, size, created_at, last_access) "
+                         "VALUES (?, ?, ?, ?, ?)", (cache_key, filename, os.path.getsize(self.path(cache_key)), now, now))
+        self.evict()
+        return filename
+
+    def evict(self):
+        conn = get_connection(self.database)
+        total = conn.execute("SELECT IFNULL(SUM(size), 0) FROM tts_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for cache_key, size in conn.execute("SELECT cache_key, size FROM tts_cache ORDER BY last_access ASC").fetchall():
+            with conn:
+                conn.execute("DELETE FROM tts_cache WHERE cache_key = ?", (cache_key,))
+            try:
+                os.unlink(self.path(cache_key))
+            except OSError as e:
+                print(f"キャッシュの削除に失敗しました: {e}")
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+# このアプリのキャッシュ（ベンチマークは一時フォルダに作った別の AudioCache を使う）
+audio_cache = AudioCache(UPLOAD_FOLDER, DATABASE, CACHE_MAX_BYTES)
+cache_lookup = audio_cache.lookup
+cache_path = audio_cache.path
+cache_store = audio_cache.store
 
 init_db()
+audio_cache.init_db()
 
-def save_history(input_text, audio_file):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+register_legacy('ai_voice_synthesis', DATABASE,
+                "SELECT id, timestamp, input_text, audio_file, NULL, cache_hit FROM history")
 
-    # 現在の日時をJSTで取得
-    current_time = datetime.now(jst)
-    c.execute("INSERT INTO history (timestamp, input_text, audio_file) VALUES (?, ?, ?)",
-              (current_time, input_text, audio_file))
-    
-    conn.commit()
-    conn.close()
+def save_history(input_text, audio_file, cache_hit=None):
+    record('ai_voice_synthesis', input_text=input_text, file=audio_file, cache_hit=cache_hit)
+
+def normalize_text(text):
+    """
+    キャッシュのキー用にテキストを正規化する（全角半角の統一・前後と連続する空白）
+    """
+    return " ".join(unicodedata.normalize('NFKC', text).split())
+
+def tts_cache_key(text, voice, model=TTS_MODEL):
+    return hashlib.sha256(f"{model}\n{voice}\n{normalize_text(text)}".encode('utf-8')).hexdigest()
 
 @ai_voice_synthesis_bp.route('/', methods=['GET', 'POST'])
 def index():
@@ -71,41 +207,243 @@ def index():
         else:
             voice_model = 'nova'
 
-        # UUIDを使ってファイル名を生成
-        unique_filename = str(uuid.uuid4()) + '.mp3'
-        file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-        #print(file_path)
-        try:
-            # OpenAIのAPIを使ってテキストを音声に変換
-            with client.audio.speech.with_streaming_response.create(
-                model="tts-1",
-                voice=voice_model,  # 選択された音声モデルを使用
-                input=text
-            ) as response:
-              response.stream_to_file(file_path)
-            # 履歴に保存
-            save_history(text, unique_filename)
-            
-            # リダイレクトを使ってGETリクエストで結果を表示
-            return redirect(url_for('ai_voice_synthesis.result', filename=unique_filename))
-        except OpenAIError as e:
-            flash(f"An error occurred while trying to fetch the audio stream: {e}", 'danger')       
-            return redirect(url_for('ai_voice_synthesis.index'))
-        except Exception as e:
-            flash(f'音声合成に失敗しました: {str(e)}', 'danger')
-            return redirect(url_for('ai_voice_synthesis.index'))
+        # 同じテキスト・声で合成済みならAPIを呼ばずにそのファイルを使う
+        cache_key = tts_cache_key(text, voice_model)
+        cached = cache_lookup(cache_key)
+        if cached:
+            save_history(text, cached, cache_hit=True)
+            return redirect(url_for('ai_voice_synthesis.result', filename=cached))
+
+        # 合成は結果ページの音声（/stream）で行い、届いた分からブラウザへ流す（履歴は書き終えた時に保存する）
+        add_pending(cache_key, text, voice_model)
+        filename = 'cache/' + cache_key + '.mp3'
+
+        # リダイレクトを使ってGETリクエストで結果を表示
+        return redirect(url_for('ai_voice_synthesis.result', filename=filename))
     
     return render_template('ai_voice_synthesis/upload.html', form=form)
 
-@ai_voice_synthesis_bp.route('/result/<filename>')
+def split_sentences(text, max_chars=CHUNK_MAX_CHARS):
+    """
+    テキストを文末（。！？）で分ける。空白だけの文は捨て、長すぎる文は max_chars ごとに切る
+    """
+    chunks = []
+    for sentence in SENTENCE_PATTERN.findall(text):
+        sentence = sentence.strip()
+        for i in range(0, len(sentence), max_chars):
+            chunks.append(sentence[i:i + max_chars])
+    return chunks
+
+def fetch_audio(tts_client, text, voice):
+    """
+    1回の API 呼び出しで音声（mp3）のバイト列を得る
+    """
+    with tts_client.audio.speech.with_streaming_response.create(
+        model=TTS_MODEL,
+        voice=voice,
+        input=text
+    ) as response:
+        return response.read()
+
+def synthesize_chunk(text, voice, tts_client, cache):
+    """
+    1文を合成して cache（AudioCache）に置き、そのパスを返す（キャッシュにあれば API を呼ばない）
+    """
+    cache_key = tts_cache_key(text, voice)
+    if not cache.lookup(cache_key):
+        data = fetch_audio(tts_client, text, voice)
+        temp_path = cache.path(cache_key) + '.' + uuid.uuid4().hex + '.part'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, cache.path(cache_key))
+        cache.store(cache_key)
+    return cache.path(cache_key)
+
+def strip_id3(data, first, last):
+    """
+    つなぐ mp3 の間に入るタグを取り除く（先頭の ID3v2 は最初のものだけ、末尾の ID3v1 は最後のものだけ残す）
+    """
+    if not first and data[:3] == b'ID3' and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        data = data[10 + size + footer:]
+    if not last and len(data) >= 128 and data[-128:-125] == b'TAG':
+        data = data[:-128]
+    return data
+
+def chunked_audio(text, voice, tts_client, cache, pool):
+    """
+    文ごとの合成を pool（WorkerPool）に並列に投げ、文の順に届いた分から mp3 のバイト列を返す
+    """
+    chunks = split_sentences(text)
+    submitted = {}  # 同じ文は1回だけ合成する
+    for chunk in chunks:
+        if chunk not in submitted:
+            submitted[chunk] = pool.submit(synthesize_chunk, chunk, voice, tts_client, cache)
+    futures = [submitted[chunk] for chunk in chunks]
+    try:
+        for i, future in enumerate(futures):
+            with open(future.result(), 'rb') as f:
+                yield strip_id3(f.read(), i == 0, i == len(futures) - 1)
+    finally:
+        for future in futures:
+            future.cancel()  # 途中で切れたらまだ始まっていない文は合成しない
+
+def add_pending(cache_key, text, voice):
+    conn = get_connection(DATABASE)
+    with conn:
+        # 合成中の行は claimed_at を残したまま受付時刻だけ更新する
+        conn.execute("INSERT INTO tts_pending (cache_key, input_text, voice, created_at) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (cache_key) DO UPDATE SET created_at = excluded.created_at",
+                     (cache_key, text, voice, time.time()))
+        # 再生されずに残ったものは1日で消す
+        conn.execute("DELETE FROM tts_pending WHERE created_at < ?", (time.time() - 24 * 3600,))
+
+def get_pending(cache_key):
+    row = get_connection(DATABASE).execute(
+        "SELECT input_text, voice FROM tts_pending WHERE cache_key = ?", (cache_key,)).fetchone()
+    return {'text': row[0], 'voice': row[1]} if row else None
+
+def remove_pending(cache_key):
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute("DELETE FROM tts_pending WHERE cache_key = ?", (cache_key,))
+
+def claim_pending(cache_key):
+    """
+    未合成の行を取る（取れたリクエストだけが API を呼ぶ）。取れたら True
+    """
+    now = time.time()
+    conn = get_connection(DATABASE)
+    with conn:
+        claimed = conn.execute("UPDATE tts_pending SET claimed_at = ? "
+                               "WHERE cache_key = ? AND (claimed_at IS NULL OR claimed_at < ?)",
+                               (now, cache_key, now - STREAM_CLAIM_TIMEOUT)).rowcount
+    return claimed == 1
+
+def release_pending(cache_key):
+    """
+    合成に失敗した行を戻す（次の再生でやり直せる）
+    """
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute("UPDATE tts_pending SET claimed_at = NULL WHERE cache_key = ?", (cache_key,))
+
+def wait_for_claim(cache_key):
+    """
+    未合成の行を取る。他のリクエストが合成中なら書き終えるまで待つ
+    戻り値: 'claimed'（自分で合成する）/ 'cached'（他のリクエストが書き終えた）/ None（待ちきれない・取り消された）
+    """
+    deadline = time.monotonic() + STREAM_WAIT
+    while True:
+        if claim_pending(cache_key):
+            return 'claimed'
+        if cache_lookup(cache_key):
+            return 'cached'
+        if time.monotonic() >= deadline or not get_pending(cache_key):
+            return None
+        time.sleep(STREAM_WAIT_INTERVAL)
+
+def tee_stream(chunks, cache_key, input_text, close=None):
+    """
+    音声のバイト列をチャンクごとにブラウザへ返しながらファイルにも書く
+    最後まで書けたらキャッシュに登録して履歴に保存する（途中で切れたら一時ファイルを消し、行を戻す）
+    close は最後に必ず呼ぶ（API のレスポンスを閉じる）
+    """
+    file_path = cache_path(cache_key)
+    temp_path = file_path + '.' + uuid.uuid4().hex + '.part'
+    completed = False
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(temp_path, file_path)
+        filename = cache_store(cache_key)
+        remove_pending(cache_key)
+        completed = True
+        save_history(input_text, filename, cache_hit=False)
+    except Exception as e:
+        # 受信中の切断は OpenAIError ではなく通信ライブラリの例外になる
+        print(f"音声の受信に失敗しました: {e}")
+    finally:
+        if close:
+            close()
+        if not completed:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            release_pending(cache_key)
+
+@ai_voice_synthesis_bp.route('/stream/<cache_key>')
+def stream(cache_key):
+    if not CACHE_KEY_PATTERN.match(cache_key):
+        abort(404)
+    # 合成済み（別のリクエストで書き終えた）ならファイルを返す
+    if cache_lookup(cache_key):
+        return send_media(CACHE_FOLDER, cache_key + '.mp3', mimetype='audio/mpeg')
+    pending = get_pending(cache_key)
+    if not pending:
+        abort(404)
+
+    # 同じ音声を別のリクエストが合成中なら、書き終えるのを待ってファイルを返す
+    claim = wait_for_claim(cache_key)
+    if claim == 'cached':
+        save_history(pending['text'], 'cache/' + cache_key + '.mp3', cache_hit=True)
+        return send_media(CACHE_FOLDER, cache_key + '.mp3', mimetype='audio/mpeg')
+    if claim is None:
+        return Response("音声を合成中です。しばらくしてから再生してください", status=409, mimetype='text/plain',
+                        headers={'Retry-After': str(STREAM_WAIT)})
+
+    # API のレスポンスは tee_stream の最後（送り終えた・切れた時）に閉じる
+    stack = ExitStack()
+    if len(split_sentences(pending['text'])) > 1:
+        # 複数の文は並列に合成し、先頭の文が届いたところから流す
+        source = chunked_audio(pending['text'], pending['voice'], client, audio_cache, executor)
+    else:
+        try:
+            # 最初のバイトが届く前のエラーはここで返す（ヘッダー送信後はブラウザに伝えられない）
+            response = stack.enter_context(client.audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=pending['voice'],  # 選択された音声モデルを使用
+                input=pending['text']
+            ))
+        except OpenAIError as e:
+            print(f"An error occurred while trying to fetch the audio stream: {e}")
+            release_pending(cache_key)
+            return Response(f"音声合成に失敗しました: {e}", status=502, mimetype='text/plain')
+        source = response.iter_bytes(STREAM_CHUNK_SIZE)
+
+    streamed = Response(stream_with_context(tee_stream(source, cache_key, pending['text'], stack.close)),
+                        mimetype='audio/mpeg', headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+    def close():
+        # 送り始める前に切られた時は tee_stream が動かないので、ここでも閉じて行を戻す（送り終えた後は何もしない）
+        stack.close()
+        release_pending(cache_key)
+
+    streamed.call_on_close(close)
+    return streamed
+
+@ai_voice_synthesis_bp.route('/result/<path:filename>')
 def result(filename):
-    return render_template('ai_voice_synthesis/result.html', audio_file=filename)
+    # まだ合成していない音声は /stream から再生する
+    stream_url = None
+    cache_key = os.path.splitext(os.path.basename(filename))[0]
+    if filename.startswith('cache/') and not os.path.exists(cache_path(cache_key)) \
+            and get_pending(cache_key):
+        stream_url = url_for('ai_voice_synthesis.stream', cache_key=cache_key)
+    return render_template('ai_voice_synthesis/result.html', audio_file=filename, stream_url=stream_url)
+
+@ai_voice_synthesis_bp.route('/media/<path:filename>')
+def media(filename):
+    # 再生用（Range対応なのでシークしても全体を送り直さない）
+    return send_media(UPLOAD_FOLDER, filename, mimetype='audio/mpeg')
 
-@ai_voice_synthesis_bp.route('/download/<filename>')
+@ai_voice_synthesis_bp.route('/download/<path:filename>')
 def download(filename):
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    if os.path.exists(file_path):
-        return jsonify({'download_url': url_for('static', filename='audio/' + filename)})
+    file_path = safe_join(UPLOAD_FOLDER, filename)
+    if file_path and os.path.exists(file_path):
+        return send_media(UPLOAD_FOLDER, filename, as_attachment=True, mimetype='audio/mpeg')
     else:
         flash('指定されたファイルが見つかりません', 'danger')
         return redirect(url_for('ai_voice_synthesis.index'))
@@ -115,13 +453,24 @@ def history():
     if request.method == 'POST':
         password = request.form.get('password')
         if password == HISTORY_PASSWORD:
-            conn = sqlite3.connect(DATABASE)
-            c = conn.cursor()
-            c.execute("SELECT id, datetime(timestamp, 'localtime'), input_text, audio_file FROM history ORDER BY timestamp DESC")
-            history_data = c.fetchall()
-            conn.close()
-            return render_template('ai_voice_synthesis/history.html', history=history_data)
+            session['ai_voice_synthesis_history'] = True
+            return redirect(url_for('ai_voice_synthesis.history'))
         else:
             flash("パスワードが正しくありません", "danger")
             return redirect(url_for('ai_voice_synthesis.history'))
-    return render_template('ai_voice_synthesis/password_prompt.html')
+    if not session.get('ai_voice_synthesis_history'):
+        return render_template('ai_voice_synthesis/password_prompt.html')
+
+    # 期間指定とページ移動は common.history_store
+    page = query_history('ai_voice_synthesis', request.args)
+    history_data = [(row[0], row[1], row[2], row[3], row[5]) for row in page.rows]
+    # キャッシュのヒット率
+    counts = cache_counts('ai_voice_synthesis')
+    cache_hits, cache_misses = counts.get(1, 0), counts.get(0, 0)
+    c = get_connection(DATABASE).cursor()
+    c.execute("SELECT COUNT(*), IFNULL(SUM(size), 0) FROM tts_cache")
+    cache_files, cache_bytes = c.fetchone()
+    cache_ratio = cache_hits * 100 / (cache_hits + cache_misses) if cache_hits + cache_misses else 0
+    return render_template('ai_voice_synthesis/history.html', history=history_data, page=page, args=request.args,
+                           cache_hits=cache_hits, cache_misses=cache_misses, cache_ratio=cache_ratio,
+                           cache_files=cache_files, cache_mb=cache_bytes / 1024 / 1024)
@@ -2,10 +2,16 @@ import os, platform
 from flask import Flask, render_template, url_for, request, flash, redirect
 from ai_image_analysis import ai_image_analysis_bp
 from ai_voice_synthesis import ai_voice_synthesis_bp
-# from ai_remove_background import ai_remove_background_bp
+from ai_remove_background import ai_remove_background_bp
 from youtube_to_mpeg import youtube_to_mpeg_bp
 from bakusai_db import bakusai_db_bp
 from kakei_db import kakei_db_bp
+from common.janitor import start_janitor, sweep_files_command
+from common.images import image_bench_command
+from ai_image_analysis.bench import inline_bench_command
+from ai_voice_synthesis.bench import tts_bench_command
+from bakusai_db.bench import bakusai_bench_command
+from common.history_store import migrate_history_command
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'Canon-01')  # 環境変数から読み込む
@@ -14,11 +20,29 @@ APP_PASSWORD = 'Canon-01'  # セキュリティ強化のため環境変数に保
 # Blueprintをアプリケーションに登録
 app.register_blueprint(ai_image_analysis_bp, url_prefix='/ai_image_analysis')
 app.register_blueprint(ai_voice_synthesis_bp, url_prefix='/ai_voice_synthesis')
-# app.register_blueprint(ai_remove_background_bp, url_prefix='/ai_remove_background')
+app.register_blueprint(ai_remove_background_bp, url_prefix='/ai_remove_background')
 app.register_blueprint(youtube_to_mpeg_bp, url_prefix='/youtube_to_mpeg')
 app.register_blueprint(bakusai_db_bp, url_prefix='/bakusai_db')
 app.register_blueprint(kakei_db_bp, url_prefix='/kakei_db')
 
+# 生成ファイルの掃除（バックグラウンドのスレッド、または flask sweep-files で手動実行）
+app.cli.add_command(sweep_files_command)
+
+# 画像変換のスループット計測（flask image-bench <ファイル...>）
+app.cli.add_command(image_bench_command)
+# OpenAI に送る画像の縮小・再圧縮の計測（flask inline-bench <ファイル...>）
+app.cli.add_command(inline_bench_command)
+# 長いテキストの音声合成のスループット計測（flask tts-bench）
+app.cli.add_command(tts_bench_command)
+# 詳細画面の前後15件の取得時間をスレッド内の位置ごとに計測（flask bakusai-bench）
+app.cli.add_command(bakusai_bench_command)
+# 各Blueprintの history.db の履歴を共通の履歴データベースに取り込む（flask migrate-history、1回だけ実行すればよい）
+app.cli.add_command(migrate_history_command)
+
+@app.before_request
+def ensure_janitor():
+    start_janitor()
+
 @app.route('/')
 def index():
     return render_template('index.html')
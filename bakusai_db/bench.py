@@ -0,0 +1,82 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import click
+
+from . import routes
+
+# 詳細画面の「前後15件」をスレッド内の位置ごとに測る（一時フォルダに作った投稿データで比べる）
+#   offset : 以前のクエリ（前にある投稿を数えて OFFSET で読み飛ばす。位置に比例して遅くなる）
+#   seek   : routes.surrounding_posts（索引で前後それぞれに読む）
+
+# 以前の detail() のクエリ（比較用）
+OFFSET_QUERY = """
+    SELECT * FROM data
+    WHERE tab_sheet = ?
+    ORDER BY date ASC, time ASC
+    LIMIT 31 OFFSET (
+        SELECT COUNT(*) FROM data
+        WHERE tab_sheet = ? AND (date < ? OR (date = ? AND time < ?))
+    ) - 15
+"""
+
+
+def build_thread_db(path, posts, sheets):
+    """
+    sheets 個のスレッドにそれぞれ posts 件の投稿がある data テーブルを作る（1分おき、id は通し番号）
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE data (tab_sheet TEXT, id INTEGER, date TEXT, time TEXT, text TEXT)")
+    start = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+    for sheet in range(sheets):
+        rows = []
+        for i in range(posts):
+            posted = time.localtime(start + i * 60)
+            rows.append((f"sheet{sheet:02d}", i + 1, time.strftime('%Y-%m-%d', posted),
+                         time.strftime('%H:%M', posted), f"投稿{i + 1}"))
+        conn.executemany("INSERT INTO data VALUES (?, ?, ?, ?, ?)", rows)
+    for sql in routes.BAKUSAI_INDEXES.values():
+        conn.execute(sql)
+    conn.commit()
+    return conn
+
+
+def measure(func, repeat):
+    """
+    func を repeat 回実行した1回あたりのミリ秒と、最後の結果を返す
+    """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) * 1000 / repeat, result
+
+
+@click.command('bakusai-bench')
+@click.option('--posts', default=100000, help='1スレッドの投稿数')
+@click.option('--sheets', default=3, help='スレッド数')
+@click.option('--repeat', default=20, help='1か所あたりの計測回数')
+def bakusai_bench_command(posts, sheets, repeat):
+    """詳細画面の前後15件の取得時間をスレッド内の位置ごとに測る（OFFSET と索引シークを比べる）"""
+    folder = tempfile.mkdtemp(prefix='bakusai-bench-')
+    try:
+        conn = build_thread_db(os.path.join(folder, 'bench.db'), posts, sheets)
+        cursor = conn.cursor()
+        click.echo(f"{sheets} スレッド × {posts} 件")
+        for position in sorted({1, 10, posts // 2, posts - 1, posts}):
+            cursor.execute("SELECT * FROM data WHERE tab_sheet = ? AND id = ?", ('sheet00', position))
+            detail = cursor.fetchone()
+
+            def offset():
+                cursor.execute(OFFSET_QUERY, ('sheet00', 'sheet00', detail[2], detail[2], detail[3]))
+                return cursor.fetchall()
+
+            offset_ms, offset_rows = measure(offset, repeat)
+            seek_ms, seek_rows = measure(lambda: routes.surrounding_posts(cursor, 'sheet00', detail), repeat)
+            click.echo(f"{position:>8} 件目: offset {offset_ms:8.2f} ms（{len(offset_rows)} 件） / "
+                       f"seek {seek_ms:6.3f} ms（{len(seek_rows)} 件）")
+        conn.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
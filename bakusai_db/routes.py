@@ -1,15 +1,22 @@
-from flask import request, render_template, redirect, url_for, flash, jsonify
+from flask import request, render_template, redirect, url_for, flash, jsonify, stream_template, session
 import os
 import uuid
 import sqlite3
+import threading
+import click
 import pytz
 from datetime import datetime
+from common.db import register_database, get_connection
+from common.history_store import record, register_legacy, query_history
+from common.janitor import register_folder
+from common.paging import KeysetPage, keyset_query, decode_cursor, page_size
 from .forms import BakusaiDbForm
 from . import bakusai_db_bp  # Blueprintをインポート
 
 # 保存先ディレクトリの設定
 UPLOAD_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'static/pdf')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+register_folder(UPLOAD_FOLDER, max_age=3600, max_bytes=500 * 1024 ** 2)  # 古いファイルは common.janitor が消す
 
 # データベースのパスを指定
 DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
@@ -17,6 +24,10 @@ DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
 # BAKUSAIデータベースのパスを指定
 BAKUSAI_DB = os.path.join(os.path.dirname(__file__), 'Bakusai_New_search.db')
 
+# 接続設定（検索用DBは読み取り専用で開く）
+register_database(DATABASE)
+register_database(BAKUSAI_DB, readonly=True, mmap_size=1024 * 1024 * 1024, cache_size=-64000)
+
 # 認証に使用するパスワード
 HISTORY_PASSWORD = os.environ.get("HISTORY_PASSWORD", "Canon-01")
 
@@ -25,76 +36,232 @@ jst = pytz.timezone('Asia/Tokyo')
 
 # データベースの初期化
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS history
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                  input_text TEXT) ''')
-    conn.commit()
-    conn.close()
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                      input_text TEXT) ''')
 
 init_db()
 
+register_legacy('bakusai_db', DATABASE,
+                "SELECT id, timestamp, input_text, NULL, NULL, NULL FROM history")
+
+# 本文の全文検索索引（FTS5 trigram：日本語でも3文字以上の部分一致を索引で引ける）
+# data を更新するとトリガーで同期される。作り直しは `flask bakusai_db rebuild-fts`
+FTS_TABLE = 'data_fts'
+FTS_TRIGGERS = ('data_fts_ai', 'data_fts_ad', 'data_fts_au')
+FTS_MIN_LENGTH = 3  # trigram で索引が効く最短の検索語
+
+# スレッド内を (date, time, id) 順に読む並び順キー（common.paging）
+#   date / time が NULL の投稿も飛ばさないよう '' に置き換えて比べ、索引も同じ式で張る
+POSTED_KEYS = [('date', 2, ''), ('time', 3, ''), ('id', 1)]
+
+BAKUSAI_INDEXES = {
+    # スレッド一覧の集計用（tab_sheet ごとの件数・最初と最後の投稿日時をこの索引だけで求める）
+    'idx_data_sheet_date_time_id':
+        'CREATE INDEX IF NOT EXISTS idx_data_sheet_date_time_id ON data (tab_sheet, date, time, id)',
+    # スレッド内をキーセットで読む・詳細画面の前後の投稿を読むための索引（POSTED_KEYS と同じ式）
+    'idx_data_sheet_posted':
+        "CREATE INDEX IF NOT EXISTS idx_data_sheet_posted "
+        "ON data (tab_sheet, COALESCE(date, ''), COALESCE(time, ''), id)",
+    # 詳細画面で tab_sheet と id から1件を引くための索引
+    'idx_data_sheet_id': 'CREATE INDEX IF NOT EXISTS idx_data_sheet_id ON data (tab_sheet, id)',
+}
+
+# 一覧・検索結果の1ページの件数（?size= で変更可）
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 5000
+
+# 詳細画面で前後に表示する件数
+SURROUNDING_COUNT = 15
+
+def migrate_bakusai_db(rebuild=False):
+    """
+    BAKUSAI_DB に索引・全文検索索引・トリガーを用意する（`flask bakusai_db rebuild-fts` から呼ぶ）
+    全文検索索引かトリガーが無い場合（初回・DBの差し替え後など）と rebuild=True の時は全件から作り直す。
+    失敗した時は sqlite3.Error を送出する。何か作った時は True を返す
+    """
+    indexes_ready = schema_has(tuple(BAKUSAI_INDEXES))
+    rebuild_fts = rebuild or not schema_has((FTS_TABLE,) + FTS_TRIGGERS)
+    if indexes_ready and not rebuild_fts:
+        return False
+
+    conn = sqlite3.connect(BAKUSAI_DB)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        for sql in BAKUSAI_INDEXES.values():
+            cursor.execute(sql)
+
+        if rebuild_fts:
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE}
+                USING fts5(text, content='data', tokenize='trigram')
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS data_fts_ai AFTER INSERT ON data
+                BEGIN
+                    INSERT INTO {FTS_TABLE} (rowid, text) VALUES (new.rowid, new.text);
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS data_fts_ad AFTER DELETE ON data
+                BEGIN
+                    INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, text) VALUES ('delete', old.rowid, old.text);
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS data_fts_au AFTER UPDATE OF text ON data
+                BEGIN
+                    INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, text) VALUES ('delete', old.rowid, old.text);
+                    INSERT INTO {FTS_TABLE} (rowid, text) VALUES (new.rowid, new.text);
+                END
+            """)
+            # 全件から作り直す（トリガーが無かった間の変更もここで吸収する）
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return True
+
+def bakusai_db_mtimes():
+    """
+    BAKUSAI_DB の更新時刻（WALモードで更新された場合は本体より先に -wal ファイルの時刻が変わる）
+    """
+    return tuple(os.path.getmtime(p) for p in (BAKUSAI_DB, BAKUSAI_DB + '-wal') if os.path.exists(p))
+
+# 全文検索索引が使えるか（BAKUSAI_DB のファイル更新時刻が変わった時だけ確かめ直す）
+_fts_cache = {}
+_fts_lock = threading.Lock()
+
+def fts_ready():
+    """
+    全文検索索引とトリガーが揃っているか。揃っていなければ検索は LIKE で行う
+    """
+    key = (BAKUSAI_DB, bakusai_db_mtimes())
+    with _fts_lock:
+        if _fts_cache.get('key') != key:
+            ready = schema_has((FTS_TABLE,) + FTS_TRIGGERS)
+            if not ready and os.path.exists(BAKUSAI_DB):
+                print("全文検索索引が無いため、LIKE で検索します（flask bakusai_db rebuild-fts で作成できます）")
+            _fts_cache.update(key=key, ready=ready)
+        return _fts_cache['ready']
+
+def schema_has(names):
+    """
+    BAKUSAI_DB に指定した名前のテーブル・索引・トリガーがすべてあるか
+    """
+    try:
+        cursor = get_connection(BAKUSAI_DB).execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name IN (%s)" % ",".join(["?"] * len(names)),
+            names)
+        return cursor.fetchone()[0] == len(names)
+    except sqlite3.Error:
+        return False
+
+# 起動時は確認だけ行う（索引の作成は重いので CLI から行う）
+fts_ready()
+
+@bakusai_db_bp.cli.command('rebuild-fts')
+def rebuild_fts_command():
+    """BAKUSAI_DB の索引と全文検索索引を作り直す（BAKUSAI_DB を差し替えた後にも実行する）"""
+    if not os.path.exists(BAKUSAI_DB):
+        click.echo(f"{BAKUSAI_DB} がありません。")
+        return
+    try:
+        migrate_bakusai_db(rebuild=True)
+    except sqlite3.Error as e:
+        click.echo(f"全文検索索引の作成に失敗しました: {e}")
+        return
+    click.echo("全文検索索引を作り直しました。")
+
+# tab_sheet 一覧と統計のキャッシュ（BAKUSAI_DB のファイル更新時刻が変わったら作り直す）
+_catalog_cache = {}
+_catalog_lock = threading.Lock()
+
 def list_tab_sheets():
     """
-    BAKUSAI_DBの全tab_sheet名とデータベースの更新日時を取得
+    BAKUSAI_DBの全tab_sheetの統計（件数・最初の投稿日・最後の投稿日時）とデータベースの更新日時を取得
+    tab_sheets は dict(name, count, first_date, last_posted) のリスト
     """
-    tab_sheets = []
-    updated_at = "不明"
+    if not os.path.exists(BAKUSAI_DB):
+        return [], "不明"
 
-    query = "SELECT DISTINCT tab_sheet FROM data ORDER BY tab_sheet ASC"
+    mtimes = bakusai_db_mtimes()
+    with _catalog_lock:
+        if _catalog_cache.get('mtimes') == mtimes:
+            return _catalog_cache['tab_sheets'], _catalog_cache['updated_at']
+
+    # (tab_sheet, date, time, id) 索引を1回なめるだけで集計する
+    query = """
+        SELECT tab_sheet, COUNT(*), MIN(date), MAX(date || ' ' || time)
+        FROM data
+        GROUP BY tab_sheet
+        ORDER BY tab_sheet ASC
+    """
 
     try:
-        conn = sqlite3.connect(BAKUSAI_DB)
-        cursor = conn.cursor()
-        
+        cursor = get_connection(BAKUSAI_DB).cursor()
+
         # tab_sheet一覧の取得
         cursor.execute(query)
-        tab_sheets = [row[0] for row in cursor.fetchall()]
-
-        # データベースの最終更新日時を取得（ファイルのメタ情報から取得）
-        if os.path.exists(BAKUSAI_DB):
-            updated_at = datetime.fromtimestamp(os.path.getmtime(BAKUSAI_DB)).strftime("%Y-%m-%d %H:%M:%S")
-
+        tab_sheets = [
+            {'name': name, 'count': count, 'first_date': first_date, 'last_posted': last_posted}
+            for name, count, first_date, last_posted in cursor.fetchall()
+        ]
     except sqlite3.Error as e:
         print(f"データベースエラー: {e}")
-    finally:
-        conn.close()
+        return [], "不明"
+
+    # データベースの最終更新日時を取得（ファイルのメタ情報から取得）
+    updated_at = datetime.fromtimestamp(max(mtimes)).strftime("%Y-%m-%d %H:%M:%S")
 
+    with _catalog_lock:
+        _catalog_cache.update(mtimes=mtimes, tab_sheets=tab_sheets, updated_at=updated_at)
     return tab_sheets, updated_at
 
 @bakusai_db_bp.route('/tab/<db_name>')
 def tab_detail(db_name):
     """
-    特定の tab_sheet（＝地域・スレッド）内の全データを一覧表示
+    特定の tab_sheet（＝地域・スレッド）内のデータを (date, time, id) 順にページ単位で一覧表示
+      ?size=件数  ?after=/?before=カーソル  ?stream=1 で読みながら送信
+    """
+    size = page_size(request.args.get('size'), PAGE_SIZE, MAX_PAGE_SIZE)
+    stream = request.args.get('stream') == '1'
+    query = """
+        SELECT * FROM data
+        WHERE tab_sheet = ? {keyset}
+        ORDER BY {order}
     """
     try:
-        conn = sqlite3.connect(BAKUSAI_DB)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM data
-            WHERE tab_sheet = ?
-            ORDER BY date ASC, time ASC
-        """, (db_name,))
-        records = cursor.fetchall()
+        cursor = get_connection(BAKUSAI_DB).cursor()
+        page = keyset_query(
+            cursor, query, (db_name,), POSTED_KEYS, size,
+            after=decode_cursor(request.args.get('after')),
+            before=decode_cursor(request.args.get('before')),
+            stream=stream)
     except sqlite3.Error as e:
         flash(f"データベースエラー: {e}", 'danger')
-        records = []
-    finally:
-        conn.close()
-    
-    if not records:
+        page = KeysetPage.empty()
+
+    context = dict(page=page, db_name=db_name, size=size, stream=stream)
+    if stream:
+        # 行を読みながらHTMLを送る（stream_template は stream_with_context でリクエストを保持したまま生成する）
+        return stream_template('bakusai_db/tab_detail.html', **context)
+
+    if not page.rows:
         flash("該当するデータが見つかりませんでした。", "warning")
-    
-    return render_template('bakusai_db/tab_detail.html', records=records, db_name=db_name)
+
+    return render_template('bakusai_db/tab_detail.html', **context)
 
 
 @bakusai_db_bp.route('/', methods=['GET', 'POST'])
 def index():
-    # PDFォルダを空にする #
-    clear_upload_folder()
-    
     form = BakusaiDbForm()
     if form.validate_on_submit():
         search_text = form.text.data.strip()  # 入力された検索語を取得し、前後の空白を削除
@@ -111,17 +278,19 @@ def index():
                 raise ValueError("検索語はスペースで区切られた2つの単語である必要があります。")
             db_name = parts[0]  # 最初の単語をdb_nameに代入
             person = parts[1]  # 2つ目の単語をpersonに代入
+            # 並び順（date: 日付順 / rank: 関連度順）
+            order = request.form.get('order', 'date')
 
-            # データベース検索
-            results = search_bakusai_db(db_name, person)
-            if not results:
+            # データベース検索（1ページ目）
+            page = search_bakusai_db(db_name, person, order=order)
+            if not page.rows:
                 flash("該当するデータが見つかりませんでした。", 'warning')
                 return redirect(url_for('bakusai_db.index'))
-            
-            # 結果を一時ファイルやテンプレートに渡して表示する
+
+            # 結果を一時ファイルやテンプレートに渡して表示する（2ページ目以降は search で表示）
             save_history(search_text)
-            # リダイレクトを使ってGETリクエストで結果を表示
-            return render_template('bakusai_db/result.html', results=results, db_name=db_name, person=person)
+            return render_template('bakusai_db/result.html', page=page, db_name=db_name, person=person,
+                                   order=order, size=PAGE_SIZE, stream=False)
 
         except Exception as e:
             flash(str(e), 'danger')
@@ -134,6 +303,33 @@ def index():
                 flash(f"{field}: {error}", 'danger')
     return render_template('bakusai_db/upload.html', form=form)
 
+def surrounding_posts(cursor, db_name, detail):
+    """
+    detail の前後 SURROUNDING_COUNT 件（detail を含む）を (date, time, id) 順に返す（NULL の日時は '' として並べる）
+    idx_data_sheet_posted 索引で前後それぞれに読むだけなので、スレッド内の位置には関係しない
+    （式の索引では行値の比較が範囲にならず、日付だけで範囲を絞るので、同じ日付の投稿はなめる）
+    """
+    date_key, time_key = detail[2] or '', detail[3] or ''
+    key = (db_name, date_key, date_key, time_key, detail[1])
+    query_before = f"""
+        SELECT * FROM data
+        WHERE tab_sheet = ? AND COALESCE(date, '') <= ?
+          AND (COALESCE(date, ''), COALESCE(time, ''), id) < (?, ?, ?)
+        ORDER BY COALESCE(date, '') DESC, COALESCE(time, '') DESC, id DESC
+        LIMIT {SURROUNDING_COUNT}
+    """
+    query_after = f"""
+        SELECT * FROM data
+        WHERE tab_sheet = ? AND COALESCE(date, '') >= ?
+          AND (COALESCE(date, ''), COALESCE(time, ''), id) >= (?, ?, ?)
+        ORDER BY COALESCE(date, '') ASC, COALESCE(time, '') ASC, id ASC
+        LIMIT {SURROUNDING_COUNT + 1}
+    """
+    cursor.execute(query_before, key)
+    records = cursor.fetchall()[::-1]
+    cursor.execute(query_after, key)
+    return records + cursor.fetchall()
+
 @bakusai_db_bp.route('/detail/<db_name>/<id>', methods=['GET'])
 def detail(db_name, id):
     """
@@ -143,8 +339,7 @@ def detail(db_name, id):
     surrounding_records = []
     try:
         # データベースに接続
-        conn = sqlite3.connect(BAKUSAI_DB)
-        cursor = conn.cursor()
+        cursor = get_connection(BAKUSAI_DB).cursor()
 
         # 指定されたIDの詳細情報を取得
         query_detail = """
@@ -155,28 +350,12 @@ def detail(db_name, id):
         detail = cursor.fetchone()
 
         if detail:
-            # 前後15件を取得
-            query_surrounding = """
-                SELECT * FROM data
-                WHERE tab_sheet = ?
-                ORDER BY date ASC, time ASC
-                LIMIT 31 OFFSET (
-                    SELECT COUNT(*) FROM data
-                    WHERE tab_sheet = ? AND (date < ? OR (date = ? AND time < ?))
-                ) - 15
-            """
-            cursor.execute(query_surrounding, (
-                db_name, db_name, detail[2], detail[2], detail[3]
-            ))
-            surrounding_records = cursor.fetchall()
+            surrounding_records = surrounding_posts(cursor, db_name, detail)
 
     except sqlite3.Error as e:
         print(f"データベースエラー: {e}")
         detail = None
 
-    finally:
-        conn.close()
-
     if not detail:
         return render_template('bakusai_db/no_result.html', db_name=db_name, id=id)
 
@@ -187,71 +366,91 @@ def detail(db_name, id):
     )
 
 
-def search_bakusai_db(db_name, person):
+@bakusai_db_bp.route('/search')
+def search():
     """
-    BAKUSAI_DBを検索し、条件に一致する結果を返す
+    検索結果の2ページ目以降（?db_name=&person=&order=&size=&after=/before=、?stream=1 で読みながら送信）
     """
-    results = []
-    query = """
-        SELECT * FROM data
-        WHERE tab_sheet LIKE ? AND text LIKE ?
-        ORDER BY date ASC, time ASC
+    db_name = request.args.get('db_name', '')
+    person = request.args.get('person', '')
+    order = request.args.get('order', 'date')
+    size = page_size(request.args.get('size'), PAGE_SIZE, MAX_PAGE_SIZE)
+    stream = request.args.get('stream') == '1'
+    if not (db_name and person):
+        return redirect(url_for('bakusai_db.index'))
+
+    page = search_bakusai_db(
+        db_name, person, order=order, size=size,
+        after=decode_cursor(request.args.get('after')),
+        before=decode_cursor(request.args.get('before')),
+        stream=stream)
+
+    context = dict(page=page, db_name=db_name, person=person, order=order, size=size, stream=stream)
+    if stream:
+        return stream_template('bakusai_db/result.html', **context)
+    return render_template('bakusai_db/result.html', **context)
+
+
+def search_bakusai_db(db_name, person, order='date', size=PAGE_SIZE, after=None, before=None, stream=False):
+    """
+    BAKUSAI_DBを検索し、条件に一致する結果を1ページ分（KeysetPage）で返す
+    3文字以上の検索語は全文検索索引から引き、order='rank' ならBM25の関連度順に並べる。
+    それより短い検索語（trigramでは索引が効かない）は従来どおり LIKE で検索する。
+    """
+    if len(person) >= FTS_MIN_LENGTH and fts_ready():
+        inner = f"""
+            SELECT d.*, bm25({FTS_TABLE}) AS score FROM {FTS_TABLE}
+            JOIN data AS d ON d.rowid = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH ? AND d.tab_sheet LIKE ?
+        """
+        # 検索語はフレーズとして渡す（FTS5の演算子として解釈させない）
+        params = ('"' + person.replace('"', '""') + '"', f"%{db_name}%")
+    else:
+        inner = """
+            SELECT *, 0 AS score FROM data
+            WHERE tab_sheet LIKE ? AND text LIKE ?
+        """
+        params = (f"%{db_name}%", f"%{person}%")
+
+    # 並び順キー（末尾の tab_sheet, id で一意にする）。score は行の末尾の列
+    if order == 'rank':
+        keys = [('score', -1), ('tab_sheet', 0), ('id', 1)]
+    else:
+        keys = POSTED_KEYS[:2] + [('tab_sheet', 0), ('id', 1)]
+    query = f"""
+        SELECT * FROM ({inner})
+        WHERE 1=1 {{keyset}}
+        ORDER BY {{order}}
     """
 
     try:
         # データベースに接続
-        conn = sqlite3.connect(BAKUSAI_DB)
-        cursor = conn.cursor()
+        cursor = get_connection(BAKUSAI_DB).cursor()
 
         # クエリ実行
-        cursor.execute(query, (f"%{db_name}%", f"%{person}%"))
-        results = cursor.fetchall()
+        return keyset_query(cursor, query, params, keys, size, after=after, before=before, stream=stream)
 
     except sqlite3.Error as e:
         print(f"データベースエラー: {e}")
 
-    finally:
-        conn.close()
-    
-    return results
-
-def clear_upload_folder():
-    for filename in os.listdir(UPLOAD_FOLDER):
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)  # ファイルを削除
-            elif os.path.isdir(file_path):
-                os.rmdir(file_path)  # サブフォルダを削除（必要なら再帰処理を追加）
-        except Exception as e:
-            flash(e, 'danger')
-            return redirect(url_for('bakusai_db.index'))
+    return KeysetPage.empty()
 
 def save_history(input_text):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-
-    # 現在の日時をJSTで取得
-    current_time = datetime.now(jst)
-    c.execute("INSERT INTO history (timestamp, input_text) VALUES (?, ?)",
-              (current_time, input_text))
-    
-    conn.commit()
-    conn.close()
+    record('bakusai_db', input_text=input_text)
 
 @bakusai_db_bp.route("/history", methods=['GET', 'POST'])
 def history():
     if request.method == 'POST':
         password = request.form.get('password')
         if password == HISTORY_PASSWORD:
-            conn = sqlite3.connect(DATABASE)
-            c = conn.cursor()
-            c.execute("SELECT id, datetime(timestamp, 'localtime'), input_text FROM history ORDER BY timestamp DESC")
-            history_data = c.fetchall()
-            conn.close()
-            return render_template('bakusai_db/history.html', history=history_data)
+            session['bakusai_db_history'] = True
+            return redirect(url_for('bakusai_db.history'))
         else:
             flash("パスワードが正しくありません", "danger")
             return redirect(url_for('bakusai_db.history'))
+    if not session.get('bakusai_db_history'):
+        return render_template('bakusai_db/password_prompt.html')
 
-    return render_template('bakusai_db/password_prompt.html')
+    # 期間指定とページ移動は common.history_store（行は id, 日時, input_text, ...）
+    page = query_history('bakusai_db', request.args)
+    return render_template('bakusai_db/history.html', history=page.rows, page=page, args=request.args)
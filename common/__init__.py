@@ -0,0 +1 @@
+# Blueprint 間で共有する部品
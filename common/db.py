@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+# データベースごとの既定設定
+#   readonly   : 読み取り専用URI（file:...?mode=ro）で開く
+#   wal        : 書き込み用の接続で journal_mode=WAL にする
+#   cache_size : ページキャッシュ（負数はKiB単位）
+#   mmap_size  : メモリマップするサイズ（バイト）
+DEFAULT_SETTINGS = {
+    'readonly': False,
+    'wal': True,
+    'cache_size': -8000,
+    'mmap_size': 64 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+
+# 接続ごとにキャッシュするプリペアドステートメント数（sqlite3 側でSQL文字列をキーに再利用）
+CACHED_STATEMENTS = 256
+
+_settings = {}
+_settings_lock = threading.Lock()
+_local = threading.local()
+
+
+def register_database(path, **settings):
+    """
+    データベースごとの設定を登録する（各Blueprintのimport時に呼ぶ）
+    例: register_database(KAKEI_DB, readonly=True, mmap_size=256 * 1024 * 1024)
+    """
+    key = os.path.abspath(path)
+    with _settings_lock:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update(_settings.get(key, {}))
+        merged.update(settings)
+        _settings[key] = merged
+
+
+def get_connection(path):
+    """
+    スレッドごとに使い回す接続を返す。
+    呼び出し側で close() しないこと（書き込みは `with conn:` でコミット／ロールバックする）。
+    """
+    key = os.path.abspath(path)
+    connections = _thread_connections()
+    conn = connections.get(key)
+    if conn is None:
+        conn = _connect(key, _settings.get(key, DEFAULT_SETTINGS))
+        connections[key] = conn
+    return conn
+
+
+def close_connections():
+    """
+    現在のスレッドが持っている接続をすべて閉じる
+    """
+    connections = getattr(_local, 'connections', None) or {}
+    for conn in connections.values():
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.connections = {}
+
+
+def _thread_connections():
+    # gunicorn の fork 後に親プロセスの接続を引き継がないよう、PIDが変わったら作り直す
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+
+def _connect(path, settings):
+    if settings['readonly']:
+        uri = Path(path).as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+    else:
+        conn = sqlite3.connect(path, cached_statements=CACHED_STATEMENTS)
+        if settings['wal']:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+    conn.execute(f"PRAGMA busy_timeout={int(settings['busy_timeout'])}")
+    conn.execute(f"PRAGMA cache_size={int(settings['cache_size'])}")
+    conn.execute(f"PRAGMA mmap_size={int(settings['mmap_size'])}")
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
@@ -0,0 +1,203 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import click
+import pytz
+
+from common.db import register_database, get_connection
+from common.history_writer import enqueue, flush
+from common.paging import KeysetPage, keyset_query, decode_cursor, page_size
+
+# 全Blueprintの履歴を1つのデータベースにまとめる
+#   blueprint   : どのアプリの履歴か（(blueprint, timestamp, id) の索引で1アプリ分を新しい順に引く）
+#   timestamp   : UTC の 'YYYY-MM-DD HH:MM:SS'（文字列の大小がそのまま時刻の前後になる形に揃える）
+#   input_text / file / result / cache_hit : 各アプリで共通に使う列
+#   detail      : アプリごとの項目（JSON）
+#   source_id   : flask migrate-history で取り込んだ元の history.db の id（二重に取り込まない）
+# 各Blueprintは save_history から record() で1件ずつ追加する（書き込みは common.history_writer がまとめて行う）。
+# 以前の各Blueprintの history.db は import 時に register_legacy() で登録しておき、flask migrate-history で取り込む
+HISTORY_DB = os.environ.get(
+    "HISTORY_DB",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'history.db'))
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MIGRATE_BATCH = 1000
+
+jst = pytz.timezone('Asia/Tokyo')
+
+register_database(HISTORY_DB)
+
+_legacy = {}
+_legacy_lock = threading.Lock()
+
+
+def init_db():
+    conn = get_connection(HISTORY_DB)
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      blueprint TEXT NOT NULL,
+                      timestamp TEXT NOT NULL,
+                      input_text TEXT,
+                      file TEXT,
+                      result TEXT,
+                      cache_hit INTEGER,
+                      detail TEXT,
+                      source_id INTEGER)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_blueprint_time ON history (blueprint, timestamp, id)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_history_source ON history (blueprint, source_id) "
+                     "WHERE source_id IS NOT NULL")
+
+init_db()
+
+
+def utc_timestamp(value=None):
+    """
+    日時を保存用の UTC 文字列にする。タイムゾーンの無い値は UTC（SQLite の CURRENT_TIMESTAMP）とみなす
+    """
+    if value is None:
+        value = datetime.now(pytz.utc)
+    elif isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value.astimezone(pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def record(blueprint, input_text=None, file=None, result=None, cache_hit=None, **detail):
+    """
+    履歴を1件追加する（書き込みは common.history_writer がまとめて行う）
+    """
+    detail = {name: value for name, value in detail.items() if value is not None}
+    enqueue(HISTORY_DB, "INSERT INTO history (blueprint, timestamp, input_text, file, result, cache_hit, detail) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (blueprint, utc_timestamp(), input_text, file, result,
+             None if cache_hit is None else int(cache_hit),
+             json.dumps(detail, ensure_ascii=False) if detail else None))
+
+
+def date_range(date_from, date_to):
+    """
+    画面で指定された日付（日本時間、to は当日を含む）を UTC の [開始, 終了) にする。不正な値は無視する
+    """
+    bounds = []
+    for value, offset in ((date_from, 0), (date_to, 1)):
+        try:
+            day = jst.localize(datetime.strptime(value, '%Y-%m-%d')) + timedelta(days=offset)
+        except (TypeError, ValueError):
+            bounds.append(None)
+            continue
+        bounds.append(utc_timestamp(day))
+    return bounds
+
+
+def query_history(blueprint, args):
+    """
+    1アプリ分の履歴を新しい順に1ページ分（KeysetPage）返す
+      args: ?size=件数 ?after=/?before=カーソル ?from=/?to=日付（YYYY-MM-DD）
+    行は (id, 表示用の日時（日本時間）, input_text, file, result, cache_hit, detail(dict), timestamp)
+    """
+    flush()  # まだ書き込んでいない履歴も表示する
+    size = page_size(args.get('size'), PAGE_SIZE, MAX_PAGE_SIZE)
+    start, end = date_range(args.get('from'), args.get('to'))
+    conditions = ""
+    params = [blueprint]
+    if start:
+        conditions += " AND timestamp >= ?"
+        params.append(start)
+    if end:
+        conditions += " AND timestamp < ?"
+        params.append(end)
+
+    # 表示する日時は期間指定と同じ日本時間にする（'localtime' はサーバーのタイムゾーンになるので使わない）
+    query = f"""
+        SELECT id, datetime(timestamp, '+9 hours'), input_text, file, result, cache_hit, detail, timestamp
+        FROM history
+        WHERE blueprint = ?{conditions} {{keyset}}
+        ORDER BY {{order}}
+    """
+    try:
+        page = keyset_query(
+            get_connection(HISTORY_DB).cursor(), query, params, [('timestamp', 7), ('id', 0)], size,
+            after=decode_cursor(args.get('after')),
+            before=decode_cursor(args.get('before')),
+            descending=True)
+    except sqlite3.Error as e:
+        print(f"履歴の読み込みに失敗しました: {e}")
+        return KeysetPage.empty()
+    page.rows = [row[:6] + (json.loads(row[6]) if row[6] else {},) + row[7:] for row in page.rows]
+    return page
+
+
+def cache_counts(blueprint):
+    """
+    cache_hit の値ごとの件数 {値: 件数}
+    """
+    rows = get_connection(HISTORY_DB).execute(
+        "SELECT cache_hit, COUNT(*) FROM history WHERE blueprint = ? AND cache_hit IS NOT NULL GROUP BY cache_hit",
+        (blueprint,)).fetchall()
+    return dict(rows)
+
+
+def register_legacy(blueprint, database, query, detail=(), json_detail=()):
+    """
+    取り込み元（各Blueprintの旧 history.db）を登録する
+      query       : id, timestamp, input_text, file, result, cache_hit に続けて detail の列を返す SELECT
+      json_detail : detail のうち JSON 文字列で保存されている列
+    """
+    with _legacy_lock:
+        _legacy[blueprint] = {'database': database, 'query': query,
+                              'detail': tuple(detail), 'json_detail': set(json_detail)}
+
+
+def migrate_legacy(blueprint, database, query, detail=(), json_detail=()):
+    """
+    旧 history.db の履歴をまとめて取り込み、(読んだ件数, 追加した件数) を返す（何度実行しても二重にならない）
+    """
+    if not os.path.exists(database):
+        return 0, 0
+    source = sqlite3.connect(database)
+    conn = get_connection(HISTORY_DB)
+    read = added = 0
+    try:
+        cursor = source.execute(query)
+        while True:
+            rows = cursor.fetchmany(MIGRATE_BATCH)
+            if not rows:
+                break
+            batch = []
+            for row in rows:
+                values = dict(zip(detail, row[6:]))
+                for name in json_detail:
+                    if values.get(name):
+                        values[name] = json.loads(values[name])
+                values = {name: value for name, value in values.items() if value is not None}
+                batch.append((blueprint, utc_timestamp(row[1]) if row[1] else utc_timestamp(),
+                              row[2], row[3], row[4], row[5],
+                              json.dumps(values, ensure_ascii=False) if values else None, row[0]))
+            with conn:
+                before = conn.total_changes
+                conn.executemany("INSERT OR IGNORE INTO history (blueprint, timestamp, input_text, file, result, "
+                                 "cache_hit, detail, source_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                added += conn.total_changes - before
+            read += len(rows)
+    finally:
+        source.close()
+    return read, added
+
+
+@click.command('migrate-history')
+def migrate_history_command():
+    """各Blueprintの history.db の履歴を共通の履歴データベースに取り込む"""
+    with _legacy_lock:
+        sources = dict(_legacy)
+    for blueprint, source in sources.items():
+        try:
+            read, added = migrate_legacy(blueprint, **source)
+        except (sqlite3.Error, ValueError) as e:
+            click.echo(f"{blueprint}: 取り込みに失敗しました: {e}")
+            continue
+        click.echo(f"{blueprint}: {read} 件読み込み、{added} 件追加")
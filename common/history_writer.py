@@ -0,0 +1,158 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+
+from common.db import get_connection
+
+# 履歴の書き込みをリクエストの外でまとめて行う（write-behind）
+#   save_history は enqueue() でメモリのキューに積むだけにし、
+#   バックグラウンドのスレッドが FLUSH_INTERVAL ごと、または BATCH_SIZE 件たまった時点で
+#   データベースごとに1トランザクションで INSERT する（コミット＝fsync の回数が減る）。
+#   書き込みに失敗した分は SPOOL_FILE に追記しておき、次に書き込む時に入れ直す。
+#   HISTORY_WRITE_BEHIND=0 ならその場で書き込む（以前と同じ動作）
+ENABLED = os.environ.get("HISTORY_WRITE_BEHIND", "1") != "0"
+FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "1.0"))
+BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", "100"))
+SPOOL_FILE = os.environ.get(
+    "HISTORY_SPOOL_FILE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'history_spool.jsonl'))
+
+_queue = []
+_queue_pid = None
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wakeup = threading.Event()
+_thread = None
+
+
+def enqueue(database, sql, params):
+    """
+    履歴1件（INSERT文とパラメータ）をキューに積む
+    params は JSON にできる値か datetime（文字列にして保存する）
+    """
+    record = (os.path.abspath(database), sql, tuple(_plain(value) for value in params))
+    if not ENABLED:
+        conn = get_connection(record[0])
+        with conn:
+            conn.execute(record[1], record[2])
+        return
+    with _lock:
+        _ensure_thread()
+        _queue.append(record)
+        full = len(_queue) >= BATCH_SIZE
+    if full:
+        _wakeup.set()
+
+
+def flush():
+    """
+    キューに残っている分を書き込み、書き込んだ件数を返す（履歴ページを表示する前などに呼ぶ）
+    """
+    with _flush_lock:
+        with _lock:
+            if _queue_pid != os.getpid():
+                records = []
+            else:
+                records = _queue[:]
+                del _queue[:]
+        records = _read_spool() + records
+        if not records:
+            return 0
+        failed = _write(records)
+        if failed:
+            _spool(failed)
+        return len(records) - len(failed)
+
+
+def pending():
+    with _lock:
+        return len(_queue) if _queue_pid == os.getpid() else 0
+
+
+def _plain(value):
+    # sqlite3 は datetime をそのまま ISO 形式の文字列で保存するので、同じ形にしておく
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(' ')
+    return value
+
+
+def _write(records):
+    """
+    データベースごとに1トランザクションで書き込み、書けなかった分を返す
+    """
+    by_database = {}
+    for record in records:
+        by_database.setdefault(record[0], []).append(record)
+    failed = []
+    for database, rows in by_database.items():
+        try:
+            conn = get_connection(database)
+            with conn:
+                for _, sql, params in rows:
+                    conn.execute(sql, params)
+        except sqlite3.Error as e:
+            print(f"履歴の書き込みに失敗しました（{len(rows)} 件を退避）: {e}")
+            failed.extend(rows)
+    return failed
+
+
+def _spool(records):
+    with open(SPOOL_FILE, 'a', encoding='utf-8') as f:
+        for database, sql, params in records:
+            f.write(json.dumps([database, sql, params], ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_spool():
+    """
+    退避してあった分を取り出す（取り出したらファイルは消す。書けなければまた退避される）
+    """
+    if not os.path.exists(SPOOL_FILE):
+        return []
+    # 別のプロセスと同じ分を二重に取り出さないよう、名前を変えてから読む
+    claimed = f"{SPOOL_FILE}.{os.getpid()}"
+    records = []
+    try:
+        os.replace(SPOOL_FILE, claimed)
+        with open(claimed, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    database, sql, params = json.loads(line)
+                except ValueError:
+                    continue  # 書きかけの行
+                records.append((database, sql, tuple(params)))
+        os.unlink(claimed)
+    except FileNotFoundError:
+        return []  # 別のプロセスが先に取り出した
+    except OSError as e:
+        print(f"退避した履歴の読み込みに失敗しました: {e}")
+        return []
+    return records
+
+
+def _run():
+    while True:
+        _wakeup.wait(FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            print(f"履歴の書き込みに失敗しました: {e}")
+
+
+def _ensure_thread():
+    # _lock を持った状態で呼ぶ。fork 後は親のキューを引き継がずに子で起動し直す
+    global _thread, _queue_pid
+    if _queue_pid == os.getpid() and _thread is not None:
+        return
+    del _queue[:]
+    _queue_pid = os.getpid()
+    _thread = threading.Thread(target=_run, name="history-writer", daemon=True)
+    _thread.start()
+
+
+# 終了時に残りを書き込む
+atexit.register(flush)
@@ -0,0 +1,154 @@
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import click
+from PIL import Image, ImageOps
+import pillow_heif
+
+# アップロード画像（JPEG / HEIF）の変換
+#   デコード・再エンコードは別プロセスで行い、リクエストのスレッドで CPU を使わない。
+#   IMAGE_MAX_PIXELS : これより画素数の多い画像は受け付けない（巨大な画像でメモリを使い切らないように）
+#   IMAGE_MAX_SIDE   : 保存する画像の長辺の上限（JPEG は縮小しながらデコードする）
+#   IMAGE_WORKERS    : 変換プロセス数（0 ならプロセスを使わずその場で変換する）
+MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", str(50_000_000)))
+MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "4096"))
+JPEG_QUALITY = 90
+WORKERS = int(os.environ.get("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+pillow_heif.register_heif_opener()
+
+HEIF_BRANDS = [
+    b'ftypheic', b'ftypheix', b'ftyphevc', b'ftyphevx',
+    b'ftypmif1', b'ftypmsf1'
+]
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class ImageTooLarge(ValueError):
+    """画素数が IMAGE_MAX_PIXELS を超えている"""
+
+
+def is_jpegfile(file):
+    """
+    先頭12バイトで JPEG / HEIF かを判定する。(is_jpeg, is_heif) を返す
+    """
+    header = file.read(12)
+    file.seek(0)  # ファイルポインタを元に戻す
+
+    # JPEG判定
+    is_jpeg = header[:2] == b'\xff\xd8'
+
+    # HEIF/HEIC判定
+    is_heif = any(header[4:12] == heif for heif in HEIF_BRANDS)
+
+    return is_jpeg, is_heif
+
+
+def convert_to_jpeg(data, max_side=MAX_SIDE, quality=JPEG_QUALITY):
+    """
+    画像のバイト列を JPEG のバイト列にする（変換プロセスで実行される）
+    長辺が max_side 以下の JPEG はデコードせずそのまま返す
+    """
+    # Pillow の上限（Image.MAX_IMAGE_PIXELS の2倍）を超える画像は開く時点で例外になるので、同じ扱いにする
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(f"画像が大きすぎます（{e}）") from e
+    width, height = image.size  # ここまではヘッダーを読むだけ
+    if width * height > MAX_PIXELS:
+        raise ImageTooLarge(f"画像が大きすぎます（{width}x{height}）")
+    if image.format == 'JPEG' and max(width, height) <= max_side:
+        return data
+
+    # JPEG は 1/2, 1/4, 1/8 に縮小しながらデコードできる
+    image.draft('RGB', (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, 'JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def get_pool():
+    """
+    変換用のプロセスプール（プロセスごとに1つ、fork後は作り直す）
+    forkserver で起動するので、スレッドを抱えたWebサーバーのプロセスを複製しない
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                # 変換に使うモジュールを読み込んだ状態のサーバーから複製する（sys.path も引き継がれる）
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context()
+            _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=context)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def reset_pool(pool):
+    """
+    壊れたプール（変換プロセスが落ちた）を捨て、次の get_pool() で作り直させる
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def to_jpeg_bytes(data, max_side=MAX_SIDE):
+    if WORKERS <= 0:
+        return convert_to_jpeg(data, max_side)
+    pool = get_pool()
+    try:
+        return pool.submit(convert_to_jpeg, data, max_side).result()
+    except BrokenProcessPool as e:
+        # 変換プロセスが落ちた。プールを作り直し、この1枚はその場で変換する
+        print(f"画像変換のプロセスが停止しました: {e}")
+        reset_pool(pool)
+        return convert_to_jpeg(data, max_side)
+
+
+def save_upload_as_jpeg(file, output_path, max_side=MAX_SIDE):
+    """
+    アップロードされたファイル（JPEG / HEIF）を JPEG にして output_path に保存する
+    一時ファイルは作らず、アップロードのストリームから直接変換する
+    """
+    file.seek(0)
+    data = to_jpeg_bytes(file.read(), max_side)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+
+
+@click.command('image-bench')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--repeat', default=1, help='同じファイル群を繰り返す回数')
+def image_bench_command(paths, repeat):
+    """画像ファイル群の変換スループットを測る（その場で変換した場合と比べる）"""
+    batch = [open(path, 'rb').read() for path in paths] * repeat
+    total_mb = sum(len(data) for data in batch) / 1024 / 1024
+
+    started = time.perf_counter()
+    for data in batch:
+        convert_to_jpeg(data)
+    inline = time.perf_counter() - started
+    click.echo(f"その場で変換: {len(batch)} 枚 {inline:.2f} 秒（{len(batch) / inline:.1f} 枚/秒, {total_mb / inline:.1f} MB/秒）")
+
+    if WORKERS > 0:
+        pool = get_pool()
+        list(pool.map(convert_to_jpeg, batch[:WORKERS]))  # プロセスの起動分は除く
+        started = time.perf_counter()
+        list(pool.map(convert_to_jpeg, batch))
+        pooled = time.perf_counter() - started
+        click.echo(f"プロセス {WORKERS} 個: {len(batch)} 枚 {pooled:.2f} 秒（{len(batch) / pooled:.1f} 枚/秒, {total_mb / pooled:.1f} MB/秒）")
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+
+import click
+
+# 生成ファイルの掃除（リクエストの外で、古いものと容量超過分を消す）
+#   max_age   : これより古いファイルを消す（秒）
+#   max_bytes : フォルダ合計の上限。超えたら古い順に消す（None なら無制限）
+#   exclude   : 対象外にするサブフォルダ名（別の仕組みで管理しているもの）
+# 作成・更新から GRACE_SECONDS 以内のファイルは容量超過でも消さない（配信中・書き込み中のもの）
+# ファイル以外の片付け（古いジョブの行など）は register_task で登録し、掃除のたびに呼ぶ
+DEFAULT_MAX_AGE = int(os.environ.get("JANITOR_MAX_AGE", "3600"))
+GRACE_SECONDS = int(os.environ.get("JANITOR_GRACE", "300"))
+INTERVAL = int(os.environ.get("JANITOR_INTERVAL", "300"))  # 0 なら定期実行しない
+
+_folders = {}
+_folders_lock = threading.Lock()
+_tasks = {}
+_thread = None
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+
+def register_folder(path, max_age=DEFAULT_MAX_AGE, max_bytes=None, exclude=()):
+    """
+    掃除するフォルダを登録する（各Blueprintのimport時に呼ぶ）
+    例: register_folder(UPLOAD_FOLDER, max_age=24 * 3600, max_bytes=1024 ** 3)
+    """
+    key = os.path.abspath(path)
+    with _folders_lock:
+        _folders[key] = {'max_age': max_age, 'max_bytes': max_bytes, 'exclude': set(exclude)}
+
+
+def register_task(name, task):
+    """
+    掃除のたびに呼ぶ関数を登録する。task() は消した件数を返す
+    例: register_task('youtube_to_mpeg.jobs', prune_jobs)
+    """
+    with _folders_lock:
+        _tasks[name] = task
+
+
+def _list_files(folder, exclude):
+    files = []
+    for root, dirs, names in os.walk(folder):
+        if root == folder:
+            dirs[:] = [d for d in dirs if d not in exclude]
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # 他のリクエストが先に消した
+            files.append((st.st_mtime, st.st_size, path))
+    return files
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        print(f"ファイルの削除に失敗しました: {e}")
+        return False
+
+
+def sweep_folder(folder, max_age=DEFAULT_MAX_AGE, max_bytes=None, exclude=(), now=None):
+    """
+    1フォルダを掃除して (削除件数, 削除バイト数) を返す
+    """
+    if not os.path.isdir(folder):
+        return 0, 0
+    now = time.time() if now is None else now
+    files = sorted(_list_files(folder, set(exclude)))  # 古い順
+
+    removed = freed = 0
+    kept = []
+    for mtime, size, path in files:
+        if now - mtime > max_age and _remove(path):
+            removed += 1
+            freed += size
+        else:
+            kept.append((mtime, size, path))
+
+    if max_bytes is not None:
+        total = sum(size for _, size, _ in kept)
+        for mtime, size, path in kept:
+            if total <= max_bytes or now - mtime <= GRACE_SECONDS:
+                break
+            if _remove(path):
+                removed += 1
+                freed += size
+            total -= size
+
+    # 空になったサブフォルダを片付ける
+    for root, dirs, names in os.walk(folder, topdown=False):
+        if root == folder or os.path.relpath(root, folder).split(os.sep)[0] in exclude:
+            continue
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+    return removed, freed
+
+
+def sweep_all():
+    """
+    登録済みの全フォルダを掃除して {フォルダ: (削除件数, 削除バイト数)} を返す
+    """
+    with _folders_lock:
+        folders = dict(_folders)
+    return {folder: sweep_folder(folder, **settings) for folder, settings in folders.items()}
+
+
+def run_tasks():
+    """
+    登録済みの片付けを実行して {名前: 削除件数} を返す
+    """
+    with _folders_lock:
+        tasks = dict(_tasks)
+    results = {}
+    for name, task in tasks.items():
+        try:
+            results[name] = task()
+        except Exception as e:
+            print(f"{name} の片付けに失敗しました: {e}")
+    return results
+
+
+def _run(interval):
+    while True:
+        try:
+            sweep_all()
+        except Exception as e:
+            print(f"ファイルの掃除に失敗しました: {e}")
+        run_tasks()
+        time.sleep(interval)
+
+
+def start_janitor(interval=INTERVAL):
+    """
+    定期的に掃除するスレッドを起動する。プロセスごとに1つだけ（fork 後は子で起動し直す）
+    """
+    global _thread, _thread_pid
+    if interval <= 0 or (_thread_pid == os.getpid() and _thread is not None):
+        return
+    with _thread_lock:
+        if _thread_pid == os.getpid() and _thread is not None:
+            return
+        _thread = threading.Thread(target=_run, args=(interval,), name="janitor", daemon=True)
+        _thread.start()
+        _thread_pid = os.getpid()
+
+
+@click.command('sweep-files')
+def sweep_files_command():
+    """生成ファイルのうち期限切れ・容量超過分と、登録済みの古い行を削除する"""
+    for folder, (removed, freed) in sweep_all().items():
+        click.echo(f"{folder}: {removed} 件削除 ({freed / 1024 / 1024:.1f} MB)")
+    for name, removed in run_tasks().items():
+        click.echo(f"{name}: {removed} 件削除")
@@ -0,0 +1,77 @@
+import mimetypes
+import os
+import time
+from urllib.parse import quote
+
+from flask import Response, abort, request, send_file
+from werkzeug.utils import safe_join
+
+# 生成したメディアファイルの配信
+#   send_file(conditional=True) で Range（206）と If-None-Match / If-Modified-Since（304）に対応し、
+#   ファイル本体は wsgi.file_wrapper（sendfile）で送る。
+#   MEDIA_ACCEL_PREFIX を設定すると本体の送信はフロントの nginx に任せる（X-Accel-Redirect）。
+#     例: MEDIA_ACCEL_PREFIX=/_media のとき nginx 側は
+#         location /_media/ { internal; alias /path/to/my_flask_apps/; }
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCEL_PREFIX = os.environ.get("MEDIA_ACCEL_PREFIX", "").rstrip("/")
+MAX_AGE = int(os.environ.get("MEDIA_MAX_AGE", "3600"))
+
+_hooks = []
+
+
+def register_media_hook(hook):
+    """
+    配信ごとに呼ばれる関数を登録する（メトリクス用）
+    hook(info) の info: path, status, bytes, range, accel, seconds
+    """
+    _hooks.append(hook)
+
+
+def _notify(path, response, started):
+    if not _hooks:
+        return
+    info = {
+        'path': path,
+        'status': response.status_code,
+        'bytes': 0 if response.status_code == 304 else (response.content_length or 0),
+        'range': request.headers.get('Range'),
+        'accel': 'X-Accel-Redirect' in response.headers,
+        'seconds': time.perf_counter() - started,
+    }
+    for hook in _hooks:
+        try:
+            hook(info)
+        except Exception as e:
+            print(f"メディア配信のフックでエラー: {e}")
+
+
+def _content_disposition(name):
+    try:
+        name.encode('ascii')
+        return f'attachment; filename="{name}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*=UTF-8''{quote(name)}"
+
+
+def send_media(root, filename, as_attachment=False, download_name=None, mimetype=None):
+    """
+    root 配下の filename を配信する。root の外や存在しないファイルは 404
+    """
+    started = time.perf_counter()
+    path = safe_join(root, filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+
+    if ACCEL_PREFIX:
+        # 本体はフロントのプロキシが送る（Range・条件付きリクエストもプロキシ側で処理される）
+        location = ACCEL_PREFIX + "/" + quote(os.path.relpath(path, BASE_DIR).replace(os.sep, "/"))
+        response = Response(mimetype=mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = location
+        if as_attachment:
+            response.headers['Content-Disposition'] = _content_disposition(download_name or os.path.basename(path))
+    else:
+        response = send_file(path, mimetype=mimetype, as_attachment=as_attachment,
+                             download_name=download_name, conditional=True, etag=True, max_age=MAX_AGE)
+
+    _notify(path, response, started)
+    return response
@@ -0,0 +1,148 @@
+import base64
+import json
+
+# キーセット方式のページング（OFFSETを使わず、前ページ末尾のキーより後ろを索引で引く）
+
+
+def encode_cursor(values):
+    """
+    並び順キーの値をURLに載せられる文字列にする
+    """
+    raw = json.dumps(list(values), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    encode_cursor の逆。不正な値は None を返す
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def page_size(value, default, maximum):
+    """
+    リクエストのページサイズを 1〜maximum に丸める
+    """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, maximum))
+
+
+class KeysetPage:
+    """
+    キーセット方式の1ページ分。
+      rows        : 表示する行（stream=True の時は読みながら返すイテレータ）
+      next_cursor : 次ページ用カーソル（無ければ None）
+      prev_cursor : 前ページ用カーソル（無ければ None）
+    stream=True の場合、next_cursor / prev_cursor は rows を読み終えてから確定する。
+    """
+
+    def __init__(self, keys, rows=(), has_prev=False, has_next=False):
+        self.keys = keys
+        self.rows = rows
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.first = rows[0] if rows else None
+        self.last = rows[-1] if rows else None
+
+    @classmethod
+    def empty(cls):
+        return cls([])
+
+    def key_of(self, row):
+        return [null_value(key) if row[key[1]] is None else row[key[1]] for key in self.keys]
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.last is not None:
+            return encode_cursor(self.key_of(self.last))
+        return None
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.first is not None:
+            return encode_cursor(self.key_of(self.first))
+        return None
+
+    def _stream(self, cursor, size):
+        count = 0
+        for row in cursor:
+            if count == size:
+                # size+1 件目があれば次ページあり
+                self.has_next = True
+                break
+            if self.first is None:
+                self.first = row
+            self.last = row
+            count += 1
+            yield row
+
+
+def null_value(key):
+    """
+    並び順キーの NULL の代わりの値（(列名, 行内の位置, NULLの代わりの値) の3つ目。無ければ None）
+    """
+    return key[2] if len(key) > 2 else None
+
+
+def key_expression(key):
+    """
+    比較と ORDER BY に使う式（NULL の代わりの値があれば COALESCE で置き換える）
+    """
+    column, null = key[0], null_value(key)
+    if null is None:
+        return column
+    literal = "'" + null.replace("'", "''") + "'" if isinstance(null, str) else repr(null)
+    return f"COALESCE({column}, {literal})"
+
+
+def keyset_query(cursor, query, params, keys, size, after=None, before=None, stream=False, descending=False):
+    """
+    キーセット方式で1ページ分を取得する。
+      query : "{keyset}"（追加条件 "AND (...) > (...)"）と "{order}"（ORDER BY の中身）を含むSQL
+      keys  : 並び順キーの [(列名, 行内の位置)]。末尾のキーで一意になるようにする
+              NULL になりうる列は (列名, 行内の位置, NULLの代わりの値) とする（NULL の行を読み飛ばさないように。
+              索引も同じ COALESCE の式で張る）
+      after / before : decode_cursor で戻したカーソル（before が優先）
+      descending : 新しい順など、キーの降順に並べる
+    """
+    columns = "(" + ", ".join(key_expression(key) for key in keys) + ")"
+    marks = "(" + ", ".join(["?"] * len(keys)) + ")"
+    params = list(params)
+
+    backward = before is not None and len(before) == len(keys)
+    bound = before if backward else after
+    keyset = ""
+    if bound is not None and len(bound) == len(keys):
+        # 行値の比較は式（COALESCE）の索引では範囲検索にならないので、先頭のキーだけの条件も付けて索引で引く
+        op = '<' if backward != descending else '>'
+        keyset = f"AND {key_expression(keys[0])} {op}= ? AND {columns} {op} {marks}"
+        params.extend([bound[0], *bound])
+    else:
+        bound = None
+
+    direction = "DESC" if backward != descending else "ASC"
+    order = ", ".join(f"{key_expression(key)} {direction}" for key in keys)
+    cursor.execute(query.format(keyset=keyset, order=order) + f" LIMIT {int(size) + 1}", params)
+
+    if backward:
+        # 前ページは逆順に読んでから並べ直す
+        rows = cursor.fetchall()
+        return KeysetPage(keys, rows[:size][::-1], has_prev=len(rows) > size, has_next=True)
+
+    if stream:
+        page = KeysetPage(keys, has_prev=bound is not None)
+        page.rows = page._stream(cursor, size)
+        return page
+
+    rows = cursor.fetchall()
+    return KeysetPage(keys, rows[:size], has_prev=bound is not None, has_next=len(rows) > size)
@@ -0,0 +1,64 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Blueprintごとのバックグラウンド処理（ジョブ・タスク）の共通部分
+#   WorkerPool  : プロセスごとに1つのワーカープール（gunicorn の fork 後は子で作り直す）
+#   resume_once : 中断された処理の再開を、リクエストを受けるプロセスで最初のリクエストの前に1回だけ行う
+#                 （CLIコマンドなどでは再開しない）
+
+
+class WorkerPool:
+    """
+    例: executor = WorkerPool(JOB_WORKERS, 'ytdlp')
+        executor.submit(run_job, job_id)
+    """
+    def __init__(self, max_workers, name):
+        self.max_workers = max_workers
+        self.name = name
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.get().submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        """
+        プールを止める（次の submit で max_workers の数で作り直す）
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=wait)
+
+
+class ResumeHook:
+    def __init__(self, resume):
+        self.resume = resume
+        self.done = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+        self.resume()
+
+
+def resume_once(blueprint, resume):
+    """
+    blueprint を登録したアプリの最初のリクエストの前に resume() を1回だけ呼ぶ
+    戻り値の done を True にすると再開しない（テストなど）
+    """
+    hook = ResumeHook(resume)
+    blueprint.before_app_request(hook)
+    return hook
@@ -1,16 +1,24 @@
-from flask import request, render_template, redirect, url_for, flash, jsonify
+from flask import request, render_template, redirect, url_for, flash, jsonify, session
 import os
 import uuid
 import sqlite3
+import hashlib
+import json
+import threading
+import click
 import pytz
 from datetime import datetime, timedelta
 
+from common.db import register_database, get_connection
+from common.history_store import record, register_legacy, query_history
+from common.janitor import register_folder
 from .forms import KakeiDbForm
 from . import kakei_db_bp  # Blueprintをインポート
 
 # 保存先ディレクトリの設定
 UPLOAD_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'static')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+register_folder(UPLOAD_FOLDER, max_age=3600, max_bytes=100 * 1024 ** 2)  # 古いファイルは common.janitor が消す
 
 # データベースのパスを指定
 DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
@@ -18,6 +26,10 @@ DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
 # KAKEIデータベースのパスを指定
 KAKEI_DB = os.path.join(os.path.dirname(__file__), 'Kakei.db')
 
+# 接続設定（Kakei.db は読み取り専用で開く。スキーマ移行だけ書き込み用に別途開く）
+register_database(DATABASE)
+register_database(KAKEI_DB, readonly=True, mmap_size=256 * 1024 * 1024)
+
 # 認証に使用するパスワード
 HISTORY_PASSWORD = os.environ.get("HISTORY_PASSWORD", "Canon-01")
 
@@ -26,26 +38,202 @@ jst = pytz.timezone('Asia/Tokyo')
 
 # データベースの初期化
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS history
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                  input_text TEXT) ''')
-    conn.commit()
-    conn.close()
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                      input_text TEXT) ''')
 
 init_db()
 
+register_legacy('kakei_db', DATABASE,
+                "SELECT id, timestamp, input_text, NULL, NULL, NULL FROM history")
+
+# 月次集計テーブル（年・月・大項目・中項目ごとの合計金額と件数）
+# kakeibo を更新するとトリガーで差分だけ反映される
+ROLLUP_TABLE = 'kakeibo_monthly'
+ROLLUP_TRIGGERS = ('kakeibo_monthly_ai', 'kakeibo_monthly_ad', 'kakeibo_monthly_au')
+
+# 集計テーブルを作れない時（Kakei.db が読み取り専用・ロック中など）に使う、明細から同じ列を集計する副問い合わせ
+ROLLUP_FALLBACK = """(
+    SELECT SUBSTR("日付", 1, 4) AS year, SUBSTR("日付", 6, 2) AS month,
+           IFNULL("大項目", '') AS major, IFNULL("中項目", '') AS minor,
+           SUM(IFNULL("金額（円）", 0)) AS total, COUNT(*) AS cnt
+    FROM kakeibo
+    WHERE "日付" IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+)"""
+
+# 日付は範囲条件（"日付" >= 月初 AND "日付" < 翌月初）で絞るので、そのまま索引が効く
+# 月だけの絞り込み（同月過去）は集計テーブルの month 索引で引く
+KAKEI_INDEXES = {
+    'idx_kakeibo_date': 'CREATE INDEX IF NOT EXISTS idx_kakeibo_date ON kakeibo ("日付")',
+    'idx_kakeibo_major_minor_date':
+        'CREATE INDEX IF NOT EXISTS idx_kakeibo_major_minor_date ON kakeibo ("大項目", "中項目", "日付")',
+    'idx_kakeibo_monthly_month':
+        f'CREATE INDEX IF NOT EXISTS idx_kakeibo_monthly_month ON {ROLLUP_TABLE} (month, major, minor)',
+}
+KAKEI_SCHEMA = (ROLLUP_TABLE,) + ROLLUP_TRIGGERS + tuple(KAKEI_INDEXES)
+
+def kakei_schema():
+    """
+    Kakei.db にある索引・月次集計テーブル・トリガーの名前（共有の読み取り専用接続で確認する）
+    """
+    cursor = get_connection(KAKEI_DB).execute(
+        "SELECT name FROM sqlite_master WHERE name IN (%s)" % ",".join(["?"] * len(KAKEI_SCHEMA)),
+        KAKEI_SCHEMA)
+    return {row[0] for row in cursor.fetchall()}
+
+def migrate_kakei_db():
+    """
+    Kakei.db のスキーマ移行（索引・月次集計テーブル・トリガー）。flask kakei_db migrate から実行する。
+    足りないものだけ作成し、集計テーブルかトリガーが無い場合（初回・Kakei.dbの差し替え後など）は
+    全件から作り直す。何か作成したかを返す（失敗した時は sqlite3.Error）
+    """
+    existing = kakei_schema()
+    if len(existing) == len(KAKEI_SCHEMA):
+        return False
+
+    # 不足がある時だけ書き込み用の接続を開く
+    conn = sqlite3.connect(KAKEI_DB)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        rebuild_rollup = not existing.issuperset((ROLLUP_TABLE,) + ROLLUP_TRIGGERS)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+                year  TEXT NOT NULL,
+                month TEXT NOT NULL,
+                major TEXT NOT NULL,
+                minor TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                cnt   INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (year, month, major, minor)
+            )
+        """)
+
+        for sql in KAKEI_INDEXES.values():
+            cursor.execute(sql)
+
+        if not rebuild_rollup:
+            conn.commit()
+            return True
+
+        # 追加：該当キーに加算（無ければ作成）
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS kakeibo_monthly_ai AFTER INSERT ON kakeibo
+            WHEN new."日付" IS NOT NULL
+            BEGIN
+                INSERT INTO {ROLLUP_TABLE} (year, month, major, minor, total, cnt)
+                VALUES (SUBSTR(new."日付", 1, 4), SUBSTR(new."日付", 6, 2),
+                        IFNULL(new."大項目", ''), IFNULL(new."中項目", ''),
+                        IFNULL(new."金額（円）", 0), 1)
+                ON CONFLICT (year, month, major, minor)
+                DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+            END
+        """)
+
+        # 削除：該当キーから減算し、件数0になった行は消す
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS kakeibo_monthly_ad AFTER DELETE ON kakeibo
+            WHEN old."日付" IS NOT NULL
+            BEGIN
+                UPDATE {ROLLUP_TABLE}
+                SET total = total - IFNULL(old."金額（円）", 0), cnt = cnt - 1
+                WHERE year = SUBSTR(old."日付", 1, 4) AND month = SUBSTR(old."日付", 6, 2)
+                  AND major = IFNULL(old."大項目", '') AND minor = IFNULL(old."中項目", '');
+                DELETE FROM {ROLLUP_TABLE}
+                WHERE year = SUBSTR(old."日付", 1, 4) AND month = SUBSTR(old."日付", 6, 2)
+                  AND major = IFNULL(old."大項目", '') AND minor = IFNULL(old."中項目", '')
+                  AND cnt <= 0;
+            END
+        """)
+
+        # 更新：旧値を減算してから新値を加算
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS kakeibo_monthly_au
+            AFTER UPDATE OF "日付", "金額（円）", "大項目", "中項目" ON kakeibo
+            BEGIN
+                UPDATE {ROLLUP_TABLE}
+                SET total = total - IFNULL(old."金額（円）", 0), cnt = cnt - 1
+                WHERE old."日付" IS NOT NULL
+                  AND year = SUBSTR(old."日付", 1, 4) AND month = SUBSTR(old."日付", 6, 2)
+                  AND major = IFNULL(old."大項目", '') AND minor = IFNULL(old."中項目", '');
+                DELETE FROM {ROLLUP_TABLE}
+                WHERE old."日付" IS NOT NULL
+                  AND year = SUBSTR(old."日付", 1, 4) AND month = SUBSTR(old."日付", 6, 2)
+                  AND major = IFNULL(old."大項目", '') AND minor = IFNULL(old."中項目", '')
+                  AND cnt <= 0;
+                INSERT INTO {ROLLUP_TABLE} (year, month, major, minor, total, cnt)
+                SELECT SUBSTR(new."日付", 1, 4), SUBSTR(new."日付", 6, 2),
+                       IFNULL(new."大項目", ''), IFNULL(new."中項目", ''),
+                       IFNULL(new."金額（円）", 0), 1
+                WHERE new."日付" IS NOT NULL
+                ON CONFLICT (year, month, major, minor)
+                DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+            END
+        """)
+
+        # 全件から作り直す（トリガーが無かった間の変更もここで吸収する）
+        cursor.execute(f"DELETE FROM {ROLLUP_TABLE}")
+        cursor.execute(f"""
+            INSERT INTO {ROLLUP_TABLE} (year, month, major, minor, total, cnt)
+            SELECT SUBSTR("日付", 1, 4), SUBSTR("日付", 6, 2),
+                   IFNULL("大項目", ''), IFNULL("中項目", ''),
+                   SUM(IFNULL("金額（円）", 0)), COUNT(*)
+            FROM kakeibo
+            WHERE "日付" IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+        """)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return True
+
+@kakei_db_bp.cli.command('migrate')
+def migrate_command():
+    """Kakei.db に索引・月次集計テーブル・トリガーを作る（Kakei.db を差し替えた後にも実行する）"""
+    if not os.path.exists(KAKEI_DB):
+        click.echo(f"{KAKEI_DB} がありません。")
+        return
+    try:
+        created = migrate_kakei_db()
+    except sqlite3.Error as e:
+        click.echo(f"Kakei.dbの移行に失敗しました: {e}")
+        return
+    click.echo("Kakei.dbを移行しました。" if created else "Kakei.dbは移行済みです。")
+
+# 月次集計テーブルが使えるか（Kakei.db のファイル更新時刻が変わった時だけ確かめ直す）
+_rollup_cache = {}
+_rollup_lock = threading.Lock()
+
+def rollup_source():
+    """
+    月次集計の読み出し元。集計テーブルかトリガーが無ければ（未移行・移行に失敗した）明細から集計する副問い合わせを返す
+    """
+    key = (KAKEI_DB, kakei_db_mtimes())
+    with _rollup_lock:
+        if _rollup_cache.get('key') != key:
+            try:
+                ready = kakei_schema().issuperset((ROLLUP_TABLE,) + ROLLUP_TRIGGERS)
+            except sqlite3.Error as e:
+                print(f"データベースエラー: {e}")
+                ready = False
+            if not ready:
+                print("月次集計テーブルが無いため、明細から集計します（flask kakei_db migrate で作成できます）")
+            _rollup_cache.update(key=key, ready=ready)
+        ready = _rollup_cache['ready']
+    return ROLLUP_TABLE if ready else ROLLUP_FALLBACK
+
 
 @kakei_db_bp.route('/', methods=['GET', 'POST'])
 def index():
-    clear_upload_folder()
     form = KakeiDbForm()
 
-    # 大項目・中項目のマスタを取得
-    categories, subcategories_map = get_categories_from_db()    
-
     if form.validate_on_submit():
 
         period = request.form.get('period', 'this_month')
@@ -100,15 +288,75 @@ def index():
             flash(str(e), 'danger')
             return redirect(url_for('kakei_db.index'))
 
-    # 初期表示（GET時）
+    # 初期表示（GET時）大項目はマスタのキャッシュから、中項目は画面から /categories を取得する
+    categories, _ = get_categories_from_db()
     return render_template('kakei_db/upload.html',
                            form=form,
-                           categories=categories,
-                           subcategories_map=subcategories_map)
+                           categories=categories)
+
+# 大項目・中項目マスタのキャッシュ（Kakei.db の更新時刻・PRAGMA data_version で無効化）
+_category_cache = {}
+_category_lock = threading.Lock()
+_category_seen = threading.local()
+
+def kakei_db_changed():
+    """
+    Kakei.db の更新検知用に (ファイル更新時刻, このスレッドで data_version が変わったか) を返す。
+    data_version は接続ごとの値なので、スレッドごとの前回値と比べる。
+    """
+    data_version = get_connection(KAKEI_DB).execute('PRAGMA data_version').fetchone()[0]
+    changed = getattr(_category_seen, 'data_version', data_version) != data_version
+    _category_seen.data_version = data_version
+
+    return kakei_db_mtimes(), changed
+
+def kakei_db_mtimes():
+    # WALモードで更新された場合は本体より先に -wal ファイルの時刻が変わる
+    return tuple(os.path.getmtime(p) for p in (KAKEI_DB, KAKEI_DB + '-wal') if os.path.exists(p))
+
+def get_category_master():
+    """
+    大項目一覧・大項目ごとの中項目一覧と ETag を返す（変更が無ければキャッシュを返す）
+    """
+    mtimes, changed = kakei_db_changed()
+    with _category_lock:
+        if _category_cache and not changed and _category_cache['mtimes'] == mtimes:
+            return _category_cache
+
+    categories, mapping = load_categories_from_db()
+    body = json.dumps([categories, mapping], ensure_ascii=False, sort_keys=True)
+    master = {
+        'mtimes': mtimes,
+        'categories': categories,
+        'mapping': mapping,
+        'etag': hashlib.sha1(body.encode('utf-8')).hexdigest(),
+    }
+    with _category_lock:
+        _category_cache.clear()
+        _category_cache.update(master)
+    return master
 
 def get_categories_from_db():
-    conn = sqlite3.connect(KAKEI_DB)
-    cursor = conn.cursor()
+    master = get_category_master()
+    return master['categories'], master['mapping']
+
+@kakei_db_bp.route("/categories")
+def categories():
+    """
+    大項目・中項目マスタをJSONで返す。ETag が一致すれば 304 を返す。
+    """
+    master = get_category_master()
+    response = jsonify({
+        "ok": True,
+        "categories": master['categories'],
+        "subcategories": master['mapping'],
+    })
+    response.set_etag(master['etag'])
+    response.cache_control.no_cache = True  # 毎回 If-None-Match で再検証させる
+    return response.make_conditional(request)
+
+def load_categories_from_db():
+    cursor = get_connection(KAKEI_DB).cursor()
 
     # 大項目一覧
     cursor.execute('SELECT DISTINCT "大項目" FROM kakeibo WHERE "大項目" IS NOT NULL')
@@ -120,30 +368,47 @@ def get_categories_from_db():
     for cat, sub in cursor.fetchall():
         mapping.setdefault(cat, []).append(sub)
 
-    conn.close()
     return categories, mapping
 
 def search_kakei_db(period, same_month=None, categories=None, subcategories=None):
+    """
+    月ごとの合計を返す。締まった月は月次集計テーブルから、
+    当月（今日まで）の分だけ明細から集計して合算する。
+    """
     results = []
     today = datetime.now()
     end_date = today.strftime('%Y-%m-%d')
+    rollup = rollup_source()
 
-    base_query = """
-        SELECT 
-            SUBSTR("日付", 1, 4) AS year,
-            SUBSTR("日付", 6, 2) AS month,
-            SUM("金額（円）") AS total
-        FROM kakeibo
-        WHERE 1=1
-    """
-    params = []
+    # 集計テーブル側・明細側それぞれの 大項目/中項目 フィルタ
+    rollup_filter = ""
+    detail_filter = ""
+    filter_params = []
 
-    # ✅ 同月過去（特別処理：月だけでフィルタ）
+    # ✅ 大項目フィルタ（複数選択可）
+    if categories:
+        placeholders = ','.join(['?'] * len(categories))
+        rollup_filter += f' AND major IN ({placeholders})'
+        detail_filter += f' AND "大項目" IN ({placeholders})'
+        filter_params.extend(categories)
+
+    # ✅ 中項目フィルタ（複数選択可）
+    if subcategories:
+        placeholders = ','.join(['?'] * len(subcategories))
+        rollup_filter += f' AND minor IN ({placeholders})'
+        detail_filter += f' AND "中項目" IN ({placeholders})'
+        filter_params.extend(subcategories)
+
+    # ✅ 同月過去（特別処理：月だけでフィルタ、期間の上限なし）
     if period == "same_month_past":
-        base_query += ' AND strftime("%m", "日付") = ?'
-        params.append(same_month)
+        base_query = f"""
+            SELECT year, month, SUM(total) AS total
+            FROM {rollup}
+            WHERE month = ?{rollup_filter}
+        """
+        params = [same_month] + filter_params
 
-    # ✅ 通常の期間（BETWEEN 日付指定）
+    # ✅ 通常の期間（開始月〜今日）
     else:
         start_date = "1900-01-01"
         if period == "this_month":
@@ -170,20 +435,24 @@ def search_kakei_db(period, same_month=None, categories=None, subcategories=None
                 month = 1
             start_date = datetime(year, month, 1).strftime('%Y-%m-%d')
 
-        base_query += ' AND "日付" BETWEEN ? AND ?'
-        params.extend([start_date, end_date])
-
-    # ✅ 大項目フィルタ（複数選択可）
-    if categories:
-        placeholders = ','.join(['?'] * len(categories))
-        base_query += f' AND "大項目" IN ({placeholders})'
-        params.extend(categories)
-
-    # ✅ 中項目フィルタ（複数選択可）
-    if subcategories:
-        placeholders = ','.join(['?'] * len(subcategories))
-        base_query += f' AND "中項目" IN ({placeholders})'
-        params.extend(subcategories)
+        # 開始月〜前月は集計テーブル、当月1日〜今日は明細
+        month_start = today.replace(day=1).strftime('%Y-%m-%d')
+        base_query = f"""
+            SELECT year, month, SUM(total) AS total
+            FROM (
+                SELECT year, month, total
+                FROM {rollup}
+                WHERE (year, month) >= (?, ?) AND (year, month) < (?, ?){rollup_filter}
+                UNION ALL
+                SELECT SUBSTR("日付", 1, 4), SUBSTR("日付", 6, 2), "金額（円）"
+                FROM kakeibo
+                WHERE "日付" BETWEEN ? AND ?{detail_filter}
+            )
+        """
+        params = [start_date[:4], start_date[5:7], month_start[:4], month_start[5:7]]
+        params.extend(filter_params)
+        params.extend([max(start_date, month_start), end_date])
+        params.extend(filter_params)
 
     # ✅ 集計・並び順
     base_query += """
@@ -193,17 +462,25 @@ def search_kakei_db(period, same_month=None, categories=None, subcategories=None
 
     # ✅ 実行
     try:
-        conn = sqlite3.connect(KAKEI_DB)
-        cursor = conn.cursor()
+        cursor = get_connection(KAKEI_DB).cursor()
         cursor.execute(base_query, params)
         results = cursor.fetchall()
     except sqlite3.Error as e:
         print(f"データベースエラー: {e}")
-    finally:
-        conn.close()
 
     return results
 
+def month_range(year, month):
+    """
+    指定年月の [月初, 翌月初) を 'YYYY-MM-DD' 文字列で返す（"日付" の範囲条件用）
+    """
+    start = f"{year:04d}-{month:02d}-01"
+    if month == 12:
+        end = f"{year + 1:04d}-01-01"
+    else:
+        end = f"{year:04d}-{month + 1:02d}-01"
+    return start, end
+
 @kakei_db_bp.route("/details")
 def details():
     """
@@ -220,9 +497,9 @@ def details():
     if not year or not month:
         return jsonify({"ok": False, "error": "year/month is required"}), 400
 
-    # 年・月で絞る
-    where = ['strftime("%Y", "日付") = ?', 'strftime("%m", "日付") = ?']
-    params = [f"{year:04d}", f"{month:02d}"]
+    # 年・月で絞る（索引が効くよう月初〜翌月初の範囲で指定）
+    where = ['"日付" >= ?', '"日付" < ?']
+    params = list(month_range(year, month))
 
     # 大項目・中項目の任意フィルタ
     if majors:
@@ -245,12 +522,10 @@ def details():
     """
 
     # 実行
-    conn = sqlite3.connect(KAKEI_DB)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    cur = get_connection(KAKEI_DB).cursor()
+    cur.row_factory = sqlite3.Row
     cur.execute(sql, params)
     rows = cur.fetchall()
-    conn.close()
 
     # JSON 整形（金額は数値保証）
     items = []
@@ -296,24 +571,39 @@ def drilldown():
     y = f"{year:04d}"
     m = f"{month:02d}"
 
-    base_where = ['strftime("%Y","日付")=?', 'strftime("%m","日付")=?']
-    params = [y, m]
+    # 明細は月初〜翌月初の範囲、大項目・中項目レベルは月次集計テーブルのキーで絞る
+    if level == "detail":
+        base_where = ['"日付">=?', '"日付"<?']
+        params = list(month_range(year, month))
+    else:
+        rollup_where = ['year=?', 'month=?']
+        params = [y, m]
 
     # 事前選択フィルタ（ある場合のみ適用）
     if majors_selected:
-        base_where.append('"大項目" IN ({})'.format(",".join(["?"] * len(majors_selected))))
+        placeholders = ",".join(["?"] * len(majors_selected))
+        if level == "detail":
+            base_where.append('"大項目" IN ({})'.format(placeholders))
+        else:
+            rollup_where.append('major IN ({})'.format(placeholders))
         params.extend(majors_selected)
     if minors_selected:
-        base_where.append('"中項目" IN ({})'.format(",".join(["?"] * len(minors_selected))))
+        placeholders = ",".join(["?"] * len(minors_selected))
+        if level == "detail":
+            base_where.append('"中項目" IN ({})'.format(placeholders))
+        else:
+            rollup_where.append('minor IN ({})'.format(placeholders))
         params.extend(minors_selected)
 
     # ---- レベル別のSQLを用意（どの分岐でも sql/params を必ず用意）----
+    if level in {"major", "minor"}:
+        rollup = rollup_source()
     if level == "major":
         sql = f"""
-            SELECT "大項目" AS major, SUM("金額（円）") AS amount
-            FROM kakeibo
-            WHERE {' AND '.join(base_where)}
-            GROUP BY "大項目"
+            SELECT NULLIF(major, '') AS major, SUM(total) AS amount
+            FROM {rollup}
+            WHERE {' AND '.join(rollup_where)}
+            GROUP BY major
             ORDER BY amount DESC
         """
 
@@ -321,10 +611,10 @@ def drilldown():
         if not major:
             return jsonify({"ok": False, "error": "major required"}), 400
         sql = f"""
-            SELECT "中項目" AS minor, SUM("金額（円）") AS amount
-            FROM kakeibo
-            WHERE {' AND '.join(base_where)} AND "大項目"=?
-            GROUP BY "中項目"
+            SELECT NULLIF(minor, '') AS minor, SUM(total) AS amount
+            FROM {rollup}
+            WHERE {' AND '.join(rollup_where)} AND major=?
+            GROUP BY minor
             ORDER BY amount DESC
         """
         params.append(major)
@@ -346,21 +636,14 @@ def drilldown():
         params.extend([major, minor])
 
     # ---- 実行（例外時も必ず return）----
-    conn = None
     try:
-        conn = sqlite3.connect(KAKEI_DB)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
+        cur = get_connection(KAKEI_DB).cursor()
+        cur.row_factory = sqlite3.Row
         cur.execute(sql, params)
         rows = cur.fetchall()
     except Exception as e:
-        if conn:
-            conn.close()
         # ここで必ず return
         return jsonify({"ok": False, "error": f"query failed: {e}"}), 500
-    finally:
-        if conn:
-            conn.close()
 
     # ---- 整形して返す（必ず return）----
     def to_int(v):
@@ -386,43 +669,22 @@ def drilldown():
     return jsonify({"ok": True, "level": level, "items": items, "count": len(items)})
 
 
-def clear_upload_folder():
-    for filename in os.listdir(UPLOAD_FOLDER):
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)  # ファイルを削除
-            elif os.path.isdir(file_path):
-                os.rmdir(file_path)  # サブフォルダを削除（必要なら再帰処理を追加）
-        except Exception as e:
-            flash(e, 'danger')
-            return redirect(url_for('kakei_db.index'))
-
 def save_history(input_text):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-
-    # 現在の日時をJSTで取得
-    current_time = datetime.now(jst)
-    c.execute("INSERT INTO history (timestamp, input_text) VALUES (?, ?)",
-              (current_time, input_text))
-    
-    conn.commit()
-    conn.close()
+    record('kakei_db', input_text=input_text)
 
 @kakei_db_bp.route("/history", methods=['GET', 'POST'])
 def history():
     if request.method == 'POST':
         password = request.form.get('password')
         if password == HISTORY_PASSWORD:
-            conn = sqlite3.connect(DATABASE)
-            c = conn.cursor()
-            c.execute("SELECT id, datetime(timestamp, 'localtime'), input_text FROM history ORDER BY timestamp DESC")
-            history_data = c.fetchall()
-            conn.close()
-            return render_template('kakei_db/history.html', history=history_data)
+            session['kakei_db_history'] = True
+            return redirect(url_for('kakei_db.history'))
         else:
             flash("パスワードが正しくありません", "danger")
             return redirect(url_for('kakei_db.history'))
+    if not session.get('kakei_db_history'):
+        return render_template('kakei_db/password_prompt.html')
 
-    return render_template('kakei_db/password_prompt.html')
+    # 期間指定とページ移動は common.history_store（行は id, 日時, input_text, ...）
+    page = query_history('kakei_db', request.args)
+    return render_template('kakei_db/history.html', history=page.rows, page=page, args=request.args)
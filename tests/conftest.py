@@ -0,0 +1,37 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# テストはリポジトリのコピーで動かす
+#   各Blueprintは import 時に自分のフォルダの history.db を作成・変更し、生成ファイルも自分のフォルダに置くため、
+#   作業ツリーのデータベースやファイルを書き換えないようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='my_flask_apps-test-')
+APP_DIR = os.path.join(WORKDIR, 'app')
+shutil.copytree(ROOT, APP_DIR, ignore=shutil.ignore_patterns('.git', 'tests', '__pycache__', '*.whl'))
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)  # 相対パスで指定しているフォルダ（./ai_remove_background/static/...）もコピー側を使う
+
+os.environ['HISTORY_WRITE_BEHIND'] = '0'  # 履歴はその場で書き込む
+os.environ['IMAGE_WORKERS'] = '0'         # 画像変換はプロセスを使わずその場で行う
+os.environ['JANITOR_INTERVAL'] = '0'      # 掃除のスレッドは起動しない
+
+
+def pytest_unconfigure(config):
+    os.chdir(ROOT)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app as flask_app
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,64 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# OpenAI の audio.speech（POST /v1/audio/speech）の代わりをするローカルのサーバー
+#   入力1文字あたり BYTES_PER_CHAR バイトの audio/mpeg を CHUNK_SIZE ずつ chunked で返す
+#   break_after : そのチャンク数を送ったところで接続を切る（None なら最後まで送る）
+#   delay       : チャンクごとに待つ秒数
+#   latency     : 返し始める前に入力1文字あたり待つ秒数（合成にかかる時間）
+# flask tts-bench の相手としても使える: python tests/fake_tts.py --port 8765 --latency 0.002
+BYTES_PER_CHAR = 1000
+CHUNK_SIZE = 4096
+
+
+class FakeTTS(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    break_after = None
+    delay = 0
+    latency = 0
+    inputs = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        FakeTTS.inputs.append(body['input'])
+        data = b'\xff\xfb' * (len(body['input']) * BYTES_PER_CHAR // 2)
+        time.sleep(len(body['input']) * FakeTTS.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(0, len(data), CHUNK_SIZE):
+            if FakeTTS.break_after is not None and i // CHUNK_SIZE == FakeTTS.break_after:
+                self.close_connection = True
+                return
+            chunk = data[i:i + CHUNK_SIZE]
+            self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            self.wfile.flush()
+            time.sleep(FakeTTS.delay)
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def start_server(port=0):
+    """
+    サーバーを別スレッドで起動し、(server, base_url) を返す
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeTTS)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='偽の TTS サーバー')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.002, help='1文字あたりの合成時間（秒）')
+    args = parser.parse_args()
+    FakeTTS.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeTTS)
+    print(f'http://127.0.0.1:{args.port}/v1')
+    server.serve_forever()
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import openai
+import pytest
+from PIL import Image, ImageDraw
+
+import ai_image_analysis.routes as ai
+from common.db import get_connection
+from test_ai_image_stream import DELTAS, FakeOpenAI
+
+
+def photo(path, size=(640, 480), seed=0, quality=95):
+    """
+    写真の代わりになる JPEG（なだらかなグラデーションに図形を重ねたもの）を path に保存する
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    angle = rng.uniform(0, np.pi)
+    base = (np.cos(angle) * x / width + np.sin(angle) * y / height) * 160
+    pixels = np.stack([base, base[::-1, :] * 0.8, base[:, ::-1] * 0.6], axis=-1)
+    image = Image.fromarray(np.clip(pixels + 40, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x0, y0 = rng.integers(0, width - 100), rng.integers(0, height - 100)
+        draw.ellipse((x0, y0, x0 + rng.integers(60, 200), y0 + rng.integers(60, 200)),
+                     fill=tuple(int(v) for v in rng.integers(0, 256, 3)))
+    image.save(path, 'JPEG', quality=quality)
+    return os.path.basename(path)
+
+
+def resized_copy(source, path, scale=0.5, quality=60):
+    """
+    source を縮小・再圧縮したコピーを path に保存する
+    """
+    image = Image.open(source)
+    image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS).save(path, 'JPEG',
+                                                                                            quality=quality)
+    return os.path.basename(path)
+
+
+@pytest.fixture(scope='module')
+def openai_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/v1'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def cache(openai_server, monkeypatch):
+    """
+    空の分析結果キャッシュと、ローカルの偽の OpenAI
+    """
+    monkeypatch.setattr(ai, 'client', openai.OpenAI(base_url=openai_server, api_key='test', max_retries=0),
+                        raising=False)
+    monkeypatch.setattr(FakeOpenAI, 'status', 200)
+    monkeypatch.setattr(ai, 'IMAGE_MODE', 'inline')
+    del FakeOpenAI.bodies[:]
+    os.makedirs(ai.UPLOAD_FOLDER, exist_ok=True)
+    conn = get_connection(ai.DATABASE)
+    with conn:
+        conn.execute("DELETE FROM analysis_cache")
+
+
+def analyze(image_file):
+    return ai.analyze_image(image_file, '/ai_image_analysis/static/images/' + image_file, on_delta=lambda d: None)
+
+
+def upload(name):
+    return os.path.join(ai.UPLOAD_FOLDER, name)
+
+
+def test_exact_and_near_duplicate_hits():
+    original = photo(upload('cache-original.jpg'))
+    copy = resized_copy(upload(original), upload('cache-copy.jpg'))
+    assert ai.image_hashes(upload(original))[0] != ai.image_hashes(upload(copy))[0]
+
+    text = ''.join(DELTAS)
+    assert analyze(original) == (text, 0)
+    assert analyze(original) == (text, 1)  # 同じ内容のファイル（sha256 が一致）
+    assert analyze(copy) == (text, 2)      # 縮小・再圧縮したもの（知覚ハッシュが近い）
+    assert len(FakeOpenAI.bodies) == 1
+
+    # 別の写真は分析し直す
+    other = photo(upload('cache-other.jpg'), seed=1)
+    assert analyze(other) == (text, 0)
+    assert len(FakeOpenAI.bodies) == 2
+
+
+def test_near_duplicate_uses_band_index():
+    plans = []
+    conn = get_connection(ai.DATABASE)
+    conn.set_trace_callback(plans.append)
+    try:
+        ai.lookup_analysis('0' * 64, 12345)
+    finally:
+        conn.set_trace_callback(None)
+    query = next(sql for sql in plans if 'phash' in sql and sql.startswith('SELECT'))
+
+    plan = ' '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query))
+
+    assert 'MULTI-INDEX OR' in plan
+    for i in range(ai.PHASH_BANDS):
+        assert f'idx_analysis_cache_band{i}' in plan
+
+
+def test_phash_bands_find_every_near_hash():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        phash = int(rng.integers(-(1 << 63), (1 << 63) - 1))
+        flipped = phash
+        for bit in rng.choice(64, ai.PHASH_BANDS - 1, replace=False):
+            flipped ^= 1 << int(bit)
+        flipped = flipped - (1 << 64) if flipped >= (1 << 63) else flipped
+        # 距離が PHASH_BANDS - 1 以下ならどれかの帯が一致する
+        assert any(a == b for a, b in zip(ai.phash_bands(phash), ai.phash_bands(flipped)))
+
+
+def test_expired_entries_are_not_used():
+    original = photo(upload('cache-expired.jpg'), seed=2)
+    analyze(original)
+    conn = get_connection(ai.DATABASE)
+    with conn:
+        conn.execute("UPDATE analysis_cache SET created_at = ?", (time.time() - ai.ANALYSIS_CACHE_TTL - 60,))
+
+    assert analyze(original)[1] == 0
+    assert len(FakeOpenAI.bodies) == 2
+    # 新しく入れた時に期限切れの行は消える
+    assert conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0] == 1
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(ai, 'ANALYSIS_CACHE_MAX_ENTRIES', 2)
+    images = [photo(upload(f'cache-lru{i}.jpg'), seed=10 + i) for i in range(3)]
+    analyze(images[0])
+    analyze(images[1])
+    time.sleep(0.01)
+    assert analyze(images[0])[1] == 1  # images[0] を使ったので images[1] が最も古い
+    analyze(images[2])
+
+    assert len(FakeOpenAI.bodies) == 3
+    assert analyze(images[0])[1] == 1
+    assert analyze(images[2])[1] == 1
+    assert analyze(images[1])[1] == 0
+    assert len(FakeOpenAI.bodies) == 4
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+import ai_image_analysis.routes as ai
+from common.history_store import query_history
+
+# OpenAI の chat.completions（stream=True）の代わりをするローカルのサーバー
+DELTAS = ['この写真には', '木道と', '草原が', '写っています。']
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    status = 200
+    bodies = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        FakeOpenAI.bodies.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        if FakeOpenAI.status != 200:
+            body = json.dumps({'error': {'message': 'server error', 'type': 'server_error'}}).encode()
+            self.send_response(FakeOpenAI.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for delta in DELTAS:
+            chunk = {'id': 'chatcmpl-test', 'object': 'chat.completion.chunk', 'created': 0,
+                     'model': ai.ANALYSIS_MODEL,
+                     'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(0.05)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+@pytest.fixture(scope='module')
+def openai_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/v1'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fake_client(openai_server, monkeypatch):
+    monkeypatch.setattr(ai, 'client', openai.OpenAI(base_url=openai_server, api_key='test', max_retries=0),
+                        raising=False)
+    monkeypatch.setattr(ai.tasks_resume, 'done', True)
+    monkeypatch.setattr(FakeOpenAI, 'status', 200)
+    del FakeOpenAI.bodies[:]
+
+
+def read_events(client, task_id):
+    """
+    SSE を最後まで読み、(delta の一覧, 最後の data) を返す
+    """
+    response = client.get(f'/ai_image_analysis/task/{task_id}/events')
+    assert response.mimetype == 'text/event-stream'
+    deltas = []
+    final = None
+    for block in response.get_data(as_text=True).split('\n\n'):
+        lines = block.split('\n')
+        if lines[0] == 'event: delta':
+            deltas.append(json.loads(lines[1][len('data: '):]))
+        elif lines[0].startswith('data: '):
+            final = json.loads(lines[0][len('data: '):])
+    return deltas, final
+
+
+def test_stream_relays_deltas_and_records_history(client):
+    image_url = 'https://example.com/stream-test.jpg'
+    task_id = ai.submit_task(None, image_url)
+
+    deltas, final = read_events(client, task_id)
+
+    text = ''.join(DELTAS)
+    assert final == {'status': 'done', 'result': text}
+    assert deltas and text.startswith(''.join(deltas))  # 終わる前から少しずつ届く
+    assert FakeOpenAI.bodies[0]['stream'] is True
+    # 生成し終わった文章が履歴に残る
+    rows = [row for row in query_history('ai_image_analysis', {}).rows if row[6].get('image_url') == image_url]
+    assert rows[0][4] == text
+
+
+def test_stream_error_is_reported(client):
+    FakeOpenAI.status = 500
+    task_id = ai.submit_task(None, 'https://example.com/stream-error.jpg')
+
+    deltas, final = read_events(client, task_id)
+
+    assert deltas == []
+    assert final['status'] == 'error'
+
+
+def test_expired_inline_image_is_not_sent(client, monkeypatch):
+    monkeypatch.setattr(ai, 'IMAGE_MODE', 'inline')
+    # 掃除で消された画像（表示用の相対URLを OpenAI に渡さない）
+    task_id = ai.submit_task('swept.jpg', '/ai_image_analysis/static/images/swept.jpg')
+
+    deltas, final = read_events(client, task_id)
+
+    assert final['status'] == 'error'
+    assert '保存期間' in final['error']
+    assert FakeOpenAI.bodies == []
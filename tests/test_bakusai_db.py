@@ -0,0 +1,113 @@
+import re
+import sqlite3
+
+import pytest
+
+from common.db import get_connection, register_database
+from common.paging import encode_cursor
+import bakusai_db.routes as bakusai
+
+# 一時フォルダに作った検索用DBで確かめる（リポジトリのDBは使わない）
+ROWS = [
+    ('sheet01', 1, '2024-01-01', '10:00', '駅前の新しいお店'),
+    ('sheet01', 2, '2024-01-01', '10:05', '新しいお店は混んでいた'),
+    ('sheet02', 1, '2024-01-02', '09:00', '昔のお店'),
+]
+
+
+@pytest.fixture
+def bakusai_db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'Bakusai_New_search.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE data (tab_sheet TEXT, id INTEGER, date TEXT, time TEXT, text TEXT)")
+    conn.executemany("INSERT INTO data VALUES (?, ?, ?, ?, ?)", ROWS)
+    conn.commit()
+    conn.close()
+    register_database(path, readonly=True)
+    monkeypatch.setattr(bakusai, 'BAKUSAI_DB', path)
+    return path
+
+
+def texts(page):
+    return sorted(row[4] for row in page.rows)
+
+
+def test_search_falls_back_to_like(bakusai_db):
+    assert not bakusai.fts_ready()
+    assert texts(bakusai.search_bakusai_db('sheet', '新しいお店')) == ['新しいお店は混んでいた', '駅前の新しいお店']
+    # 検索しただけでは索引を作らない
+    assert not bakusai.schema_has((bakusai.FTS_TABLE,) + tuple(bakusai.BAKUSAI_INDEXES))
+
+
+def test_rebuild_fts_command(bakusai_db, app):
+    result = app.test_cli_runner().invoke(args=['bakusai_db', 'rebuild-fts'])
+
+    assert '全文検索索引を作り直しました。' in result.output
+    assert bakusai.schema_has((bakusai.FTS_TABLE,) + bakusai.FTS_TRIGGERS + tuple(bakusai.BAKUSAI_INDEXES))
+    assert bakusai.fts_ready()  # 更新時刻が変わったので確かめ直す
+    page = bakusai.search_bakusai_db('sheet', '新しいお店', order='rank')
+    assert texts(page) == ['新しいお店は混んでいた', '駅前の新しいお店']
+
+
+# 日時が NULL の投稿を含むスレッド（'' として先頭に並ぶ）
+NULL_ROWS = [
+    ('nulls', 1, None, None, '投稿い'),
+    ('nulls', 2, '2024-01-01', None, '投稿は'),
+    ('nulls', 3, '2024-01-01', '10:00', '投稿に'),
+    ('nulls', 4, '2024-01-02', '09:00', '投稿ほ'),
+    ('nulls', 5, None, '08:00', '投稿ろ'),
+]
+NULL_ORDER = ['投稿い', '投稿ろ', '投稿は', '投稿に', '投稿ほ']
+
+
+@pytest.fixture
+def null_thread(bakusai_db, app):
+    conn = sqlite3.connect(bakusai_db)
+    conn.executemany("INSERT INTO data VALUES (?, ?, ?, ?, ?)", NULL_ROWS)
+    conn.commit()
+    conn.close()
+    app.test_cli_runner().invoke(args=['bakusai_db', 'rebuild-fts'])
+    return bakusai_db
+
+
+def page_texts(html):
+    return sorted((html.index(text), text) for text in NULL_ORDER if text in html)
+
+
+def test_tab_detail_pages_through_null_dates(null_thread, client):
+    texts = []
+    url = '/bakusai_db/tab/nulls?size=2'
+    while url:
+        html = client.get(url).get_data(as_text=True)
+        texts.extend(text for _, text in page_texts(html))
+        match = re.search(r'href="([^"]*after=[^"]*)"', html)
+        url = match.group(1).replace('&amp;', '&') if match else None
+
+    assert texts == NULL_ORDER
+
+    # 前へ戻る時も NULL の投稿を飛ばさない
+    html = client.get('/bakusai_db/tab/nulls?size=2&before=' + encode_cursor(['2024-01-01', '', 2]))
+    assert [text for _, text in page_texts(html.get_data(as_text=True))] == ['投稿い', '投稿ろ']
+
+
+def test_tab_detail_seeks_with_posted_index(null_thread, client):
+    statements = []
+    conn = get_connection(null_thread)
+    conn.set_trace_callback(statements.append)
+    try:
+        client.get('/bakusai_db/tab/nulls?size=2&after=' + encode_cursor(['2024-01-01', '', 2]))
+    finally:
+        conn.set_trace_callback(None)
+    query = next(sql for sql in statements if 'COALESCE' in sql)
+
+    plan = ' '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query))
+
+    assert 'idx_data_sheet_posted' in plan and '<expr>>' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_surrounding_posts_include_null_dates(null_thread):
+    cursor = get_connection(null_thread).cursor()
+    detail = cursor.execute("SELECT * FROM data WHERE tab_sheet = 'nulls' AND id = 5").fetchone()
+
+    assert [row[4] for row in bakusai.surrounding_posts(cursor, 'nulls', detail)] == NULL_ORDER
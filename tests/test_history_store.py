@@ -0,0 +1,26 @@
+import pytest
+
+from common import history_store
+from common.db import get_connection
+
+
+@pytest.fixture
+def history_row():
+    """
+    UTC 2025-01-01 15:30（日本時間では 1/2 の 0:30）の履歴を1件入れる
+    """
+    conn = get_connection(history_store.HISTORY_DB)
+    with conn:
+        row_id = conn.execute("INSERT INTO history (blueprint, timestamp, input_text) VALUES (?, ?, ?)",
+                              ('test_history', '2025-01-01 15:30:00', '日付の境目')).lastrowid
+    yield row_id
+    with conn:
+        conn.execute("DELETE FROM history WHERE id = ?", (row_id,))
+
+
+def test_display_time_matches_filter(history_row):
+    # 表示も期間指定も日本時間なので、1/2 を指定すると 1/2 の日時で表示される
+    page = history_store.query_history('test_history', {'from': '2025-01-02', 'to': '2025-01-02'})
+    assert [(row[0], row[1]) for row in page.rows] == [(history_row, '2025-01-02 00:30:00')]
+
+    assert history_store.query_history('test_history', {'from': '2025-01-01', 'to': '2025-01-01'}).rows == []
@@ -0,0 +1,36 @@
+import io
+
+import pytest
+from PIL import Image
+
+from common import images
+
+
+def jpeg_bytes(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 40)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_pillow_limit_is_kept():
+    # 読み込むだけで Pillow の画像爆弾の上限を外さない（rembg など他の Image.open も守られる）
+    assert Image.MAX_IMAGE_PIXELS is not None
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(images, 'MAX_PIXELS', 1_000_000)
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 2_000_000)
+
+
+def test_image_within_limit_is_kept(limits):
+    data = jpeg_bytes(1000, 1000)
+    assert images.convert_to_jpeg(data) == data
+
+
+# 1200x1000 と 1500x1500 は自前の上限、3000x3000 は Pillow の上限（MAX_IMAGE_PIXELS の2倍）を超える
+@pytest.mark.filterwarnings('ignore::PIL.Image.DecompressionBombWarning')
+@pytest.mark.parametrize('size', [(1200, 1000), (1500, 1500), (3000, 3000)])
+def test_oversized_images_raise_image_too_large(limits, size):
+    with pytest.raises(images.ImageTooLarge):
+        images.convert_to_jpeg(jpeg_bytes(*size))
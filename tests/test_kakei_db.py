@@ -0,0 +1,140 @@
+import sqlite3
+
+import pytest
+
+from common.db import register_database
+import kakei_db.routes as kakei
+
+# 一時フォルダに作った Kakei.db で集計を確かめる（リポジトリの Kakei.db は使わない）
+ROWS = [
+    ('2024-01-05', '定食', 1000, '食費', '外食'),
+    ('2024-01-20', 'コーヒー', 500, '食費', 'カフェ'),
+    ('2024-02-03', '洗剤', 300, '日用品', None),
+]
+
+
+def build_kakei_db(path, view=False):
+    """
+    kakeibo に ROWS を入れた Kakei.db を作る
+    view=True なら kakeibo をビューにする（トリガーも索引も作れないので移行が必ず失敗する）
+    """
+    conn = sqlite3.connect(path)
+    table = 'entries' if view else 'kakeibo'
+    conn.execute(f'CREATE TABLE {table} ("日付" TEXT, "内容" TEXT, "金額（円）" INTEGER, '
+                 '"保有金融機関" TEXT, "大項目" TEXT, "中項目" TEXT, "_locked" INTEGER)')
+    conn.executemany(f'INSERT INTO {table} ("日付", "内容", "金額（円）", "大項目", "中項目") '
+                     'VALUES (?, ?, ?, ?, ?)', ROWS)
+    if view:
+        conn.execute('CREATE VIEW kakeibo AS SELECT * FROM entries')
+    conn.commit()
+    conn.close()
+    register_database(path, readonly=True)
+    return path
+
+
+@pytest.fixture(params=['rollup', 'unmigrated', 'failed'])
+def kakei_db(request, tmp_path, monkeypatch):
+    """
+    rollup     : flask kakei_db migrate 済み
+    unmigrated : 移行していない（集計テーブルが無い）
+    failed     : 移行に失敗した
+    """
+    path = build_kakei_db(str(tmp_path / 'Kakei.db'), view=request.param == 'failed')
+    monkeypatch.setattr(kakei, 'KAKEI_DB', path)
+    if request.param == 'rollup':
+        assert kakei.migrate_kakei_db()
+    elif request.param == 'failed':
+        with pytest.raises(sqlite3.Error):
+            kakei.migrate_kakei_db()
+    # リクエストの中では移行しない
+    monkeypatch.setattr(kakei, 'migrate_kakei_db', lambda: pytest.fail('migrate_kakei_db がリクエスト中に呼ばれた'))
+    return request.param
+
+
+def test_rollup_source(kakei_db):
+    expected = kakei.ROLLUP_TABLE if kakei_db == 'rollup' else kakei.ROLLUP_FALLBACK
+    assert kakei.rollup_source() == expected
+    assert kakei.rollup_source() == expected
+
+
+def test_migrate_command(tmp_path, monkeypatch, app):
+    path = build_kakei_db(str(tmp_path / 'Kakei.db'))
+    monkeypatch.setattr(kakei, 'KAKEI_DB', path)
+    runner = app.test_cli_runner()
+    assert kakei.rollup_source() == kakei.ROLLUP_FALLBACK
+
+    assert 'Kakei.dbを移行しました。' in runner.invoke(args=['kakei_db', 'migrate']).output
+    assert 'Kakei.dbは移行済みです。' in runner.invoke(args=['kakei_db', 'migrate']).output
+    assert kakei.rollup_source() == kakei.ROLLUP_TABLE  # 更新時刻が変わったので確かめ直す
+
+
+def test_search_totals(kakei_db):
+    assert kakei.search_kakei_db('all') == [('2024', '01', 1500), ('2024', '02', 300)]
+    assert kakei.search_kakei_db('same_month_past', same_month='01', categories=['食費']) == [('2024', '01', 1500)]
+
+
+def test_drilldown(kakei_db, client):
+    response = client.get('/kakei_db/drilldown?year=2024&month=1&level=minor&major=食費')
+
+    assert response.status_code == 200
+    assert response.get_json()['items'] == [{'minor': '外食', 'amount': 1000}, {'minor': 'カフェ', 'amount': 500}]
+
+
+@pytest.fixture
+def kakei_plans(tmp_path, monkeypatch):
+    """
+    Kakei.db に対して実行された SELECT を記録し、[(SQL, EXPLAIN QUERY PLAN の detail 一覧)] を返す関数を渡す
+    """
+    path = build_kakei_db(str(tmp_path / 'Kakei.db'))
+    monkeypatch.setattr(kakei, 'KAKEI_DB', path)
+    assert kakei.migrate_kakei_db()
+    conn = kakei.get_connection(path)
+    statements = []
+    conn.set_trace_callback(statements.append)
+
+    def plans():
+        conn.set_trace_callback(None)
+        selects = [sql for sql in statements if sql.lstrip().upper().startswith('SELECT')]
+        return [(sql, [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]) for sql in selects]
+
+    yield plans
+    conn.set_trace_callback(None)
+
+
+def assert_search(plans, table, index):
+    """
+    table を読むところがすべて index での SEARCH になっている（SCAN が無い）ことを確かめる
+    """
+    used = [detail for sql, details in plans for detail in details if f' {table} ' in f'{detail} ']
+    assert used, plans
+    for detail in used:
+        assert detail.startswith(f'SEARCH {table} USING '), detail
+        assert index in detail, detail
+
+
+@pytest.mark.parametrize('query, index', [
+    ('year=2024&month=1', 'idx_kakeibo_date'),
+    ('year=2024&month=1&major=食費&minor=外食', 'idx_kakeibo_major_minor_date'),
+])
+def test_details_uses_index(kakei_plans, client, query, index):
+    assert client.get(f'/kakei_db/details?{query}').status_code == 200
+    assert_search(kakei_plans(), 'kakeibo', index)
+
+
+def test_drilldown_detail_uses_index(kakei_plans, client):
+    response = client.get('/kakei_db/drilldown?year=2024&month=1&level=detail&major=食費&minor=外食')
+
+    assert response.status_code == 200
+    assert_search(kakei_plans(), 'kakeibo', 'idx_kakeibo_major_minor_date')
+
+
+def test_search_current_month_uses_index(kakei_plans):
+    kakei.search_kakei_db('past_1_year')
+    plans = kakei_plans()
+    assert_search(plans, 'kakeibo', 'idx_kakeibo_date')
+    assert_search(plans, 'kakeibo_monthly', 'kakeibo_monthly')
+
+
+def test_search_same_month_uses_month_index(kakei_plans):
+    kakei.search_kakei_db('same_month_past', same_month='01')
+    assert_search(kakei_plans(), 'kakeibo_monthly', 'idx_kakeibo_monthly_month')
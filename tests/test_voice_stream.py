@@ -0,0 +1,161 @@
+import glob
+import os
+import threading
+
+import openai
+import pytest
+
+import ai_voice_synthesis.routes as voice
+from common.db import register_database
+from common.history_store import query_history
+from common.workers import WorkerPool
+from fake_tts import BYTES_PER_CHAR, CHUNK_SIZE, FakeTTS, start_server
+
+
+@pytest.fixture(scope='module')
+def tts_server():
+    server, base_url = start_server()
+    yield base_url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def tts(tts_server, monkeypatch):
+    monkeypatch.setattr(voice, 'client', openai.OpenAI(base_url=tts_server, api_key='test', max_retries=0),
+                        raising=False)
+    monkeypatch.setattr(voice, 'STREAM_CHUNK_SIZE', CHUNK_SIZE)
+    monkeypatch.setattr(FakeTTS, 'break_after', None)
+    monkeypatch.setattr(FakeTTS, 'delay', 0)
+    del FakeTTS.inputs[:]
+
+
+def submit(client, text):
+    """
+    フォームから送信し、/stream の URL とキャッシュのキーを返す
+    """
+    response = client.post('/ai_voice_synthesis/', data={'text': text, 'voice_gender': 'male'})
+    assert response.status_code == 302
+    cache_key = voice.tts_cache_key(text, 'alloy')
+    return f'/ai_voice_synthesis/stream/{cache_key}', cache_key
+
+
+def part_files(cache_key):
+    return glob.glob(voice.cache_path(cache_key) + '.*.part')
+
+
+def history_rows(text):
+    """
+    text の履歴の (file, cache_hit) の一覧
+    """
+    return [(row[3], row[5]) for row in query_history('ai_voice_synthesis', {}).rows if row[2] == text]
+
+
+def test_stream_then_replay_from_cache(client):
+    text = 'ストリームのテストです'
+    url, cache_key = submit(client, text)
+    assert history_rows(text) == []  # 音声ができるまでは履歴に残さない
+
+    body = client.get(url).get_data()
+
+    assert len(body) == len(text) * BYTES_PER_CHAR
+    assert voice.cache_lookup(cache_key) == f'cache/{cache_key}.mp3'
+    assert voice.get_pending(cache_key) is None
+    assert part_files(cache_key) == []
+    assert history_rows(text) == [(f'cache/{cache_key}.mp3', 0)]
+
+    # 2回目はファイルから返す（API は呼ばない。Range にも答える）
+    replay = client.get(url)
+    assert replay.get_data() == body
+    partial = client.get(url, headers={'Range': 'bytes=0-99'})
+    assert partial.status_code == 206 and partial.get_data() == body[:100]
+    assert FakeTTS.inputs == [text]
+
+
+def test_upstream_break_is_not_cached(client):
+    FakeTTS.break_after = 2
+    text = '途中で切れる音声です'
+    url, cache_key = submit(client, text)
+
+    body = client.get(url).get_data()
+
+    assert len(body) == 2 * CHUNK_SIZE
+    assert voice.cache_lookup(cache_key) is None
+    assert not os.path.exists(voice.cache_path(cache_key))
+    assert part_files(cache_key) == []
+    assert history_rows(text) == []
+
+    # 次の再生でやり直せる
+    FakeTTS.break_after = None
+    assert len(client.get(url).get_data()) == len(text) * BYTES_PER_CHAR
+    assert FakeTTS.inputs == [text, text]
+
+
+def test_client_disconnect_is_not_cached(client):
+    url, cache_key = submit(client, '聞き手が途中でやめる音声です')
+
+    response = client.get(url, buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    assert len(part_files(cache_key)) == 1  # 書き込み中
+    response.close()
+
+    assert voice.cache_lookup(cache_key) is None
+    assert not os.path.exists(voice.cache_path(cache_key))
+    assert part_files(cache_key) == []
+    assert voice.claim_pending(cache_key)  # 行は戻されている
+
+
+def test_concurrent_streams_call_api_once(app, client):
+    FakeTTS.delay = 0.05
+    text = '同時に再生される音声です'
+    url, cache_key = submit(client, text)
+    bodies = []
+
+    def play():
+        bodies.append(app.test_client().get(url).get_data())
+
+    threads = [threading.Thread(target=play) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 後から来たリクエストは書き終えるのを待ってキャッシュから返す
+    assert FakeTTS.inputs == [text]
+    assert [len(body) for body in bodies] == [len(text) * BYTES_PER_CHAR] * 2
+    assert sorted(history_rows(text)) == [(f'cache/{cache_key}.mp3', 0), (f'cache/{cache_key}.mp3', 1)]
+
+
+def test_concurrent_stream_gives_up_after_wait(client, monkeypatch):
+    monkeypatch.setattr(voice, 'STREAM_WAIT', 0)
+    url, cache_key = submit(client, '合成中の音声です')
+    assert voice.claim_pending(cache_key)  # 別のリクエストが合成中
+
+    response = client.get(url)
+
+    assert response.status_code == 409
+    assert FakeTTS.inputs == []
+
+
+def test_chunked_audio_uses_given_cache_and_client(tmp_path, tts_server):
+    database = str(tmp_path / 'history.db')
+    register_database(database)
+    cache = voice.AudioCache(str(tmp_path), database, voice.CACHE_MAX_BYTES)
+    cache.init_db()
+    tts_client = openai.OpenAI(base_url=tts_server, api_key='test', max_retries=0)
+    pool = WorkerPool(2, 'tts-test')
+    text = '一文目です。二文目です。一文目です。'
+
+    try:
+        body = b''.join(voice.chunked_audio(text, 'alloy', tts_client, cache, pool))
+    finally:
+        pool.shutdown()
+
+    # 同じ文は1回だけ合成し、渡したキャッシュに置く（このアプリのキャッシュには置かない）
+    assert len(body) == len('一文目です。二文目です。一文目です。') * BYTES_PER_CHAR
+    assert sorted(FakeTTS.inputs) == ['一文目です。', '二文目です。']
+    for sentence in ('一文目です。', '二文目です。'):
+        cache_key = voice.tts_cache_key(sentence, 'alloy')
+        assert cache.lookup(cache_key) == f'cache/{cache_key}.mp3'
+        assert voice.cache_lookup(cache_key) is None
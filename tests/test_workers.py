@@ -0,0 +1,42 @@
+from flask import Blueprint, Flask
+
+from common.workers import WorkerPool, resume_once
+
+
+def make_app(calls, done=False):
+    bp = Blueprint('resume_test', __name__)
+    hook = resume_once(bp, lambda: calls.append('resumed'))
+    hook.done = done
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    app.add_url_rule('/', 'ping', lambda: 'ok')
+    return app
+
+
+def test_resume_runs_before_first_request_only():
+    calls = []
+    client = make_app(calls).test_client()
+
+    assert calls == []  # 登録しただけ（CLIなど）では再開しない
+    client.get('/')
+    client.get('/')
+    assert calls == ['resumed']
+
+
+def test_resume_can_be_skipped():
+    calls = []
+    make_app(calls, done=True).test_client().get('/')
+    assert calls == []
+
+
+def test_pool_is_recreated_after_shutdown():
+    pool = WorkerPool(2, 'test')
+    first = pool.get()
+    assert pool.submit(lambda: 1 + 1).result() == 2
+    assert pool.get() is first
+
+    pool.shutdown()
+    pool.max_workers = 3
+    assert pool.get() is not first
+    assert pool.get()._max_workers == 3
+    pool.shutdown()
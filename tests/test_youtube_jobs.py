@@ -0,0 +1,248 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import youtube_to_mpeg.routes as youtube
+
+
+class FakeDownloader:
+    """
+    ytdlp_download の代わり（ネットワークに出ず、出力テンプレの場所にファイルを作る）
+    """
+    def __init__(self, error=None, delay=0.0):
+        self.error = error
+        self.delay = delay
+        self.calls = []
+        self.infos = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url, outtmpl, mode='mp4', progress_hook=None, postprocessor_hook=None,
+                 info=None, profile=None, timings=None):
+        with self.lock:
+            self.calls.append(url)
+            self.infos.append(info)
+        time.sleep(self.delay)
+        if progress_hook:
+            progress_hook({'status': 'downloading', 'downloaded_bytes': 50, 'total_bytes': 100})
+        path = outtmpl.replace('%(title)s', 'video').replace('%(ext)s', mode)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.error:
+            with open(path + '.part', 'wb') as f:  # 途中まで書いてから失敗する
+                f.write(b'partial')
+            raise self.error
+        with open(path, 'wb') as f:
+            f.write(b'data')
+        if progress_hook:
+            progress_hook({'status': 'finished'})
+        if timings is not None:
+            timings['download'] = 0.01
+        return path
+
+
+@pytest.fixture(autouse=True)
+def no_resume(monkeypatch):
+    # テスト用のクライアントのリクエストで古いジョブを再開しない
+    monkeypatch.setattr(youtube.jobs_resume, 'done', True)
+
+
+def wait_for(job_id, statuses=('done', 'error'), timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = youtube.get_job(job_id)
+        if job and job['status'] in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"ジョブが終わりません: {youtube.get_job(job_id)}")
+
+
+def insert_job(url, status, updated_at):
+    job_id = os.urandom(16).hex()
+    conn = youtube.get_connection(youtube.DATABASE)
+    with conn:
+        conn.execute("INSERT INTO jobs (id, created_at, updated_at, url, mode, profile, status, progress, message) "
+                     "VALUES (?, ?, ?, ?, 'mp3', ?, ?, 0, '')",
+                     (job_id, updated_at, updated_at, url, youtube.DEFAULT_PROFILE, status))
+    return job_id
+
+
+def test_submit_status_done(monkeypatch, client):
+    fake = FakeDownloader()
+    monkeypatch.setattr(youtube, 'downloader', fake)
+
+    job_id = youtube.submit_job('https://example.com/clip', 'mp3')
+    job = wait_for(job_id)
+
+    assert job['status'] == 'done'
+    assert fake.calls == ['https://example.com/clip']
+    status = client.get(f'/youtube_to_mpeg/job/{job_id}/status').get_json()
+    assert status['status'] == 'done'
+    assert status['progress'] == 100
+    assert status['result_url'].endswith('/result/video.mp3')
+
+
+def test_failure_sets_error(monkeypatch, client):
+    monkeypatch.setattr(youtube, 'downloader', FakeDownloader(error=RuntimeError('boom')))
+
+    job_id = youtube.submit_job('https://example.com/broken', 'mp3')
+    job = wait_for(job_id)
+
+    assert job['status'] == 'error'
+    assert 'boom' in job['message']
+    status = client.get(f'/youtube_to_mpeg/job/{job_id}/status').get_json()
+    assert status['status'] == 'error'
+    assert status['result_url'] is None
+
+
+def test_resume_takes_over_each_job_once(monkeypatch):
+    fake = FakeDownloader(delay=0.2)
+    monkeypatch.setattr(youtube, 'downloader', fake)
+    now = datetime.now(youtube.jst)
+    stale = now - timedelta(seconds=youtube.JOB_STALE_SECONDS + 60)
+    queued = insert_job('https://example.com/queued', 'queued', now)
+    interrupted = insert_job('https://example.com/interrupted', 'running', stale)
+    alive = insert_job('https://example.com/alive', 'running', now)
+
+    # 2つのプロセスが同時に再開しても、1件のジョブは1回だけ実行される
+    youtube.resume_jobs()
+    youtube.resume_jobs()
+
+    assert wait_for(queued)['status'] == 'done'
+    assert wait_for(interrupted)['status'] == 'done'
+    assert sorted(fake.calls) == ['https://example.com/interrupted', 'https://example.com/queued']
+    # 更新が続いている実行中のジョブは他のワーカーのものなので触らない
+    assert youtube.get_job(alive)['status'] == 'running'
+
+
+def make_cache_folder(name, age):
+    folder = os.path.join(youtube.CACHE_FOLDER, name)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'video.mp4.part')
+    with open(path, 'wb') as f:
+        f.write(b'partial')
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    os.utime(folder, (mtime, mtime))
+    return folder
+
+
+def test_failed_download_removes_partial_cache(monkeypatch):
+    monkeypatch.setattr(youtube, 'downloader', FakeDownloader(error=RuntimeError('killed')))
+    url = 'https://www.youtube.com/watch?v=partial0001'
+    folder = os.path.join(youtube.CACHE_FOLDER, youtube.video_key(url, 'mp4'))
+
+    job_id = youtube.submit_job(url, 'mp4')
+    job = wait_for(job_id)
+
+    assert job['status'] == 'error'
+    assert not os.path.exists(folder)
+    assert not os.path.exists(youtube.job_folder(youtube.video_key(url, 'mp4'), job_id))
+
+
+class BlockingDownloader(FakeDownloader):
+    """
+    途中まで書いたところで release されるまで待つ
+    """
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, url, outtmpl, mode='mp4', **kwargs):
+        path = outtmpl.replace('%(title)s', 'video').replace('%(ext)s', mode) + '.part'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'partial')
+        self.started.set()
+        self.release.wait(5)
+        os.unlink(path)
+        return super().__call__(url, outtmpl, mode=mode, **kwargs)
+
+
+def test_failed_job_keeps_concurrent_download(monkeypatch):
+    blocking = BlockingDownloader()
+    downloaders = iter([blocking, FakeDownloader(error=RuntimeError('killed'))])
+    monkeypatch.setattr(youtube, 'downloader', lambda *args, **kwargs: next(downloaders)(*args, **kwargs))
+    url = 'https://www.youtube.com/watch?v=samekey0001'
+
+    first = youtube.submit_job(url, 'mp4')
+    assert blocking.started.wait(5)
+    # 同じ動画の2つ目のジョブが失敗しても、書き込み中の1つ目のファイルは消さない
+    assert wait_for(youtube.submit_job(url, 'mp4'))['status'] == 'error'
+    blocking.release.set()
+    job = wait_for(first)
+
+    assert job['status'] == 'done'
+    assert youtube.cache_lookup(youtube.video_key(url, 'mp4')) == job['filename']
+
+
+def test_second_finished_job_uses_first_cache():
+    cache_key = youtube.video_key('https://www.youtube.com/watch?v=samekey0002', 'mp4')
+    paths = []
+    for job_id in ('first', 'second'):
+        folder = youtube.job_folder(cache_key, job_id)
+        os.makedirs(folder)
+        path = os.path.join(folder, 'video.mp4')
+        with open(path, 'wb') as f:
+            f.write(job_id.encode())
+        paths.append(youtube.move_into_cache(folder, cache_key, path))
+
+    assert paths[0] == paths[1] == os.path.join(youtube.CACHE_FOLDER, cache_key, 'video.mp4')
+    assert not os.path.exists(youtube.job_folder(cache_key, 'second'))
+
+
+def test_prune_jobs_removes_old_finished_rows():
+    old = datetime.now(youtube.jst) - timedelta(seconds=youtube.JOB_TTL + 60)
+    old_done = insert_job('https://example.com/old-done', 'done', old)
+    old_error = insert_job('https://example.com/old-error', 'error', old)
+    old_running = insert_job('https://example.com/old-running', 'running', old)
+    recent = insert_job('https://example.com/recent', 'done', datetime.now(youtube.jst))
+
+    assert youtube.prune_jobs() >= 2
+
+    assert youtube.get_job(old_done) is None
+    assert youtube.get_job(old_error) is None
+    assert youtube.get_job(old_running)
+    assert youtube.get_job(recent)
+
+
+def test_sweep_orphans_keeps_cached_recent_and_active(monkeypatch):
+    monkeypatch.setattr(youtube, 'downloader', FakeDownloader())
+    cached_url = 'https://www.youtube.com/watch?v=cached00001'
+    assert wait_for(youtube.submit_job(cached_url, 'mp4'))['status'] == 'done'
+    cached = os.path.join(youtube.CACHE_FOLDER, youtube.video_key(cached_url, 'mp4'))
+    old_orphan = make_cache_folder('youtube-orphan00001-mp4-polite', age=youtube.CACHE_ORPHAN_GRACE + 60)
+    new_orphan = make_cache_folder('youtube-orphan00002-mp4-polite', age=0)
+    active_url = 'https://www.youtube.com/watch?v=active00001'
+    active = make_cache_folder(youtube.video_key(active_url, 'mp3'), age=youtube.CACHE_ORPHAN_GRACE + 60)
+    insert_job(active_url, 'running', datetime.now(youtube.jst))
+
+    youtube.sweep_orphans()
+
+    assert not os.path.exists(old_orphan)
+    assert os.path.isdir(new_orphan)
+    assert os.path.isdir(active)
+    assert os.path.isdir(cached)
+
+
+@pytest.mark.parametrize('profile', sorted(youtube.YTDLP_PROFILES))
+def test_mp3_is_always_mp3(profile):
+    opts = youtube.ytdlp_profile_opts(profile, 'mp3')
+
+    assert [pp['preferredcodec'] for pp in opts['postprocessors']] == ['mp3']
+
+
+def test_m4a_cached_as_mp3_is_not_used(monkeypatch):
+    url = 'https://www.youtube.com/watch?v=oldm4a00001'
+    cache_key = youtube.video_key(url, 'mp3', 'fast')
+    folder = os.path.join(youtube.CACHE_FOLDER, cache_key)
+    os.makedirs(folder)
+    path = os.path.join(folder, 'video.m4a')
+    with open(path, 'wb') as f:
+        f.write(b'data')
+    youtube.cache_store(cache_key, path)
+
+    assert youtube.cache_lookup(cache_key) is None
+    assert not os.path.exists(folder)
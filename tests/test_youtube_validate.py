@@ -0,0 +1,109 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import youtube_to_mpeg.routes as youtube
+from test_youtube_jobs import FakeDownloader, wait_for
+
+# validate_url の確認先になるローカルのサーバー（外部には通信しない）
+#   /clip.mp4 : 動画ファイル（HEAD も GET も 200）
+#   /missing  : 404、/gone : 410
+#   /no-head  : HEAD を受け付けないサイト（405）
+CLIP = b'\x00\x00\x00\x18ftypmp42' + b'\x00' * 1000
+
+
+class FakeSite(BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, body):
+        FakeSite.requests.append((self.command, self.path))
+        status = {'/clip.mp4': 200, '/missing': 404, '/gone': 410, '/no-head': 405}.get(self.path, 404)
+        if self.command == 'GET' and self.path == '/no-head':
+            status = 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4' if self.path == '/clip.mp4' else 'text/html')
+        self.send_header('Content-Length', str(len(CLIP)))
+        self.end_headers()
+        if body:
+            self.wfile.write(CLIP)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+
+@pytest.fixture(scope='module')
+def site():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSite)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def clear_requests(monkeypatch):
+    monkeypatch.setattr(youtube.jobs_resume, 'done', True)
+    del FakeSite.requests[:]
+
+
+@pytest.mark.parametrize('path, valid', [
+    ('/clip.mp4', True),
+    ('/no-head', True),
+    ('/missing', False),
+    ('/gone', False),
+])
+def test_head_mode(site, monkeypatch, path, valid):
+    monkeypatch.setattr(youtube, 'VALIDATE_MODE', 'head')
+
+    assert youtube.validate_url(site + path) is valid
+    assert FakeSite.requests == [('HEAD', path)]  # 通信は HEAD 1回だけ
+
+
+def test_youtube_url_is_checked_locally(site, monkeypatch):
+    monkeypatch.setattr(youtube, 'VALIDATE_MODE', 'head')
+
+    assert youtube.validate_url('https://youtu.be/abcdefghijk')
+    assert not youtube.validate_url('ftp://example.com/clip.mp4')
+    assert FakeSite.requests == []
+
+
+def test_index_rejects_missing_page(site, monkeypatch, client):
+    monkeypatch.setattr(youtube, 'VALIDATE_MODE', 'head')
+    fake = FakeDownloader()
+    monkeypatch.setattr(youtube, 'downloader', fake)
+
+    response = client.post('/youtube_to_mpeg/', data={'text': site + '/missing', 'format': 'mp4'})
+
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/youtube_to_mpeg/')
+    assert fake.calls == []
+
+
+def test_metadata_mode_rejects_missing_page(site, monkeypatch):
+    monkeypatch.setattr(youtube, 'VALIDATE_MODE', 'metadata')
+
+    assert not youtube.validate_url(site + '/missing')
+    assert youtube.take_metadata(site + '/missing') is None
+
+
+def test_metadata_is_reused_by_download(site, monkeypatch):
+    monkeypatch.setattr(youtube, 'VALIDATE_MODE', 'metadata')
+    fake = FakeDownloader()
+    monkeypatch.setattr(youtube, 'downloader', fake)
+    url = site + '/clip.mp4'
+
+    assert youtube.validate_url(url)
+    requests = len(FakeSite.requests)
+    job = wait_for(youtube.submit_job(url, 'mp4'))
+
+    assert job['status'] == 'done'
+    assert fake.infos[0]['webpage_url'] == url  # 事前確認で取った情報がダウンロードに渡る
+    assert len(FakeSite.requests) == requests
+    assert youtube.take_metadata(url) is None  # 1回使ったら捨てる
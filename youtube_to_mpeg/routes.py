@@ -1,9 +1,19 @@
-from flask import request, render_template, redirect, url_for, flash, jsonify
+from flask import request, render_template, redirect, url_for, flash, jsonify, session
 import os
 import uuid
 import sqlite3
+import threading
+import time
+import shutil
 import pytz
 from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from werkzeug.utils import safe_join
+from common.db import register_database, get_connection
+from common.history_store import record, register_legacy, query_history, cache_counts
+from common.janitor import register_folder, register_task
+from common.media import send_media
+from common.workers import WorkerPool, resume_once
 from .forms import YoutubeToMpegForm
 from . import youtube_to_mpeg_bp  # Blueprintをインポート
 # from pytubefix import YouTube
@@ -16,9 +26,21 @@ import urllib.request, urllib.error
 UPLOAD_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'static/video')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# ダウンロード済みファイルのキャッシュ（動画ID・形式ごとに cache/<キー>/ に置く）
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache')
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+CACHE_MAX_BYTES = int(os.environ.get("YTDLP_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))  # 合計サイズの上限
+CACHE_TTL = int(os.environ.get("YTDLP_CACHE_TTL", str(7 * 24 * 3600)))             # 保持期間（秒）
+CACHE_ORPHAN_GRACE = 600  # 台帳に無いフォルダも、これより新しいものは書き込み中とみなして残す（秒）
+
+# キャッシュ以外の古いファイルは common.janitor が消す（書き込み中のファイルは更新時刻が新しいので残る）
+register_folder(UPLOAD_FOLDER, max_age=3600, max_bytes=5 * 1024 ** 3, exclude=('cache',))
+
 # データベースのパスを指定
 DATABASE = os.path.join(os.path.dirname(__file__), 'history.db')
 
+register_database(DATABASE)
+
 # 認証に使用するパスワード
 HISTORY_PASSWORD = os.environ.get("HISTORY_PASSWORD", "Canon-01")
 
@@ -27,18 +49,57 @@ jst = pytz.timezone('Asia/Tokyo')
 
 # データベースの初期化
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS history
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                  input_text TEXT,
-                  video_file TEXT)''')
-    conn.commit()
-    conn.close()
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                      input_text TEXT,
+                      video_file TEXT)''')
+        # ダウンロードジョブ（再起動しても残るようDBに保存）
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                     (id TEXT PRIMARY KEY,
+                      created_at DATETIME,
+                      updated_at DATETIME,
+                      url TEXT,
+                      mode TEXT,
+                      status TEXT,
+                      progress REAL DEFAULT 0,
+                      message TEXT,
+                      filename TEXT)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+        # ダウンロードキャッシュの台帳（filename は UPLOAD_FOLDER からの相対パス）
+        conn.execute('''CREATE TABLE IF NOT EXISTS download_cache
+                     (cache_key TEXT PRIMARY KEY,
+                      filename TEXT,
+                      size INTEGER,
+                      created_at REAL,
+                      last_access REAL)''')
+        # 履歴にキャッシュのヒット(1)/ミス(0)を記録する列を追加
+        # プロファイルと処理段階ごとの所要時間（秒）も記録してプロファイル同士を比べられるようにする
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+        for column, column_type in [('cache_hit', 'INTEGER'), ('profile', 'TEXT'), ('download_seconds', 'REAL'),
+                                    ('merge_seconds', 'REAL'), ('transcode_seconds', 'REAL')]:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE history ADD COLUMN {column} {column_type}")
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if 'profile' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN profile TEXT")
 
 init_db()
 
+register_legacy('youtube_to_mpeg', DATABASE,
+                "SELECT id, timestamp, input_text, video_file, NULL, cache_hit, "
+                "profile, download_seconds, merge_seconds, transcode_seconds FROM history",
+                detail=('profile', 'download_seconds', 'merge_seconds', 'transcode_seconds'))
+
+# ダウンロードジョブの設定
+JOB_WORKERS = int(os.environ.get("YTDLP_WORKERS", "2"))  # 同時に実行するダウンロード数
+JOB_HEARTBEAT = 30        # 実行中ジョブの updated_at を更新する間隔（秒）
+JOB_STALE_SECONDS = 120   # これより長く更新が無い実行中ジョブは中断されたとみなす
+PROGRESS_INTERVAL = 0.5   # 進捗をDBに書く最短間隔（秒）
+JOB_TTL = int(os.environ.get("YTDLP_JOB_TTL", str(7 * 24 * 3600)))  # 終わったジョブの行を残す期間（秒）
+
 # 既存:
 # def ytdlp_download(url: str, outtmpl: str, mode: str = "mp4") -> str:
 #     if mode == "mp3":
@@ -48,17 +109,58 @@ init_db()
 #     with YoutubeDL(ydl_opts) as ydl: ...
 
 # 置き換え（共通オプションをまとめ、Cookie/IPv4/UA等を追加）
-def ytdlp_download(url: str, outtmpl: str, mode: str = "mp4") -> str:
+# URLの事前確認（YouTubeの動画IDはローカルで判定し、それ以外は1回だけ通信する）
+#   head     : タイムアウト付きの HEAD リクエスト
+#   metadata : yt-dlp の extract_info(download=False)。結果はダウンロード時に使い回す
+VALIDATE_MODE = os.environ.get("YTDLP_VALIDATE", "head")
+VALIDATE_TIMEOUT = float(os.environ.get("YTDLP_VALIDATE_TIMEOUT", "5"))
+METADATA_TTL = 600        # 取得したメタデータを使い回す時間（秒）
+METADATA_MAX_ENTRIES = 64
+
+_metadata_cache = {}      # url -> (取得時刻, info)
+_metadata_lock = threading.Lock()
+
+# yt-dlp の性能プロファイル（フォームまたは環境変数 YTDLP_PROFILE で選ぶ）
+#   fragments         : 断片の同時ダウンロード数
+#   external          : 外部ダウンローダ（インストールされていれば使う）
+#   sleep / ratelimit : アクセス間隔と低速判定のしきい値（YouTube側に優しくする）
+#   copy              : 元の形式のまま使えるものを優先して再エンコードを省く（mp4 は mp4+m4a、mp3 は元が mp3 の音声）
+#   ffmpeg_threads    : FFmpeg のスレッド数（0 は FFmpeg 任せ）
+#   audio_quality     : mp3 変換時の品質（0 が最高）
+YTDLP_PROFILES = {
+    "polite": {  # 従来の設定
+        "label": "標準（穏やか）",
+        "fragments": 4, "external": None, "sleep": (1, 2), "ratelimit": 1_000_000,
+        "copy": False, "ffmpeg_threads": 0, "audio_quality": "0",
+    },
+    "fast": {
+        "label": "高速",
+        "fragments": 8, "external": "aria2c", "sleep": None, "ratelimit": None,
+        "copy": True, "ffmpeg_threads": 0, "audio_quality": "0",
+    },
+    "audio-only-lowcost": {
+        "label": "低負荷（mp3 は音質を下げて変換）",
+        "fragments": 2, "external": None, "sleep": (1, 2), "ratelimit": 1_000_000,
+        "copy": True, "ffmpeg_threads": 1, "audio_quality": "5",
+    },
+}
+DEFAULT_PROFILE = os.environ.get("YTDLP_PROFILE", "polite")
+if DEFAULT_PROFILE not in YTDLP_PROFILES:
+    DEFAULT_PROFILE = "polite"
+
+# 後処理の名前と記録する段階の対応
+PP_STAGES = {"Merger": "merge", "ExtractAudio": "transcode", "VideoConvertor": "transcode",
+             "VideoRemuxer": "transcode"}
+
+def ytdlp_common_opts() -> dict:
     # 1) cookies.txt の場所（環境変数 > 同階層）
     cookie_path = os.environ.get("YTDLP_COOKIES") or os.path.join(os.path.dirname(__file__), "cookies.txt")
     use_cookie = os.path.exists(cookie_path)
 
     common_opts = {
-        "outtmpl": outtmpl,
         "noplaylist": True,
         "retries": 10,
         "fragment_retries": 10,
-        "concurrent_fragment_downloads": 4,
         "quiet": True,
         "no_warnings": True,
 
@@ -77,11 +179,6 @@ def ytdlp_download(url: str, outtmpl: str, mode: str = "mp4") -> str:
             "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
         },
 
-        # 4) ダウンロードの挙動を少し穏やかに
-        "sleep_interval": 1,
-        "max_sleep_interval": 2,
-        "throttledratelimit": 1_000_000,  # 1MB/s程度に抑制（任意）
-
         # 5) （任意）抽出器ワークアラウンド：最近の403/署名絡みで効くことがある
         #   効かない場合は削ってOK
         "extractor_args": {
@@ -92,119 +189,534 @@ def ytdlp_download(url: str, outtmpl: str, mode: str = "mp4") -> str:
     }
     if use_cookie:
         common_opts["cookiefile"] = cookie_path
+    return common_opts
+
+def ytdlp_profile_opts(profile: str, mode: str) -> dict:
+    """
+    プロファイルに応じた yt-dlp のオプション（形式選択・並列数・外部ダウンローダ・FFmpeg）
+    """
+    conf = YTDLP_PROFILES.get(profile) or YTDLP_PROFILES[DEFAULT_PROFILE]
+    opts = {"concurrent_fragment_downloads": conf["fragments"]}
+
+    # 4) ダウンロードの挙動を少し穏やかに
+    if conf["sleep"]:
+        opts["sleep_interval"], opts["max_sleep_interval"] = conf["sleep"]
+    if conf["ratelimit"]:
+        opts["throttledratelimit"] = conf["ratelimit"]
+
+    if conf["external"] and shutil.which(conf["external"]):
+        opts["external_downloader"] = {"default": conf["external"]}
+        opts["external_downloader_args"] = {conf["external"]: ["-x", str(conf["fragments"]), "-k", "1M"]}
+    if conf["ffmpeg_threads"]:
+        opts["postprocessor_args"] = {"ffmpeg": ["-threads", str(conf["ffmpeg_threads"])]}
 
     if mode == "mp3":
-        ydl_opts = {
-            **common_opts,
-            "format": "bestaudio/best",
-            "postprocessors": [
-                {"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": "0"}
-            ],
-        }
+        # 出力は常に mp3（キャッシュのキーも -mp3-）。元が mp3 なら FFmpegExtractAudio は再エンコードせずに取り出す
+        opts["format"] = "bestaudio[acodec=mp3]/bestaudio/best" if conf["copy"] else "bestaudio/best"
+        opts["postprocessors"] = [
+            {"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": conf["audio_quality"]}
+        ]
     else:
-        ydl_opts = {
-            **common_opts,
-            "format": "bv*+ba/b",
-            "merge_output_format": "mp4",
-        }
+        # mp4+m4a を優先すると結合はコピーだけで済む
+        opts["format"] = "bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]/bv*+ba/b" if conf["copy"] else "bv*+ba/b"
+        opts["merge_output_format"] = "mp4"
+    return opts
+
+def ytdlp_download(url: str, outtmpl: str, mode: str = "mp4",
+                   progress_hook=None, postprocessor_hook=None, info=None,
+                   profile: str = DEFAULT_PROFILE, timings=None) -> str:
+    common_opts = {**ytdlp_common_opts(), "outtmpl": outtmpl}
+
+    # 段階ごとの所要時間を timings（dict）に記録する
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    stage_started = {}
+    def on_download(d):
+        if d.get("status") == "finished":
+            timings["download"] = time.perf_counter() - started
+        if progress_hook:
+            progress_hook(d)
+    def on_postprocess(d):
+        stage = PP_STAGES.get(d.get("postprocessor"))
+        if stage and d.get("status") == "started":
+            stage_started[stage] = time.perf_counter()
+        elif stage and d.get("status") == "finished" and stage in stage_started:
+            timings[stage] = timings.get(stage, 0) + time.perf_counter() - stage_started.pop(stage)
+        if postprocessor_hook:
+            postprocessor_hook(d)
+
+    # 進捗の通知先（ジョブの進捗表示用）
+    common_opts["progress_hooks"] = [on_download]
+    common_opts["postprocessor_hooks"] = [on_postprocess]
+
+    ydl_opts = {**common_opts, **ytdlp_profile_opts(profile, mode)}
 
-    from yt_dlp import YoutubeDL
     with YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
+        if info is not None:
+            # 事前確認で取得済みのメタデータから形式選択・ダウンロードだけ行う
+            info = ydl.process_ie_result(info, download=True)
+        else:
+            info = ydl.extract_info(url, download=True)
+        # 後処理後の最終的なパス（拡張子が変わる場合もある）
+        downloads = info.get("requested_downloads") or []
+        if downloads and downloads[-1].get("filepath") and os.path.exists(downloads[-1]["filepath"]):
+            return downloads[-1]["filepath"]
         path = ydl.prepare_filename(info)
         base, _ = os.path.splitext(path)
         return base + ".mp3" if mode == "mp3" else (base + ".mp4" if os.path.exists(base + ".mp4") else path)
 
+def fetch_metadata(url):
+    """
+    yt-dlp で動画情報だけを取得し（ダウンロードしない）、ダウンロード時に使い回せるよう保存する
+    """
+    opts = {**ytdlp_common_opts(), "socket_timeout": VALIDATE_TIMEOUT, "retries": 0}
+    with YoutubeDL(opts) as ydl:
+        # 形式選択はダウンロード時の設定で行うので process=False
+        info = ydl.extract_info(url, download=False, process=False)
+
+    with _metadata_lock:
+        now = time.time()
+        for key in [k for k, (t, _) in _metadata_cache.items() if now - t > METADATA_TTL]:
+            del _metadata_cache[key]
+        if len(_metadata_cache) >= METADATA_MAX_ENTRIES:
+            del _metadata_cache[min(_metadata_cache, key=lambda k: _metadata_cache[k][0])]
+        _metadata_cache[url] = (now, info)
+    return info
+
+def take_metadata(url):
+    """
+    fetch_metadata で保存した情報を取り出す（1回限り）。無い・古い場合は None
+    """
+    with _metadata_lock:
+        entry = _metadata_cache.pop(url, None)
+    if entry and time.time() - entry[0] <= METADATA_TTL:
+        return entry[1]
+    return None
+
+def validate_url(url):
+    """
+    ダウンロードできそうなURLかを確認する。通信は多くても1回（タイムアウト付き）
+    """
+    parsed = urlparse(url.strip())
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+
+    if VALIDATE_MODE == "metadata":
+        try:
+            fetch_metadata(url)
+            return True
+        except Exception as e:
+            print(f"動画情報の取得に失敗しました: {e}")
+            return False
+
+    # YouTubeの動画URLは形だけで判定する（通信しない）
+    if parse_video_url(url):
+        return True
+
+    try:
+        req = urllib.request.Request(url, method="HEAD",
+                                     headers={"User-Agent": ytdlp_common_opts()["http_headers"]["User-Agent"]})
+        urllib.request.urlopen(req, timeout=VALIDATE_TIMEOUT).close()
+        return True
+    except urllib.error.HTTPError as e:
+        # HEAD を受け付けないサイトもあるので、存在しないことが明らかな場合だけ弾く
+        return e.code not in (404, 410)
+    except (urllib.error.URLError, OSError, ValueError):
+        return False
+
+YOUTUBE_HOSTS = {"youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtu.be"}
+
+def parse_video_url(url):
+    """
+    YouTubeのURLから動画IDを取り出す。分からなければ None
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    if host not in YOUTUBE_HOSTS:
+        return None
+
+    video_id = None
+    if host == "youtu.be":
+        video_id = parsed.path.lstrip("/").split("/")[0]
+    elif parsed.path == "/watch":
+        video_id = (parse_qs(parsed.query).get("v") or [None])[0]
+    elif parsed.path.startswith(("/shorts/", "/live/", "/embed/")):
+        video_id = parsed.path.split("/")[2]
+
+    # YouTubeの動画IDは英数字と - _ の11文字
+    if not video_id or len(video_id) != 11 or not all(ch.isalnum() or ch in "-_" for ch in video_id):
+        return None
+    return video_id
+
+def video_key(url, mode, profile=DEFAULT_PROFILE):
+    """
+    キャッシュのキー（例: youtube-<ID>-mp4-polite）を返す。動画IDが分からなければ None
+    プロファイルで形式選択が変わるのでキーに含める
+    """
+    video_id = parse_video_url(url)
+    return f"youtube-{video_id}-{mode}-{profile}" if video_id else None
+
+def cache_lookup(cache_key):
+    """
+    キャッシュにあればファイル名（UPLOAD_FOLDERからの相対パス）を返し、最終利用時刻を更新する
+    """
+    if not cache_key:
+        return None
+    conn = get_connection(DATABASE)
+    row = conn.execute("SELECT filename, created_at FROM download_cache WHERE cache_key = ?",
+                       (cache_key,)).fetchone()
+    if not row:
+        return None
+
+    filename, created_at = row
+    path = safe_join(UPLOAD_FOLDER, filename)
+    # 以前の fast / audio-only-lowcost は mp3 を指定しても m4a を保存していたので、それは使わない
+    wrong_format = '-mp3-' in cache_key and not filename.endswith('.mp3')
+    if time.time() - created_at > CACHE_TTL or not path or not os.path.exists(path) or wrong_format:
+        cache_remove(cache_key, filename)
+        return None
+
+    with conn:
+        conn.execute("UPDATE download_cache SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key))
+    return filename
+
+def cache_store(cache_key, filepath):
+    """
+    ダウンロードしたファイルをキャッシュの台帳に登録し、上限を超えた分を古い順に消す
+    """
+    filename = os.path.relpath(filepath, UPLOAD_FOLDER).replace(os.sep, "/")
+    now = time.time()
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO download_cache (cache_key, filename, size, created_at, last_access) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (cache_key, filename, os.path.getsize(filepath), now, now))
+    evict_cache()
+    return filename
+
+def cache_remove(cache_key, filename):
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute("DELETE FROM download_cache WHERE cache_key = ?", (cache_key,))
+    remove_cache_folder(cache_key)
+
+def remove_cache_folder(cache_key):
+    folder = os.path.join(CACHE_FOLDER, cache_key)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder, onerror=lambda func, path, exc: print(f"キャッシュの削除に失敗しました: {exc[1]}"))
+
+def job_folder(cache_key, job_id):
+    """
+    ジョブごとのダウンロード先（書き終えたら cache/<key> に移す）
+    """
+    return os.path.join(CACHE_FOLDER, f"{cache_key}.{job_id}.part")
+
+def move_into_cache(folder, cache_key, filepath):
+    """
+    ジョブのフォルダを cache/<key> に移し、移した後の filepath を返す
+    同じキーの別のジョブが先に移していたら、自分の分は消してそちらのファイルを使う
+    """
+    cache_folder = os.path.join(CACHE_FOLDER, cache_key)
+    try:
+        os.rename(folder, cache_folder)
+    except OSError:
+        existing = os.path.join(cache_folder, os.path.relpath(filepath, folder))
+        if not os.path.exists(existing):
+            raise
+        shutil.rmtree(folder, ignore_errors=True)
+        return existing
+    return os.path.join(cache_folder, os.path.relpath(filepath, folder))
+
+def active_cache_keys():
+    """
+    待機中・実行中のジョブが書き込む（これから書き込む）キャッシュのフォルダ名（キーとジョブごとのフォルダ）
+    """
+    rows = get_connection(DATABASE).execute(
+        "SELECT id, url, mode, profile FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+    names = set()
+    for job_id, url, mode, profile in rows:
+        cache_key = video_key(url, mode, profile or DEFAULT_PROFILE)
+        if cache_key:
+            names.update((cache_key, os.path.basename(job_folder(cache_key, job_id))))
+    return names
+
+def sweep_orphans(now=None):
+    """
+    台帳に無いキャッシュのフォルダ（失敗・中断したダウンロードの残り）を消す
+    実行中のジョブのものと、更新から CACHE_ORPHAN_GRACE 以内のものは残す
+    """
+    now = time.time() if now is None else now
+    conn = get_connection(DATABASE)
+    keep = {key for (key,) in conn.execute("SELECT cache_key FROM download_cache")} | active_cache_keys()
+    removed = 0
+    for name in os.listdir(CACHE_FOLDER):
+        folder = os.path.join(CACHE_FOLDER, name)
+        if name in keep or not os.path.isdir(folder):
+            continue
+        mtimes = [os.path.getmtime(folder)]
+        for root, dirs, files in os.walk(folder):
+            mtimes.extend(os.path.getmtime(os.path.join(root, f)) for f in files)
+        if now - max(mtimes) <= CACHE_ORPHAN_GRACE:
+            continue
+        remove_cache_folder(name)
+        removed += 1
+    return removed
+
+def evict_cache():
+    """
+    期限切れのものを消し、合計サイズが上限を超えていれば最終利用の古い順に消す
+    """
+    conn = get_connection(DATABASE)
+    expired = conn.execute("SELECT cache_key, filename FROM download_cache WHERE created_at < ?",
+                           (time.time() - CACHE_TTL,)).fetchall()
+    for cache_key, filename in expired:
+        cache_remove(cache_key, filename)
+    sweep_orphans()
+
+    total = conn.execute("SELECT IFNULL(SUM(size), 0) FROM download_cache").fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    for cache_key, filename, size in conn.execute(
+            "SELECT cache_key, filename, size FROM download_cache ORDER BY last_access ASC").fetchall():
+        cache_remove(cache_key, filename)
+        total -= size
+        if total <= CACHE_MAX_BYTES:
+            break
+
+# ジョブで使うダウンロード関数（テストでは偽物に差し替える）
+downloader = ytdlp_download
+
+# ダウンロード用のワーカープール
+executor = WorkerPool(JOB_WORKERS, 'ytdlp')
+
+def submit_job(url, mode, profile=DEFAULT_PROFILE):
+    """
+    ダウンロードジョブを登録してすぐにジョブIDを返す
+    """
+    job_id = uuid.uuid4().hex
+    now = datetime.now(jst)
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute("INSERT INTO jobs (id, created_at, updated_at, url, mode, profile, status, progress, message) "
+                     "VALUES (?, ?, ?, ?, ?, ?, 'queued', 0, '待機中')",
+                     (job_id, now, now, url, mode, profile))
+    executor.submit(run_job, job_id)
+    return job_id
+
+def update_job(job_id, **fields):
+    fields['updated_at'] = datetime.now(jst)
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    conn = get_connection(DATABASE)
+    with conn:
+        conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+def get_job(job_id):
+    c = get_connection(DATABASE).cursor()
+    c.row_factory = sqlite3.Row
+    c.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def run_job(job_id):
+    """
+    ワーカースレッドでジョブを1件実行する
+    """
+    conn = get_connection(DATABASE)
+    # 待機中のものだけを実行中にする（他のプロセスが先に取っていたら何もしない）
+    with conn:
+        claimed = conn.execute("UPDATE jobs SET status = 'running', message = '開始', updated_at = ? "
+                               "WHERE id = ? AND status = 'queued'",
+                               (datetime.now(jst), job_id)).rowcount
+    if claimed != 1:
+        return
+    job = get_job(job_id)
+
+    # 実行中であることを定期的に記録する（変換中など進捗が出ない間も止まっていないと分かるように）
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(JOB_HEARTBEAT):
+            update_job(job_id)
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    last = {'time': 0.0}
+    def on_download(d):
+        if d.get('status') == 'downloading':
+            now = time.monotonic()
+            if now - last['time'] < PROGRESS_INTERVAL:
+                return
+            last['time'] = now
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                update_job(job_id, progress=round((d.get('downloaded_bytes') or 0) * 100 / total, 1),
+                           message='ダウンロード中')
+        elif d.get('status') == 'finished':
+            update_job(job_id, progress=100, message='ダウンロード完了')
+
+    def on_postprocess(d):
+        if d.get('status') == 'started':
+            update_job(job_id, message=f"変換中（{d.get('postprocessor')}）")
+
+    cache_key = None
+    try:
+        # 出力テンプレ（動画IDが分かるものはジョブごとのフォルダに書き、終わったらキャッシュに移す）
+        profile = job['profile'] or DEFAULT_PROFILE
+        cache_key = video_key(job['url'], job['mode'], profile)
+        folder = job_folder(cache_key, job_id) if cache_key else UPLOAD_FOLDER
+        outtmpl = os.path.join(folder, "%(title)s.%(ext)s")
+        timings = {}
+        filepath = downloader(job['url'], outtmpl, mode=job['mode'],
+                              progress_hook=on_download, postprocessor_hook=on_postprocess,
+                              info=take_metadata(job['url']), profile=profile, timings=timings)
+        if not os.path.exists(filepath):
+            raise FileNotFoundError("出力ファイルが見つかりません。")
+
+        if cache_key:
+            filename = cache_store(cache_key, move_into_cache(folder, cache_key, filepath))
+        else:
+            filename = os.path.basename(filepath)
+        save_history(job['url'], filename, cache_hit=False, profile=profile, timings=timings)
+        update_job(job_id, status='done', progress=100, message='完了', filename=filename)
+    except Exception as e:
+        update_job(job_id, status='error', message=f"リンク先からダウンロードできません: {str(e)}")
+        # 途中まで書いたファイルは台帳に載らないので、ここで消す（消すのはこのジョブのフォルダだけ）
+        if cache_key:
+            shutil.rmtree(job_folder(cache_key, job_id), ignore_errors=True)
+    finally:
+        stop.set()
+
+def resume_jobs():
+    """
+    再起動などで終わらなかったジョブ（待機中・更新が途絶えた実行中）を待機中に戻して再実行する
+    """
+    conn = get_connection(DATABASE)
+    stale = datetime.fromtimestamp(time.time() - JOB_STALE_SECONDS, jst)
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'queued', message = '再開待ち' "
+                     "WHERE status = 'running' AND updated_at < ?", (stale,))
+    for (job_id,) in conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at").fetchall():
+        executor.submit(run_job, job_id)
+
+jobs_resume = resume_once(youtube_to_mpeg_bp, resume_jobs)
+
+def prune_jobs(now=None):
+    """
+    終わってから JOB_TTL を過ぎたジョブの行を消し、消した件数を返す（common.janitor から呼ぶ）
+    """
+    now = time.time() if now is None else now
+    conn = get_connection(DATABASE)
+    with conn:
+        return conn.execute("DELETE FROM jobs WHERE status IN ('done', 'error') AND updated_at < ?",
+                            (datetime.fromtimestamp(now - JOB_TTL, jst),)).rowcount
+
+register_task('youtube_to_mpeg.jobs', prune_jobs)
+
 
 # ② index() 内で選択値を読む & 呼び出しを切替
 @youtube_to_mpeg_bp.route('/', methods=['GET', 'POST'])
 def index():
-    clear_upload_folder()
-
     form = YoutubeToMpegForm()
     if form.validate_on_submit():
         url_text = form.text.data
         # 追加：UIから出力形式を取得（デフォルトmp4）
         selected_fmt = request.form.get('format', 'mp4')
+        profile = request.form.get('profile', DEFAULT_PROFILE)
+        if profile not in YTDLP_PROFILES:
+            profile = DEFAULT_PROFILE
 
-        try:
-            f = urllib.request.urlopen(url_text)
-            f.close()
-        except:
+        # 同じ動画・形式がキャッシュにあればダウンロードせずに結果画面へ
+        cached = cache_lookup(video_key(url_text, selected_fmt, profile))
+        if cached:
+            save_history(url_text, cached, cache_hit=True, profile=profile)
+            return redirect(url_for('youtube_to_mpeg.result', filename=cached))
+
+        if not validate_url(url_text):
             flash('有効なURLを指定してください', 'danger')
             return redirect(url_for('youtube_to_mpeg.index'))
 
-        try:
-            # 出力テンプレ
-            outtmpl = os.path.join(UPLOAD_FOLDER, "%(title)s.%(ext)s")
-            # 変更：モードを渡す
-            filepath = ytdlp_download(url_text, outtmpl, mode=selected_fmt)
-
-            if not os.path.exists(filepath):
-                flash("出力ファイルが見つかりません。", "danger")
-                return redirect(url_for('youtube_to_mpeg.index'))
-
-            filename = os.path.basename(filepath)
-            save_history(url_text, filename)
-            return redirect(url_for('youtube_to_mpeg.result', filename=filename))
-
-        except Exception as e:
-            # ここ、原因の一部を出すとデバッグが楽（本番はログにだけ出す等でもOK）
-            flash(f"リンク先からダウンロードできません: {str(e)}", 'danger')
-            return redirect(url_for('youtube_to_mpeg.index'))
+        # ダウンロードはワーカーで実行し、進捗画面へ移る
+        job_id = submit_job(url_text, selected_fmt, profile)
+        return redirect(url_for('youtube_to_mpeg.job', job_id=job_id))
 
     if form.errors:
         for error in form.errors['text']:
             flash(error, 'danger')
-    return render_template('youtube_to_mpeg/upload.html', form=form)
-
-
-def clear_upload_folder():
-    for filename in os.listdir(UPLOAD_FOLDER):
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)  # ファイルを削除
-            elif os.path.isdir(file_path):
-                os.rmdir(file_path)  # サブフォルダを削除（必要なら再帰処理を追加）
-        except Exception as e:
-            flash(e, 'danger')
-            return redirect(url_for('youtube_to_mpeg.index'))
-
-@youtube_to_mpeg_bp.route('/result/<filename>')
+    return render_template('youtube_to_mpeg/upload.html', form=form,
+                           profiles=YTDLP_PROFILES, default_profile=DEFAULT_PROFILE)
+
+
+@youtube_to_mpeg_bp.route('/job/<job_id>')
+def job(job_id):
+    """
+    ジョブの進捗画面（完了すると結果画面へ移る）
+    """
+    job = get_job(job_id)
+    if not job:
+        flash('指定されたジョブは存在しません', 'danger')
+        return redirect(url_for('youtube_to_mpeg.index'))
+    if job['status'] == 'done':
+        return redirect(url_for('youtube_to_mpeg.result', filename=job['filename']))
+    return render_template('youtube_to_mpeg/job.html', job=job)
+
+@youtube_to_mpeg_bp.route('/job/<job_id>/status')
+def job_status(job_id):
+    """
+    ジョブの状態をJSONで返す（進捗画面からポーリングする）
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "job not found"}), 404
+    result_url = None
+    if job['status'] == 'done':
+        result_url = url_for('youtube_to_mpeg.result', filename=job['filename'])
+    return jsonify({
+        "ok": True,
+        "status": job['status'],
+        "progress": job['progress'],
+        "message": job['message'],
+        "result_url": result_url,
+    })
+
+@youtube_to_mpeg_bp.route('/result/<path:filename>')
 def result(filename):
-    if not os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
+    file_path = safe_join(UPLOAD_FOLDER, filename)
+    if not file_path or not os.path.isfile(file_path):
         flash(f'指定されたファイルは存在しません:{filename}', 'danger')
         return redirect(url_for('youtube_to_mpeg.index'))
     
     return render_template('youtube_to_mpeg/result.html', video_file=filename)
 
+@youtube_to_mpeg_bp.route('/media/<path:filename>')
+def media(filename):
+    # Range・条件付きリクエスト対応の配信（?download=1 で保存用）
+    return send_media(UPLOAD_FOLDER, filename, as_attachment=request.args.get('download') == '1')
 
-def save_history(input_text, video_file):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
 
-    # 現在の日時をJSTで取得
-    current_time = datetime.now(jst)
-    c.execute("INSERT INTO history (timestamp, input_text, video_file) VALUES (?, ?, ?)",
-              (current_time, input_text, video_file))
-    
-    conn.commit()
-    conn.close()
+def save_history(input_text, video_file, cache_hit=None, profile=None, timings=None):
+    timings = timings or {}
+
+    record('youtube_to_mpeg', input_text=input_text, file=video_file, cache_hit=cache_hit, profile=profile,
+           download_seconds=timings.get('download'), merge_seconds=timings.get('merge'),
+           transcode_seconds=timings.get('transcode'))
 
 @youtube_to_mpeg_bp.route("/history", methods=['GET', 'POST'])
 def history():
     if request.method == 'POST':
         password = request.form.get('password')
         if password == HISTORY_PASSWORD:
-            conn = sqlite3.connect(DATABASE)
-            c = conn.cursor()
-            c.execute("SELECT id, datetime(timestamp, 'localtime'), input_text, video_file FROM history ORDER BY timestamp DESC")
-            history_data = c.fetchall()
-            conn.close()
-            return render_template('youtube_to_mpeg/history.html', history=history_data)
+            session['youtube_to_mpeg_history'] = True
+            return redirect(url_for('youtube_to_mpeg.history'))
         else:
             flash("パスワードが正しくありません", "danger")
             return redirect(url_for('youtube_to_mpeg.history'))
-
-    return render_template('youtube_to_mpeg/password_prompt.html')
+    if not session.get('youtube_to_mpeg_history'):
+        return render_template('youtube_to_mpeg/password_prompt.html')
+
+    # 期間指定とページ移動は common.history_store
+    page = query_history('youtube_to_mpeg', request.args)
+    history_data = [(row[0], row[1], row[2], row[3], row[5], row[6].get('profile'),
+                     row[6].get('download_seconds'), row[6].get('merge_seconds'), row[6].get('transcode_seconds'))
+                    for row in page.rows]
+    # キャッシュのヒット／ミス件数
+    counts = cache_counts('youtube_to_mpeg')
+    return render_template('youtube_to_mpeg/history.html', history=history_data, page=page, args=request.args,
+                           cache_hits=counts.get(1, 0), cache_misses=counts.get(0, 0))